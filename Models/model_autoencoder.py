@@ -1,11 +1,13 @@
 from __future__ import division
 from __future__ import print_function
 
+import itertools
+
 import numpy as np
 import torch
 import torch.optim
-from torch.nn import BCELoss
-from torch.utils.data import DataLoader
+from scipy import sparse
+from torch.nn.functional import binary_cross_entropy
 from torch.utils.data.dataset import Dataset
 import matplotlib.pyplot as plt
 import os.path as osp
@@ -13,15 +15,18 @@ import os.path as osp
 plt.rcParams.update({"figure.max_open_warning": 0})
 
 from early_stopping import EarlyStopping
-from net import Autoencoder
-from sklearn.model_selection import train_test_split
+from net import Autoencoder, SparseAutoencoder
 
 CUDA = torch.cuda.is_available()
 print(f"IS CUDA AVAILABLE: {CUDA}")
 
 
 class AECTraining:
-    """Train autoencoder net, use transformation of data if defined"""
+    """
+    Train autoencoder net on the samples of SparqlTreeBuilder.lista_samples_aec.
+    transform is kept for compatibility, samples are encoded as
+    get_one_hot_from_tuple by AECDataset.from_samples.
+    """
 
     def __init__(
         self,
@@ -33,7 +38,17 @@ class AECTraining:
         transform=None,
         learning_rate=0.0001,
         output_path="./",
+        deduplicate=True,
+        sparse=False,
+        negatives=256,
     ):
+        """
+        :param deduplicate: train on the distinct nodes weighted by their
+        frequency, same objective as training on every node.
+        :param sparse: train a SparseAutoencoder, the encoder reads the indexes of
+        the predicates and the loss of the decoder is estimated on negatives
+        columns sampled by batch besides the columns present.
+        """
         self.__net = None
         self.__verbose = verbose
         self.__ds_aec = ds_aec
@@ -44,26 +59,33 @@ class AECTraining:
         self.__transform = transform
         self.__learning_rate = learning_rate
         self.output_path = output_path
+        self.deduplicate = deduplicate
+        self.sparse = sparse
+        self.negatives = negatives
 
     def cuda(self):
         self.__cuda = True
 
     def fit(self, output_file):
-        batch_size = 128
+        from sklearn.model_selection import train_test_split
 
-        X_train, X_val = train_test_split(self.__ds_aec, test_size=0.2, shuffle=True)
+        batch_size = 128
 
-        dataset_train = AECDataset(
-            X_train, ignore_first=self.ignore_first, transform=self.__transform
-        )
-        dataset_val = AECDataset(
-            X_val, ignore_first=self.ignore_first, transform=self.__transform
+        # Encoded once, batches are sliced from the matrix
+        dataset = AECDataset.from_samples(
+            self.__ds_aec, self.__io_dim, ignore_first=self.ignore_first
         )
-
-        dataloader_train = DataLoader(
-            dataset_train, batch_size=batch_size, shuffle=True
+        if self.deduplicate:
+            # Copies of a node go all to train or all to validation
+            print("AEC nodes: {}".format(len(dataset)), end=", ")
+            dataset = dataset.deduplicate()
+            print("distinct: {}".format(len(dataset)))
+        train, val = train_test_split(
+            np.arange(len(dataset)), test_size=0.2, shuffle=True
         )
-        dataloader_val = DataLoader(dataset_val, batch_size=batch_size, shuffle=False)
+        dataset_train = dataset.subset(train)
+        dataset_val = dataset.subset(val)
+        device = "cuda" if CUDA else None
 
         # initialize the early_stopping object
         early_stopping = EarlyStopping(
@@ -73,11 +95,14 @@ class AECTraining:
             path=osp.join(self.output_path, "aec_checkpoint.pt"),
         )
 
-        self.__net = Autoencoder(self.__io_dim)
+        if self.sparse:
+            self.__net = SparseAutoencoder(self.__io_dim)
+        else:
+            self.__net = Autoencoder(self.__io_dim)
         if CUDA:
             self.__net = self.__net.cuda()
 
-        criterion = BCELoss()
+        criterion = weighted_bce
         optimizer = torch.optim.Adam(self.__net.parameters(), lr=self.__learning_rate)
         losses = []
         losses_val = []
@@ -85,15 +110,22 @@ class AECTraining:
             flag = True
             loss_accum = 0
             self.__net.train()
-            for data in dataloader_train:
-                if CUDA:
-                    data = data.cuda()
-                # data = data
+            for batch in dataset_train.batches(
+                batch_size,
+                shuffle=True,
+                device=device,
+                weights=True,
+                sparse=self.sparse,
+            ):
                 # ===================forward=====================
-                output = self.__net(data)
+                if self.sparse:
+                    loss = self.__net.sampled_loss(*batch, negatives=self.negatives)
+                else:
+                    data, weights = batch
+                    output = self.__net(data)
+                    loss = criterion(output, data, weights)
                 if flag:
                     flag = False
-                loss = criterion(output, data)
                 # ===================backward====================
                 optimizer.zero_grad()
                 loss.backward()
@@ -101,19 +133,19 @@ class AECTraining:
                 lost_item = loss.item()
                 loss_accum += lost_item
             # ===================log========================
-            loss_accum /= len(dataloader_train)
+            loss_accum /= dataset_train.num_batches(batch_size)
             losses.append(loss_accum)
 
             self.__net.eval()
             with torch.no_grad():
                 loss_accum_val = 0
-                for data_val in dataloader_val:
-                    if CUDA:
-                        data_val = data_val.cuda()
+                for data_val, weights_val in dataset_val.batches(
+                    batch_size, device=device, weights=True
+                ):
                     y_pred = self.__net(data_val)
-                    loss_val = criterion(y_pred, data_val)
+                    loss_val = criterion(y_pred, data_val, weights_val)
                     loss_accum_val += loss_val.item()
-                loss_accum_val /= len(dataloader_val)
+                loss_accum_val /= dataset_val.num_batches(batch_size)
                 losses_val.append(loss_accum_val)
 
             print(
@@ -158,29 +190,122 @@ class AECTraining:
         plt.cla()
 
 
+def weighted_bce(output, target, weights):
+    """Binary cross entropy of the rows averaged with weights, BCELoss if they are 1"""
+    losses = binary_cross_entropy(output, target, reduction="none").mean(1)
+    return (losses * weights).sum() / weights.sum()
+
+
 class AECDataset(Dataset):
-    """Autoencoder treen nodes dataset."""
+    """
+    Autoencoder tree nodes dataset. The multi-hot encodings of the nodes are a
+    CSR matrix built once, batches are sliced from it and densified, see batches.
+    """
 
-    def __init__(self, data, ignore_first=18, transform=None):
+    def __init__(self, matrix, weights=None):
         """
-        Args:
-            csv_file (string): Path to the csv file with annotations.
-            transform (callable, optional): Optional transform to be applied
-                on a sample.
+        :param matrix: sparse matrix, one node by row.
+        :param weights: weight of every row, as the copies of a node after
+        deduplicate. 1 if None.
         """
-        self.data = data
-        self.transform = transform
-        self.ignore_first = ignore_first
+        self.matrix = sparse.csr_matrix(matrix, dtype=np.float32)
+        if weights is None:
+            weights = np.ones(self.matrix.shape[0], dtype=np.float32)
+        self.weights = np.asarray(weights, dtype=np.float32)
+
+    @classmethod
+    def from_samples(cls, samples, io_dim, ignore_first=18):
+        """
+        Dataset of the index lists of SparqlTreeBuilder.lista_samples_aec, encoded
+        as get_one_hot_from_tuple without the first ignore_first indexes.
+        """
+        lengths = np.fromiter(map(len, samples), dtype=np.int64, count=len(samples))
+        indices = np.fromiter(
+            itertools.chain.from_iterable(samples),
+            dtype=np.int64,
+            count=int(lengths.sum()),
+        )
+        rows = np.repeat(np.arange(len(samples)), lengths)
+        keep = indices >= ignore_first
+        # Repeated indexes of a sample are summed, as get_one_hot_from_tuple
+        matrix = sparse.csr_matrix(
+            (
+                np.ones(int(keep.sum()), dtype=np.float32),
+                (rows[keep], indices[keep] - ignore_first),
+            ),
+            shape=(len(samples), io_dim),
+        )
+        return cls(matrix)
+
+    def subset(self, rows):
+        return AECDataset(self.matrix[rows], self.weights[rows])
+
+    def deduplicate(self):
+        """Dataset of the distinct rows weighted by their total weight"""
+        matrix = self.matrix.copy()
+        matrix.sum_duplicates()
+        counts = np.diff(matrix.indptr)
+        # Rows as (indexes, values) padded to the longest row, then compared whole
+        width = int(counts.max()) if len(counts) else 0
+        rows = np.repeat(np.arange(len(counts)), counts)
+        columns = np.arange(len(rows)) - np.repeat(matrix.indptr[:-1], counts)
+        padded = np.full((len(counts), 2 * width), -1, dtype=np.int64)
+        padded[rows, columns] = matrix.indices
+        padded[rows, width + columns] = matrix.data.view(np.int32)
+        _, first, inverse = np.unique(
+            padded, axis=0, return_index=True, return_inverse=True
+        )
+        weights = np.bincount(inverse.reshape(-1), weights=self.weights)
+        return AECDataset(matrix[first], weights)
+
+    @staticmethod
+    def sparse(batch, device=None):
+        """Flat indexes, offsets of the rows and values of a CSR batch, see EmbeddingBag"""
+        return (
+            torch.from_numpy(batch.indices.astype(np.int64)).to(device),
+            torch.from_numpy(batch.indptr[:-1].astype(np.int64)).to(device),
+            torch.from_numpy(batch.data).to(device),
+        )
 
     def __len__(self):
-        return len(self.data)
+        return self.matrix.shape[0]
 
     def __getitem__(self, idx):
-        row = self.data[idx]
-        if self.transform:
-            row = self.transform(row)
-        row = torch.from_numpy(row[self.ignore_first :]).to(torch.float32)
-        return row
+        return torch.from_numpy(self.matrix[idx].toarray()[0])
+
+    def num_batches(self, batch_size):
+        return -(-len(self) // batch_size)
+
+    def batches(
+        self, batch_size, shuffle=False, device=None, weights=False, sparse=False
+    ):
+        """
+        Dense batches of rows, on device if given, with their weights if weights.
+        With sparse the batches are the (indexes, offsets, values) of sparse.
+        """
+        order = np.random.permutation(len(self)) if shuffle else np.arange(len(self))
+        for start in range(0, len(self), batch_size):
+            rows = order[start : start + batch_size]
+            if sparse:
+                batch = self.sparse(self.matrix[rows], device)
+            else:
+                batch = (self.dense(self.matrix[rows], device),)
+            if weights:
+                batch += (torch.from_numpy(self.weights[rows]).to(batch[0].device),)
+            yield batch if len(batch) > 1 else batch[0]
+
+    @staticmethod
+    def dense(batch, device=None):
+        if device is not None and torch.device(device).type == "cuda":
+            # Only the non zeros are copied, densified on the device
+            batch = torch.sparse_csr_tensor(
+                torch.from_numpy(batch.indptr).to(torch.int64),
+                torch.from_numpy(batch.indices).to(torch.int64),
+                torch.from_numpy(batch.data),
+                size=batch.shape,
+            )
+            return batch.to(device).to_dense()
+        return torch.from_numpy(batch.toarray())
 
 
 ######################################################################
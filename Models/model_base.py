@@ -1,21 +1,26 @@
 # -*- coding: utf-8 -*-
 from __future__ import division
 from __future__ import print_function
+import contextlib
+import datetime
+import gc
+import importlib
+import json
 import logging
 import os.path as osp
-import json
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim
 import joblib
 import os
-from sklearn import preprocessing
-from sklearn.pipeline import Pipeline
+import threading
+from functools import partial
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 import matplotlib.pyplot as plt
 
-
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 formatter = logging.Formatter("[%(asctime)s] %(levelname)s:%(name)s:%(message)s")
@@ -33,8 +38,21 @@ logger.addHandler(ch)
 
 plt.rcParams.update({"figure.max_open_warning": 0})
 
-from featurize import SPARQLTreeFeaturizer
-from net import NeoNet
+import distributed
+import profiling
+from custom_loss import make_loss
+from early_stopping import EarlyStopping
+from featurize import SPARQLTreeFeaturizer, map_tree
+from json_parser import ParsedTrees, parse_trees
+from net import autoencoder_for_state
+from prediction_cache import prediction_keys
+from transforms import (
+    CardinalityEncoder,
+    LogMinMaxTransform,
+    QueryScaler,
+    query_card_matrix,
+)
+from TreeConvolution.util import FlatTree
 
 CUDA = torch.cuda.is_available()
 
@@ -61,6 +79,66 @@ def _n_path(base):
     return os.path.join(base, "n")
 
 
+def _aec_path(base):
+    return os.path.join(base, "aec_weights")
+
+
+def _card_encoder_path(base):
+    return os.path.join(base, "card_encoder")
+
+
+def _config_path(base):
+    return os.path.join(base, "config.json")
+
+
+def _dump_query_scaler(scaler):
+    return None if scaler is None else scaler.to_dict()
+
+
+def _load_query_scaler(saved):
+    """QueryScaler of a config.json, None for models saved without it"""
+    scaler = saved.get("query_scaler")
+    return None if scaler is None else QueryScaler.from_dict(scaler)
+
+
+def _place(module, map_location):
+    """Module moved to the cpu when map_location asks for it, as it is otherwise"""
+    if map_location is not None and torch.device(map_location).type == "cpu":
+        return module.cpu()
+    return module
+
+
+# Lock of the attributes loaded on first access, see _Deferred
+_DEFERRED_LOCK = threading.RLock()
+
+
+class _Deferred:
+    """
+    Attribute of a regressor loaded on first access, when load(lazy=True) left a
+    loader for it in the _deferred dict of the regressor.
+    """
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.private = "_" + name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        if self.name in obj._deferred:
+            with _DEFERRED_LOCK:
+                # Removed once loaded, other threads wait for it on the lock
+                loader = obj._deferred.get(self.name)
+                if loader is not None:
+                    obj.__dict__[self.private] = loader()
+                    del obj._deferred[self.name]
+        return obj.__dict__[self.private]
+
+    def __set__(self, obj, value):
+        obj._deferred.pop(self.name, None)
+        obj.__dict__[self.private] = value
+
+
 # General Methods
 def scatter_image(y_pred, y_test, title, name, max_reference=300, figsize=None):
     plt.clf()
@@ -181,11 +259,32 @@ def _inv_log1p(x):
     return np.exp(x) - 1
 
 
+def target_pipeline():
+    """
+    Unfitted target transform of the regressors: log1p then min max scaling. The
+    only use of sklearn at prediction time was building it, it is built when
+    first used.
+    """
+    from sklearn import preprocessing
+    from sklearn.pipeline import Pipeline
+
+    log_transformer = preprocessing.FunctionTransformer(
+        np.log1p, _inv_log1p, validate=True
+    )
+    scale_transformer = preprocessing.MinMaxScaler()
+    return Pipeline([("log", log_transformer), ("scale", scale_transformer)])
+
+
 ###################################################################
 ###################################################################
 
 
 class BaseRegression:
+    # Loaded on first access after load(lazy=True)
+    net = _Deferred()
+    aec_net = _Deferred()
+    tree_transform = _Deferred()
+
     def __init__(
         self,
         output_path="./",
@@ -207,6 +306,10 @@ class BaseRegression:
         tree_activation_dense=nn.LeakyReLU,
         ignore_first_aec_data=18,
         start_history_from_epoch=2,
+        json_backend="auto",
+        profiler=None,
+        distributed=False,
+        loss=None,
     ):
         if tree_units_dense is None:
             tree_units_dense = [32, 28]
@@ -220,6 +323,8 @@ class BaseRegression:
         if optimizer is None:
             optimizer = {"optimizer": "Adam", "args": {"lr": 0.00015}}
 
+        # Loaders of the attributes not loaded yet, see _Deferred
+        self._deferred = {}
         self.output_path = output_path
         self.net = None
         self.verbose = verbose
@@ -237,14 +342,8 @@ class BaseRegression:
         print(
             f"Model optimizer: {self.optimizer['optimizer']} lr: {self.optimizer['args']['lr']}"
         )
-        log_transformer = preprocessing.FunctionTransformer(
-            np.log1p, _inv_log1p, validate=True
-        )
-        scale_transformer = preprocessing.MinMaxScaler()
-
-        self.pipeline = Pipeline(
-            [("log", log_transformer), ("scale", scale_transformer)]
-        )
+        # Target transform, see the pipeline property
+        self._pipeline = None
 
         self.tree_transform = SPARQLTreeFeaturizer()
         self.in_channels = in_channels
@@ -270,6 +369,24 @@ class BaseRegression:
             "mae_val_by_epoch": [],
         }
         self.maxcardinality = maxcardinality
+        self.card_encoder = None
+        # transforms.QueryScaler of the query features, None if given scaled
+        self.query_scaler = None
+        self.json_backend = json_backend
+        # Rows of json trees ignored by json_loads, see parse_trees
+        self.json_errors = []
+        # profiling.StageProfiler to time the stages of train_loop, None to disable
+        self.profiler = profiler
+        # Logger of the training loop, subclasses set their own
+        self.logger = logger
+        # Data parallel training in the process group of distributed.setup
+        self.distributed = distributed
+        # Training loss, see custom_loss.make_loss
+        self.loss = loss
+        # prediction_cache.PredictionCache of predict_raw_data, None to disable
+        self.prediction_cache = None
+        # node_memo.NodeMemo of the first convolution in predict_raw_data
+        self.node_memo = None
 
     def log(self, *args):
         if self.verbose:
@@ -278,66 +395,165 @@ class BaseRegression:
     def num_items_trained_on(self):
         return self.n
 
+    @property
+    def pipeline(self):
+        """Target transform, the sklearn pipeline of target_pipeline until set"""
+        if self._pipeline is None:
+            self._pipeline = target_pipeline()
+        return self._pipeline
+
+    @pipeline.setter
+    def pipeline(self, pipeline):
+        self._pipeline = pipeline
+
     def get_pred(self):
         return self.tree_transform.get_pred_index()
 
-    def load(self, path, best_model_path):
+    def net_config(self):
+        """Hyperparameters that rebuild the net with build_net, json serializable"""
+        return {
+            "query_input_size": int(self.query_input_size),
+            "query_hidden_inputs": list(self.query_hidden_inputs),
+            "query_output": self.query_output,
+            "tree_units": list(self.tree_units),
+            "tree_units_dense": list(self.tree_units_dense),
+            "tree_activation_tree": self.tree_activation_tree.__name__,
+            "tree_activation_dense": self.tree_activation_dense.__name__,
+            "in_channels_neo_net": self.in_channels_neo_net,
+            "ignore_first_aec_data": self.ignore_first_aec_data,
+        }
+
+    def set_prediction_cache(self, cache):
+        """Cache predictions of predict_raw_data in cache, None to disable it"""
+        self.prediction_cache = cache
+
+    def set_node_memo(self, memo):
+        """Memoize the first convolution of predict_raw_data in memo, None to disable it"""
+        self.node_memo = memo
+
+    def invalidate_caches(self):
+        """Cached predictions are stale once the model or the featurizer change"""
+        if self.prediction_cache is not None:
+            self.prediction_cache.clear()
+        if self.node_memo is not None:
+            self.node_memo.clear()
+
+    def __getstate__(self):
+        # Copies get every attribute, loaders are not picklable
+        self.load_deferred()
+        state = self.__dict__.copy()
+        state["_deferred"] = {}
+        return state
+
+    def load_deferred(self):
+        """Load now the attributes load(lazy=True) deferred"""
+        for name in list(self._deferred):
+            getattr(self, name)
+
+    def load(self, path, best_model_path=None, map_location=None, lazy=False):
+        """
+        Load a model saved by save. The net is rebuilt with the configuration
+        saved with it, whatever the configuration of this instance.
+        :param best_model_path: weights of the net to load instead of the saved ones,
+        as the checkpoint of train_loop.
+        :param map_location: device of the nets, "cpu" on hosts without CUDA. The
+        default device of the models if None.
+        :param lazy: load the net, the autoencoder and the featurizer on first
+        access instead of now.
+        """
         with open(_n_path(path), "rb") as f:
             self.n = joblib.load(f)
         with open(_channels_path(path), "rb") as f:
             self.in_channels = joblib.load(f)
-
-        self.net = NeoNet(
-            self.aec_net,
-            self.in_channels_neo_net,
-            self.query_input_size,
-            self.query_hidden_inputs,
-            self.query_output,
-            in_cuda=CUDA,
-        )
-
-        if best_model_path is not None:
-            self.net.load_state_dict(torch.load(best_model_path))
-        else:
-            self.net.load_state_dict(torch.load(_nn_path(path)))
-
-        if CUDA:
-            self.net = self.net.cuda()
-        self.net.eval()
-
         with open(_y_transform_path(path), "rb") as f:
             self.pipeline = joblib.load(f)
-        with open(_x_transform_path(path), "rb") as f:
-            self.tree_transform = joblib.load(f)
+        if os.path.exists(_card_encoder_path(path)):
+            with open(_card_encoder_path(path), "rb") as f:
+                self.card_encoder = joblib.load(f)
+
+        nn_path = _nn_path(path) if best_model_path is None else best_model_path
+        if os.path.exists(_config_path(path)):
+            with open(_config_path(path)) as f:
+                saved = json.load(f)
+            self.configure(saved["config"])
+            self.maxcardinality = saved["maxcardinality"]
+            self.query_scaler = _load_query_scaler(saved)
+            io_dim = saved["io_dim"]
+        else:
+            # Saved before config.json, the configuration of this instance
+            # with the query features size of the weights
+            state = torch.load(nn_path, map_location="cpu")
+            self.query_input_size = state["query_model.linear1.weight"].shape[1]
+            io_dim = None
+
+        def load_tree_transform():
+            with open(_x_transform_path(path), "rb") as f:
+                return joblib.load(f)
+
+        def load_aec_net():
+            state = torch.load(_aec_path(path), map_location="cpu")
+            aec_net = autoencoder_for_state(state, io_dim - self.ignore_first_aec_data)
+            aec_net.load_state_dict(state)
+            if CUDA:
+                aec_net = aec_net.cuda()
+            return _place(aec_net, map_location).eval()
+
+        def load_net():
+            net = _place(self.build_net(io_dim), map_location)
+            net.load_state_dict(torch.load(nn_path, map_location="cpu"))
+            return net.eval()
+
+        self.aec_net = None
+        self._deferred.update({"tree_transform": load_tree_transform, "net": load_net})
+        if os.path.exists(_aec_path(path)):
+            self._deferred["aec_net"] = load_aec_net
+        if io_dim is None:
+            io_dim = len(self.get_pred())
+        if not lazy:
+            self.load_deferred()
+        self.invalidate_caches()
+
+    def configure(self, config):
+        """Set the hyperparameters of a net_config"""
+        config = dict(config)
+        for name in ("tree_activation_tree", "tree_activation_dense"):
+            config[name] = getattr(nn, config[name])
+        for name, value in config.items():
+            setattr(self, name, value)
+
+    @staticmethod
+    def load_model(path, best_model_path=None, map_location=None, lazy=False):
+        """Regressor of the class saved in path, see load"""
+        with open(_config_path(path)) as f:
+            module, name = json.load(f)["model"].rsplit(".", 1)
+        reg = getattr(importlib.import_module(module), name)()
+        reg.load(path, best_model_path, map_location=map_location, lazy=lazy)
+        return reg
 
     def fix_tree(self, tree):
         """
         Trees in data must include in first position join type follow by predicates of childs. We check and fix this.
+        The tree is walked iteratively and the label of each node is split once.
         """
-        try:
-            if len(tree) == 1:
-                assert isinstance(tree[0], str)
-                return tree
+        preds = {}
+        stack = [(tree, False)]
+        while stack:
+            node, visited = stack.pop()
+            if len(node) == 3 and "ᶲ" not in node[0]:
+                if not visited:
+                    stack.append((node, True))
+                    stack.append((node[2], False))
+                    stack.append((node[1], False))
+                    continue
+                union = list(
+                    dict.fromkeys(preds.pop(id(node[1])) + preds.pop(id(node[2])))
+                )
+                node[0] = node[0] + "ᶲ" + "ᶲ".join(union)
+                preds[id(node)] = union if union else [""]
             else:
-                assert len(tree) == 3
-                assert isinstance(tree[0], str)
-                preds = []
-                if len(tree[0].split("ᶲ")) == 1:
-
-                    tree_left = self.fix_tree(tree[1])
-                    preds.extend(tree_left[0].split("ᶲ")[1:])
-
-                    tree_right = self.fix_tree(tree[2])
-                    preds.extend(tree_right[0].split("ᶲ")[1:])
-                    preds = list(set(preds))
-                    tree[0] = tree[0] + "ᶲ" + "ᶲ".join(preds)
-                    return tree
-                else:
-                    return tree
-
-        except Exception as ex:
-            print(tree)
-            return tree
+                # Leaves and joins already fixed, these last are not walked
+                preds[id(node)] = node[0].split("ᶲ")[1:]
+        return tree
 
     def save(self, path):
         # try to create a directory here
@@ -352,8 +568,30 @@ class BaseRegression:
             joblib.dump(self.in_channels, f)
         with open(_n_path(path), "wb") as f:
             joblib.dump(self.n, f)
+        if self.card_encoder is not None:
+            with open(_card_encoder_path(path), "wb") as f:
+                joblib.dump(self.card_encoder, f)
+        if self.aec_net is not None:
+            torch.save(self.aec_net.state_dict(), _aec_path(path))
+        with open(_config_path(path), "w") as f:
+            json.dump(
+                {
+                    "model": "{}.{}".format(type(self).__module__, type(self).__name__),
+                    "config": self.net_config(),
+                    "maxcardinality": self.maxcardinality,
+                    "io_dim": len(self.get_pred()),
+                    "query_scaler": _dump_query_scaler(self.query_scaler),
+                },
+                f,
+                indent=2,
+            )
 
     def fit_transform_tree_data(self, ds_train, ds_val, ds_test):
+        """
+        Fit the tree featurizer with the trees of the three datasets. Returns the
+        parsed trees, which can be given to fit and predict_raw_data instead of
+        the json column to avoid parsing them again.
+        """
         ds_train = self.json_loads_trees_ds(ds_train)
         ds_val = self.json_loads_trees_ds(ds_val)
         ds_test = self.json_loads_trees_ds(ds_test)
@@ -363,18 +601,278 @@ class BaseRegression:
         data.extend(ds_test)
 
         self.tree_transform.fit(data)
+        self.invalidate_caches()
+        return ds_train, ds_val, ds_test
 
     def transform_trees(self, data):
         return self.tree_transform.transform(data)
 
+    def encode_cardinalities(self, json_cardinality, fit=False):
+        """Encode a json_cardinality column as a CSR matrix over the predicate vocabulary"""
+        if fit:
+            self.card_encoder = CardinalityEncoder(self.get_pred())
+            x_card = self.card_encoder.fit_transform(json_cardinality)
+            self.maxcardinality = self.card_encoder.max_cardinality
+            return x_card
+        return self.card_encoder.transform(json_cardinality)
+
+    def query_features(self, X_query, X_card=None, fit=False):
+        """
+        Build the query level features matrix, query features followed by the
+        cardinality block. If X_card is None the cardinalities are expected as
+        json strings in the last column of X_query. The query features are
+        standardized by query_scaler if set.
+        """
+        if X_card is None:
+            X_query = np.asarray(X_query, dtype=object)
+            X_card = self.encode_cardinalities(X_query[:, -1], fit=fit)
+            X_query = X_query[:, :-1]
+        return query_card_matrix(self.scale_queries(X_query), X_card)
+
+    def scale_queries(self, X_query):
+        """Query features standardized by query_scaler, as they are without it"""
+        if self.query_scaler is None:
+            return X_query
+        return self.query_scaler.transform(X_query)
+
+    def get_dataloader(self, X, X_query, y, features=None, shuffle=True):
+        """
+        DataLoader over (tree, query) pairs. When features is given X_query holds
+        row numbers into it and batches are sliced from the matrix.
+        """
+        pairs = list(zip(list(zip(X, X_query)), y))
+        if features is None:
+            collate_fn = self.collate
+        else:
+            collate_fn = partial(self.collate_with_card, features=features)
+        sampler = None
+        if self.is_distributed():
+            if shuffle:
+                # Same number of batches in every rank, as DDP requires
+                sampler = DistributedSampler(pairs, shuffle=True)
+                shuffle = False
+            else:
+                # Evaluation, every pair once over all the ranks
+                pairs = pairs[distributed.get_rank() :: distributed.get_world_size()]
+        return DataLoader(
+            pairs,
+            batch_size=64,
+            num_workers=0,
+            shuffle=shuffle,
+            sampler=sampler,
+            collate_fn=collate_fn,
+        )
+
+    def is_distributed(self):
+        return self.distributed and distributed.is_distributed()
+
+    def is_main_process(self):
+        return not self.is_distributed() or distributed.is_main_process()
+
     def fit(self, X, X_query, y, X_val, X_val_query, y_val):
         pass
 
+    def train_loop(self, dataset, dataset_val, y_val, max_y):
+        """
+        Train self.net over the dataloaders with early stopping on the val RMSE,
+        the history and scatter plots of every epoch are kept. With a profiler
+        the stages of every epoch are timed and summarized in the log.
+        Distributed, gradients are all-reduced by DistributedDataParallel, the
+        metrics are computed on the predictions of all the ranks and rank 0
+        checks early stopping, saves the checkpoints and plots.
+        """
+        profiler = self.profiler
+        if profiler is None:
+            profiler = contextlib.nullcontext()
+        with profiler:
+            self._train_loop(dataset, dataset_val, y_val, max_y)
+        self.invalidate_caches()
+
+    def _train_loop(self, dataset, dataset_val, y_val, max_y):
+        from sklearn.metrics import mean_absolute_error, mean_squared_error
+
+        stage = profiling.stage
+        # initialize the early_stopping object
+        early_stopping = EarlyStopping(
+            initial_patience=self.early_stop_initial_patience,
+            patience=self.early_stop_patience,
+            verbose=True,
+            path=osp.join(self.output_path, "../checkpoint.pt"),
+        )
+
+        optimizer = self.make_optimizer()
+
+        loss_fn = self.make_loss()
+
+        losses = []
+
+        model = self.net
+        main_process = self.is_main_process()
+        if self.is_distributed():
+            model = DistributedDataParallel(self.net)
+
+        assert np.mean(y_val) > 5, "y_val must be in real scale"
+        print("Max epochs to run:", self.epochs)
+        for epoch in range(self.epochs):
+            if isinstance(dataset.sampler, DistributedSampler):
+                dataset.sampler.set_epoch(epoch)
+            loss_accum, results_train = self.train_epoch(
+                model, dataset, optimizer, loss_fn
+            )
+            losses.append(loss_accum)
+
+            print(
+                "{} Epoch {}, Training loss {}".format(
+                    datetime.datetime.now(), epoch, loss_accum / len(dataset)
+                )
+            )
+
+            # Prediction in subsample of train
+            torch.cuda.empty_cache()
+
+            with stage("metrics"):
+                if self.is_distributed():
+                    results_train = distributed.all_gather_list(results_train)
+                y_pred_train, y_real_train = zip(*results_train)
+                msetrain = mean_squared_error(y_real_train, y_pred_train)
+                maetrain = mean_absolute_error(y_real_train, y_pred_train)
+                rmsetrain = np.sqrt(msetrain)
+                self.history["mse_by_epoch"].append(msetrain)
+                self.history["rmse_by_epoch"].append(rmsetrain)
+                self.history["mae_by_epoch"].append(maetrain)
+
+            # Testing the model
+            with stage("validation"):
+                results_val = self.predict(dataset_val)
+            with stage("metrics"):
+                if self.is_distributed():
+                    results_val = distributed.all_gather_list(results_val)
+                y_pred_val, y_real_val = zip(*results_val)
+                mseval = mean_squared_error(y_real_val, y_pred_val)
+                maeval = mean_absolute_error(y_real_val, y_pred_val)
+                rmseval = np.sqrt(mseval)
+                self.history["mse_val_by_epoch"].append(mseval)
+                self.history["rmse_val_by_epoch"].append(rmseval)
+                self.history["mae_val_by_epoch"].append(maeval)
+            #             print(f"RMSE in TRAIN: {rmsetrain} : RMSE in VAL: {rmseval}")
+            if main_process:
+                self.logger.info(
+                    "==> Epoch {},\tTRAIN_LOSS: {}\t_TRAIN_RMSE: {},\tVAL_LOSS: {},\tVAL_RMSE: {}".format(
+                        epoch, msetrain, rmsetrain, mseval, rmseval
+                    )
+                )
+            # early_stopping needs the validation loss to check if it has decresed,
+            # and if it has, it will make a checkpoint of the current model
+            with stage("early_stopping"):
+                if main_process:
+                    best_model = early_stopping(
+                        np.average(
+                            self.history["rmse_val_by_epoch"][
+                                -self.early_stop_patience :
+                            ]
+                        ),
+                        self.net,
+                    )
+                    if best_model is not None:
+                        self.best_model = best_model
+                early_stop = early_stopping.early_stop
+                if self.is_distributed():
+                    early_stop = distributed.broadcast_object(early_stop)
+            if early_stop:
+                print("Early stopping the training.")
+                self.end_epoch_profile(epoch)
+                break
+
+            if epoch and main_process:  # % 4 == 0:
+                with stage("plot"):
+                    self.scatter_plot_history(
+                        y_pred_train,
+                        y_real_train,
+                        y_pred_val,
+                        y_real_val,
+                        "Scatter real latency vs prediction on: ",
+                        osp.join(
+                            self.output_path,
+                            "neo_with_aec_scatter_train_val_epoch_"
+                            + "{:03d}".format(epoch),
+                        ),
+                        self.history,
+                        max_reference=int(max_y + 10),
+                        figsize=self.figimage_size,
+                        title_all=f"Scatter and history, RMSE Train: {rmsetrain}, RMSE VAL: {rmseval}, Epoch: {epoch}",
+                        start_history_from_epoch=self.start_history_from_epoch,
+                    )
+            gc.collect()
+            self.end_epoch_profile(epoch)
+
+    def make_optimizer(self):
+        if self.optimizer["optimizer"] == "Adam":
+            return torch.optim.Adam(self.net.parameters(), **self.optimizer["args"])
+        elif self.optimizer["optimizer"] == "Adagrad":
+            return torch.optim.Adagrad(self.net.parameters(), **self.optimizer["args"])
+        return torch.optim.SGD(self.net.parameters(), **self.optimizer["args"])
+
+    def make_loss(self):
+        """Loss of the loss configuration, the target pipeline must be fitted"""
+        pipeline = self.pipeline
+        if isinstance(pipeline, LogMinMaxTransform):
+            scale = pipeline.scale
+        else:
+            scale = pipeline.named_steps["scale"].scale_[0]
+        return make_loss(self.loss, log_scale=1.0 / scale)
+
+    def train_epoch(self, model, dataset, optimizer, loss_fn):
+        """
+        One pass of training over dataset, model is self.net or its DDP wrapper.
+        :return: mean loss of the batches, (prediction, target) pairs in real scale.
+        """
+        stage = profiling.stage
+        self.net.train()
+        loss_accum = 0
+        results_train = []
+        for x, y_train in profiling.iterate(dataset, "data"):
+            y_train_scaled = torch.tensor(
+                self.pipeline.transform(y_train.reshape(-1, 1)).astype(np.float32)
+            )
+            if CUDA:
+                y_train_scaled = y_train_scaled.cuda()
+            with stage("forward"):
+                y_pred = model(x)
+                loss = loss_fn(y_pred, y_train_scaled)
+            with stage("backward"):
+                optimizer.zero_grad()
+                loss.backward()
+            with stage("optimizer"):
+                optimizer.step()
+                lost_item = loss.item()
+            loss_accum += lost_item
+
+            with stage("metrics"):
+                results_train.extend(
+                    list(
+                        zip(
+                            self.pipeline.inverse_transform(
+                                y_pred.cpu().detach().numpy()
+                            ),
+                            y_train,
+                        )
+                    )
+                )
+        return loss_accum / len(dataset), results_train
+
+    def end_epoch_profile(self, epoch):
+        if self.profiler is not None:
+            summary = self.profiler.end_epoch(epoch)
+            text = self.profiler.format_summary(summary)
+            if self.is_distributed():
+                text = "rank {}: {}".format(distributed.get_rank(), text)
+            self.logger.info(text)
+
     def predict(self, val_loader):
         results = []
         self.net.eval()
         with torch.no_grad():
-            for (x, y_val) in val_loader:
+            for x, y_val in val_loader:
                 y_pred = self.net(x)
                 results.extend(
                     list(
@@ -388,30 +886,50 @@ class BaseRegression:
                 )
         return results
 
-    def predict_raw_data(self, trees, queries):
+    def predict_raw_data(self, trees, queries, cards=None):
+        """
+        Predictions of the rows with valid json trees. With a prediction cache
+        only the rows missing from it are featurized and predicted.
+        """
         results = []
 
-        trees, queries, _ = self.json_loads(
-            trees, queries, [None for _ in range(len(queries))]
+        features = self.query_features(queries, cards)
+        trees, rows, _ = self.json_loads(
+            trees, np.arange(features.shape[0]), [None for _ in range(len(queries))]
         )
-        trees = [self.fix_tree(x) for x in trees]
         print("X_val loaded")
 
-        trees = self.tree_transform.transform(trees)
-        pares = list(zip(trees, queries))
+        cache = self.prediction_cache
+        if cache is not None:
+            keys = prediction_keys(trees, rows, features)
+            cached = [cache.get(key) for key in keys]
+            missing = [i for i, value in enumerate(cached) if value is None]
+            trees = [trees[i] for i in missing]
+            rows = [rows[i] for i in missing]
+
+        trees = self.tree_transform.transform_packed(trees)
+        pares = list(zip(trees, rows))
         dataloader = DataLoader(
             pares,
             batch_size=128,
             shuffle=False,
-            collate_fn=self.collate_predict_with_card,
+            collate_fn=partial(self.collate_predict_with_card, features=features),
         )
         self.net.eval()
         with torch.no_grad():
             for x in dataloader:
-                y_pred = self.net(x)
+                if self.node_memo is None:
+                    y_pred = self.net(x)
+                else:
+                    y_pred = self.node_memo.forward(self.net, x)
                 results.extend(
                     self.pipeline.inverse_transform(y_pred.cpu().detach().numpy())
                 )
+        if cache is not None:
+            for i, value in zip(missing, results):
+                cache.put(keys[i], value)
+                cached[i] = value
+            return cached
         return results
 
     def predict_best(self, val_loader):
@@ -419,7 +937,7 @@ class BaseRegression:
         results = []
         self.best_model.eval()
         with torch.no_grad():
-            for (x, y_val) in val_loader:
+            for x, y_val in val_loader:
                 y_pred = self.best_model(x)
                 results.extend(
                     list(
@@ -439,116 +957,115 @@ class BaseRegression:
     def index2sparse2(self, tree, sizeindexes):
         pass
 
-    def collate_with_card(self, x):
+    def encode_nodes(self, indices, counts, sizeindexes, trees=None):
         """
-        Preprocess inputs values, transform index2vec values,
-        them predict aec.encoder to dimensionality reduction
+        Features of the nodes given as the flat indexes of their predicates and
+        the number of indexes of every node, see node_features. trees are the
+        PackedTrees of the nodes when known.
+        """
+        rows = np.repeat(np.arange(len(counts)), counts)
+        onehot = np.zeros((len(counts), sizeindexes), dtype=np.float32)
+        np.add.at(onehot, (rows, indices), 1)
+        return self.node_features(onehot)
+
+    def node_features(self, onehot):
+        """Features of the nodes from their multi-hot encodings, one node by row"""
+        return onehot
+
+    def packed2flat(self, trees, sizeindexes):
+        """
+        Node features of a batch of PackedTree as FlatTree for prepare_trees.
+        Multi-hot encodings of all the nodes of the batch are built at once and
+        given to node_features.
+        """
+        sizes = [len(tree) for tree in trees]
+        indices = np.concatenate([tree.indices for tree in trees])
+        counts = np.concatenate([np.diff(tree.indptr) for tree in trees])
+        features = self.encode_nodes(indices, counts, sizeindexes, trees)
+
+        resp = []
+        start = 0
+        for tree, size in zip(trees, sizes):
+            # The first row is the zero vector, see TreeConvolution.util._flatten
+            flat = np.zeros((size + 1, features.shape[1]), dtype=features.dtype)
+            flat[1:] = features[start : start + size]
+            resp.append(FlatTree(flat, tree.conv_indexes))
+            start += size
+        return resp
+
+    def collate_with_card(self, x, features):
+        """
+        Preprocess inputs values, transform index2vec values and slice the query
+        features, cardinalities included, of the whole batch from features.
         """
         trees = []
+        rows = []
         targets = []
-        sizeindexes = len(self.get_pred())
-        other_pred_index = self.get_pred()["OTHER_PRED"]
         for x_features, target in x:
-            tree, query = x_features
-            b = np.zeros((sizeindexes))
-            *query_features, card_features = query
-            try:
-                if type(card_features) == str:
-                    raise Exception("you need to preprocess json_cardinality features")
-                for key in card_features.keys():
-                    if type(key) == int:
-                        b[key] = card_features[key]
-                    else:
-                        b[other_pred_index] = card_features[key]
-                        print("Predicate not found", key)
-            except Exception as ex:
-                print("Error en cardinalidades", card_features)
-            trees.append(
-                tuple(
-                    [
-                        self.index2sparse(tree, sizeindexes),
-                        np.concatenate([query[:-1], b]).tolist(),
-                    ]
-                )
-            )
+            tree, row = x_features
+            trees.append(tree)
+            rows.append(row)
             targets.append(target)
 
-        targets = torch.tensor(targets)
-        return trees, targets
+        with profiling.stage("collate"):
+            trees = self.packed2flat(trees, len(self.get_pred()))
+            queries = features[rows].toarray()
+            targets = torch.tensor(np.asarray(targets))
+        return list(zip(trees, queries)), targets
 
-    def collate_predict_with_card(self, x):
+    def collate_predict_with_card(self, x, features):
         """
-        Preprocess inputs values, transform index2vec values,
-        them predict aec.encoder to dimensionality reduction
+        Preprocess inputs values, transform index2vec values and slice the query
+        features, cardinalities included, of the whole batch from features.
         """
-        trees = []
-        sizeindexes = len(self.get_pred())
-        for x_features in x:
-            b = np.zeros((sizeindexes))
-            tree, query = x_features
-            try:
-                for key in query[-1].keys():
-                    b[key] = query[-1][key]
-            except:
-                print("Error en cardinalidades", str(query[-1]))
-            trees.append(
-                tuple(
-                    [
-                        self.index2sparse(tree, sizeindexes),
-                        np.concatenate([query[:-1], b]).tolist(),
-                    ]
-                )
-            )
-
-        return trees
+        trees, rows = zip(*x)
+        trees = self.packed2flat(trees, len(self.get_pred()))
+        queries = features[list(rows)].toarray()
+        return list(zip(trees, queries))
 
     def collate(self, x):
         """Preprocess inputs values, transform index2vec values, them predict aec.encoder to dimensionality reduction"""
         trees = []
+        queries = []
         targets = []
-        sizeindexes = len(self.get_pred())
         for tree, target in x:
-            trees.append(tuple([self.index2sparse(tree[0], sizeindexes), tree[1]]))
+            trees.append(tree[0])
+            queries.append(tree[1])
             targets.append(target)
 
-        targets = torch.tensor(targets)
-        return trees, targets
+        with profiling.stage("collate"):
+            trees = self.packed2flat(trees, len(self.get_pred()))
+            targets = torch.tensor(np.asarray(targets))
+        return list(zip(trees, queries)), targets
 
     def collate2(self, x):
         """Only collocate x_data"""
-        trees = []
-        sizeindexes = len(self.get_pred())
-        for tree in x:
-            trees.append(tuple([self.index2sparse(tree[0], sizeindexes), tree[1]]))
-        return trees
+        trees = self.packed2flat([tree[0] for tree in x], len(self.get_pred()))
+        return list(zip(trees, [tree[1] for tree in x]))
 
     def json_loads(self, X, X_query, Y):
-        """read string with json data as json object"""
-        respX = []
-        respX_query = []
-        respY = []
-        for x, y in list(zip(list(zip(X, X_query)), Y)):
-            try:
-                x_tree, x_query = x
-                x_tree = json.loads(x_tree)
-                respX.append(x_tree)
-                respX_query.append(x_query)
-                respY.append(y)
-            except:
-                print("Error in data ignored!", x)
-        return respX, respX_query, np.array(respY).reshape(-1, 1)
+        """read string with json data as json object, X can also be ParsedTrees"""
+        if not isinstance(X, ParsedTrees):
+            X = self.parse_trees(X)
+        rows = X.rows
+        respX_query = [X_query[row] for row in rows]
+        respY = [Y[row] for row in rows]
+        return list(X.trees), respX_query, np.array(respY).reshape(-1, 1)
 
     def json_loads_trees_ds(self, ds):
         """read string with json data as json object from Dataframe, ignore bad jsons trees"""
-        respX = []
-        for index in range(ds.shape[0]):
-            row = ds.iloc[index]
-            try:
-                data = json.loads(row["trees"])
-                respX.append(data)
-            except:
-                print("Error in data ignored!", row["trees"])
-        return respX
+        return self.parse_trees(ds["trees"].values)
+
+    def parse_trees(self, column):
+        parsed = parse_trees(column, backend=self.json_backend)
+        if parsed.errors:
+            logger.warning(
+                "%d of %d json trees ignored, see json_errors",
+                len(parsed.errors),
+                parsed.size,
+            )
+            self.json_errors.append(parsed.report())
+        return parsed
 
     def scatter_image(
         self, y_pred, y_test, title, name, max_reference=300, figsize=None
@@ -21,8 +21,8 @@ from featurize import SPARQLTreeFeaturizer
 from early_stopping import EarlyStopping
 from net import Autoencoder, NeoNet, BaoNet
 from sklearn.metrics import mean_squared_error, mean_absolute_error
-from custom_loss import CustomMSELoss
-from memory_profiler import profile
+from custom_loss import make_loss
+from dense_dataset import DenseDataset, dense_features
 import logging
 
 CUDA = torch.cuda.is_available()
@@ -68,7 +68,9 @@ class DenseRegression:
                  figimage_size=(10, 8),
                  activation_dense=nn.LeakyReLU,
                  preds2index={},
-                 encode_cardinalities=False
+                 encode_cardinalities=False,
+                 batch_size=256,
+                 plot_epochs=True
                  ):
 
         if query_hidden_inputs is None:
@@ -120,6 +122,10 @@ class DenseRegression:
             'mae_val_by_epoch': []
         }
         self.encode_cardinalities = encode_cardinalities
+        self.batch_size = batch_size
+        # Scatter and history plot of every epoch
+        self.plot_epochs = plot_epochs
+
     def __log(self, *args):
         if self.__verbose:
             print(*args)
@@ -232,19 +238,21 @@ class DenseRegression:
         # Fit target transformer
         self.pipeline.fit_transform(y.reshape(-1, 1))
         
-        pairs = list(zip(X_query, y))
-        pairs_val = list(zip(X_val_query, y_val))
+        num_preds = len(self.preds2index) if self.encode_cardinalities else None
+        # Out of range targets were dropped by collate, only with cardinalities
+        target_range = (0, 70) if self.encode_cardinalities else None
+        device = "cuda" if CUDA else None
+        dataset = DenseDataset.from_queries(
+            X_query, y, num_preds, target_range=target_range, device=device)
+        dataset_val = DenseDataset.from_queries(
+            X_val_query, y_val, num_preds, target_range=target_range, device=device)
+        # Targets scaled once, the real ones are recovered by inverse_transform
+        dataset = DenseDataset(
+            dataset.features,
+            self.pipeline.transform(dataset.targets.cpu().numpy()),
+            device=dataset.device)
+        self.__query_input_size = dataset.features.shape[1]
 
-        if self.encode_cardinalities:
-            dataset = DataLoader(pairs, batch_size=256, num_workers=0, shuffle=True, collate_fn=self.collate)
-            dataset_val = DataLoader(pairs_val, batch_size=256, num_workers=0, shuffle=True, collate_fn=self.collate)
-        else:
-            dataset = DataLoader(pairs, batch_size=256, num_workers=0, shuffle=True, collate_fn=self.collatenocard)
-            dataset_val = DataLoader(pairs_val, batch_size=256, num_workers=0, shuffle=True, collate_fn=self.collatenocard)
-        self.__query_input_size = len(X_query[0])
-        if self.encode_cardinalities:
-            self.__query_input_size = self.__query_input_size + len(self.preds2index) -1
-            
         self.__log("Initial input channels of query model:", self.__query_input_size)
         self.__net = DenseNet(
             self.__query_input_size,
@@ -267,10 +275,8 @@ class DenseRegression:
         else:
             optimizer = torch.optim.SGD(self.__net.parameters(), **self.__optimizer["args"])
 
-        if self.loss and self.loss['func'] == "CustomMSELoss":
-            loss_fn = CustomMSELoss(self.loss['threshold'], weight_factor=self.loss['weight_factor'])
-        else:
-            loss_fn = torch.nn.MSELoss()
+        scale = self.pipeline.named_steps["scale"].scale_[0]
+        loss_fn = make_loss(self.loss, log_scale=1.0 / scale)
         
 
 
@@ -288,40 +294,26 @@ class DenseRegression:
             self.__net.train()
             loss_accum = 0
             results_train = []
-            for (query_data, y_train) in dataset:
-                y_train_scaled = torch.tensor(self.pipeline.transform(y_train.reshape(-1, 1)).astype(np.float32))
-                query_data = torch.from_numpy(np.asarray(query_data)).to(torch.float32)
-
-
-                if CUDA:
-                    y_train_scaled = y_train_scaled.cuda()
-                    query_data = query_data.cuda()
+            for (query_data, y_train_scaled) in dataset.batches(self.batch_size, shuffle=True):
                 y_pred = self.__net(query_data)
                 loss = loss_fn(y_pred, y_train_scaled)
                 optimizer.zero_grad()
                 loss.backward()
                 optimizer.step()
-                lost_item = loss.item()
-                loss_accum += lost_item
-                #                 print('{} Epoch {}, Training loss batch {}'.format(datetime.datetime.now(), epoch, lost_item))
-                inverted = self.pipeline.inverse_transform(y_pred.cpu().detach().numpy())
-
-                results_train.extend \
-                    (list(zip(inverted, y_train)))
-            #                 y_train_scaled.detach()
-            #                 del y_train_scaled
-            #                 torch.cuda.empty_cache()
-
-            loss_accum /= len(dataset)
+                loss_accum += loss.item()
+                results_train.append((y_pred.detach(), y_train_scaled))
+
+            loss_accum /= dataset.num_batches(self.batch_size)
             losses.append(loss_accum)
 
-            print('{} Epoch {}, Training loss {}'.format(datetime.datetime.now(), epoch, loss_accum / len(dataset)))
+            print('{} Epoch {}, Training loss {}'.format(datetime.datetime.now(), epoch, loss_accum))
 
             # Prediction in subsample of train
             torch.cuda.empty_cache()
 
-            y_pred_train, y_real_train = zip(*results_train)
-            y_pred_train
+            y_pred_train, y_real_train = [
+                self.pipeline.inverse_transform(torch.cat(part).cpu().numpy())
+                for part in zip(*results_train)]
             msetrain = mean_squared_error(y_real_train, y_pred_train)
             maetrain = mean_absolute_error(y_real_train, y_pred_train)
             rmsetrain = np.sqrt(msetrain)
@@ -331,8 +323,8 @@ class DenseRegression:
 
             # Testing the model
 
-            results_val = self.predict(dataset_val)
-            y_pred_val, y_real_val = zip(*results_val)
+            y_pred_val = self.predict_dataset(dataset_val)
+            y_real_val = dataset_val.targets.cpu().numpy()
             mseval = mean_squared_error(y_real_val, y_pred_val)
             maeval = mean_absolute_error(y_real_val, y_pred_val)
             rmseval = np.sqrt(mseval)
@@ -353,7 +345,7 @@ class DenseRegression:
             # selfscatter_plot_history(y_pred, y_test, title, name, history, max_refference=300, figsize=None)
 
             #             print("ID corrida: ", id_label)
-            if epoch: # % 4 == 0:
+            if epoch and self.plot_epochs: # % 4 == 0:
                 self.scatter_plot_history(
                     y_pred_train,
                     y_real_train,
@@ -371,44 +363,43 @@ class DenseRegression:
     #         self.plot_history(history)
 
     def predict(self, val_loader):
-        results = []
-        self.__net.eval()
+        """(prediction, target) pairs of a DataLoader or a DenseDataset"""
+        return self._predict_pairs(self.__net, val_loader)
+
+    def predict_dataset(self, dataset, net=None):
+        """Predictions in real scale of the features of a DenseDataset"""
+        net = self.__net if net is None else net
+        net.eval()
+        y_pred = []
         with torch.no_grad():
-
-            for (query_data, y_val) in val_loader:
-                query_data = torch.from_numpy(np.asarray(query_data)).to(torch.float32)
-                if CUDA:
-                    query_data = query_data.cuda()
-
-                y_pred = self.__net(query_data)
-                results.extend(list(zip(self.pipeline.inverse_transform(y_pred.cpu().detach().numpy()), y_val)))
-        return results
+            for query_data, _ in dataset.batches(4096):
+                y_pred.append(net(query_data))
+        return self.pipeline.inverse_transform(torch.cat(y_pred).cpu().numpy())
 
     def predict_raw_data(self, queries):
-        results = []
-        dataloader = DataLoader(queries, batch_size=128, shuffle=False)
-        self.__net.eval()
-        with torch.no_grad():
-            for x in dataloader:
-                query_data = torch.from_numpy(np.asarray(x)).to(torch.float32)
-                if CUDA:
-                    query_data = query_data.cuda()
-
-                y_pred = self.__net(query_data)
-                results.extend(self.pipeline.inverse_transform(y_pred.cpu().detach().numpy()))
-        return results
+        """Predictions of the rows of queries, with their cardinalities if encode_cardinalities"""
+        num_preds = len(self.preds2index) if self.encode_cardinalities else None
+        dataset = DenseDataset(
+            dense_features(queries, num_preds),
+            np.zeros(len(queries)),
+            device=next(self.__net.parameters()).device)
+        return list(self.predict_dataset(dataset))
 
     def predict_best(self, val_loader):
+        return self._predict_pairs(self.__best_model, val_loader)
 
+    def _predict_pairs(self, net, val_loader):
+        if isinstance(val_loader, DenseDataset):
+            return list(zip(self.predict_dataset(val_loader, net), val_loader.targets.cpu().numpy()))
         results = []
-        self.__best_model.eval()
+        net.eval()
         with torch.no_grad():
             for (query_data, y_val) in val_loader:
-                query_data = torch.from_numpy(np.asarray(query_data)).to(torch.float32)
+                query_data = torch.as_tensor(np.asarray(query_data), dtype=torch.float32)
                 if CUDA:
                     query_data = query_data.cuda()
 
-                y_pred = self.__best_model(query_data)
+                y_pred = net(query_data)
                 results.extend(list(zip(self.pipeline.inverse_transform(y_pred.cpu().detach().numpy()), y_val)))
         return results
 
@@ -440,40 +431,13 @@ class DenseRegression:
         targets = torch.tensor(targets, dtype=torch.float32)
         return queries, targets
     def collate(self, x):
-        """Preprocess inputs values, transform index2vec values, them predict aec.encoder to dimensionality reduction"""
-        queries = []
-        targets = []
-        for query, target in x:
-            b = np.zeros((len(self.preds2index)))
-            try:
-                for key in query[-1].keys():
-                    b[key] = query[-1][key]
-            except:
-                print("Error en cardinalidades",str(query[-1]))
-            
-            if target <= 0 or target > 70:
-                print(target)
-                continue
-            queries.append(np.concatenate([query[:-1], b]).tolist())
-            
-            targets.append(target)
-
-        targets = torch.tensor(targets, dtype=torch.float32)
-        return queries, targets
+        """Queries with their cardinality block and targets, out of range targets dropped"""
+        queries, targets = zip(*x)
+        dataset = DenseDataset.from_queries(queries, targets, len(self.preds2index), target_range=(0, 70))
+        return dataset.features, dataset.targets.reshape(-1)
 
     def collate2(self, x):
-        queries = []
-
-        for query in x:
-            b = np.zeros((len(self.preds2index)))
-            try:
-                for key in query[-1].keys():
-                    b[key] = query[-1][key]
-            except:
-                print("Error en cardinalidades",str(query[-1]))
-            
-            queries.append(np.concatenate([query[:-1], b]))
-        return queries
+        return dense_features(x, len(self.preds2index))
 
 
     def scatter_image(self, y_pred, y_test, title, name, max_refference=300, figsize=None):
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+Gradient boosted trees baseline, a low latency predictor on CPU.
+
+A HistGradientBoostingRegressor over the query features (LIST_QUERY_COLUMNS),
+the cardinalities hashed in a few buckets with their count, sum and max, and
+statistics of the plan (see plan_statistics). The featurizer, the cardinality
+encoder, the target transform and the inputs of fit and predict_raw_data are
+the ones of NeoRegression, so train.py trains and evaluates it the same way.
+
+    reg = GBTRegression(max_iter=300)
+    x_train_tree, x_val_tree, _ = reg.fit_transform_tree_data(ds_train, ds_val, ds_test)
+    x_train_card = reg.encode_cardinalities(ds_train["json_cardinality"].values, fit=True)
+    reg.fit(x_train_tree, x_train_query, y_train, x_val_tree, x_val_query, y_val,
+            X_card=x_train_card, X_val_card=x_val_card)
+    reg.predict_raw_data(trees, queries, cards)
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import functools
+import json
+import os
+
+import joblib
+import numpy as np
+from scipy import sparse
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.metrics import mean_absolute_error, mean_squared_error
+
+from .model_base import (
+    BaseRegression,
+    _card_encoder_path,
+    _config_path,
+    _dump_query_scaler,
+    _load_query_scaler,
+    _n_path,
+    _x_transform_path,
+    _y_transform_path,
+)
+from artifact import LogMinMaxTransform
+from json_parser import ParsedTrees
+
+# Multiplier of the hash of the predicate indexes, see hash_cardinalities
+_HASH = 2654435761
+
+
+def _gbt_path(base):
+    return os.path.join(base, "gbt")
+
+
+def plan_statistics(trees, ignore_first=18):
+    """
+    Statistics of PackedTrees, one row by tree: nodes, leaves, depth, predicates
+    of the leaves, most predicates of a leaf, distinct predicates and the count
+    of every node type (the first ignore_first indexes: joins and TPF types).
+    Computed over the concatenated trees without a loop by node.
+    """
+    if not len(trees):
+        return np.zeros((0, 6 + ignore_first), dtype=np.float32)
+    sizes = np.fromiter(map(len, trees), dtype=np.int64, count=len(trees))
+    offsets = np.zeros(len(trees) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    tree_of = np.repeat(np.arange(len(trees)), sizes)
+    counts = np.concatenate([np.diff(tree.indptr) for tree in trees])
+    # First index of every node, its type
+    first = np.concatenate([tree.indices[tree.indptr[:-1]] for tree in trees])
+    # Node, left and right child of every node, 1 based in its tree, 0 for none
+    conv = np.concatenate([tree.conv_indexes.reshape(-1, 3) for tree in trees])
+    base = offsets[tree_of] - 1
+    leaf = conv[:, 1] == 0
+
+    # Depth by pointer jumping over the parents, the roots are their own parent
+    parent = np.arange(len(conv))
+    for side in (1, 2):
+        has_child = conv[:, side] > 0
+        parent[(conv[:, side] + base)[has_child]] = np.flatnonzero(has_child)
+    depth = (parent != np.arange(len(conv))).astype(np.int64)
+    ancestor = parent
+    while np.any(ancestor[ancestor] != ancestor):
+        depth = depth + depth[ancestor]
+        ancestor = ancestor[ancestor]
+
+    preds = counts - 1
+    types = np.zeros((len(trees), ignore_first), dtype=np.float32)
+    known = first < ignore_first
+    np.add.at(types, (tree_of[known], first[known]), 1)
+    stats = np.zeros((len(trees), 6), dtype=np.float32)
+    stats[:, 0] = sizes
+    stats[:, 1] = np.bincount(tree_of, weights=leaf, minlength=len(trees))
+    np.maximum.at(stats[:, 2], tree_of, depth)
+    stats[:, 3] = np.bincount(tree_of, weights=preds * leaf, minlength=len(trees))
+    np.maximum.at(stats[:, 4], tree_of[leaf], preds[leaf])
+    # Joins carry the union of the predicates below, so the root has them all
+    stats[:, 5] = preds[offsets[:-1]]
+    return np.hstack([stats, types])
+
+
+@functools.lru_cache(maxsize=8)
+def _buckets(num_preds, hash_dim):
+    """Bucket of every predicate index, a multiplicative hash"""
+    hashed = (np.arange(num_preds, dtype=np.uint64) * _HASH) % np.uint64(2**32)
+    return (hashed % np.uint64(hash_dim)).astype(np.int64)
+
+
+def hash_cardinalities(cards, hash_dim):
+    """
+    Cardinality block (CSR, rows x predicates) summed in hash_dim buckets by
+    predicate index, followed by the number of predicates, the sum and the max
+    of the cardinalities of every row.
+    """
+    if not sparse.isspmatrix_csr(cards):
+        cards = sparse.csr_matrix(cards)
+    n_rows = cards.shape[0]
+    counts = np.diff(cards.indptr)
+    rows = np.repeat(np.arange(n_rows), counts)
+    features = np.zeros((n_rows, hash_dim + 3), dtype=np.float32)
+    buckets = _buckets(cards.shape[1], hash_dim)[cards.indices]
+    np.add.at(features, (rows, buckets), cards.data)
+    features[:, hash_dim] = counts
+    features[:, hash_dim + 1] = np.bincount(rows, weights=cards.data, minlength=n_rows)
+    # Cardinalities are positive, rows without them keep 0
+    np.maximum.at(features[:, hash_dim + 2], rows, cards.data)
+    return features
+
+
+class FlatForest:
+    """
+    Nodes of the trees of a fitted HistGradientBoostingRegressor in flat arrays,
+    walked for all the trees and rows at once. Same predictions as its predict,
+    without the overhead of the call that dominates small batches. It reads
+    private attributes of sklearn, GBTRegression falls back to predict when
+    they change.
+    """
+
+    def __init__(self, model):
+        nodes = [predictor.nodes for (predictor,) in model._predictors]
+        if any(node["is_categorical"].any() for node in nodes):
+            raise ValueError("Categorical splits are not supported")
+        sizes = np.array([len(node) for node in nodes], dtype=np.int64)
+        self.roots = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(np.int64)
+        offsets = np.repeat(self.roots, sizes)
+        nodes = np.concatenate(nodes)
+        self.feature = nodes["feature_idx"].astype(np.int64)
+        self.threshold = nodes["num_threshold"]
+        self.missing_left = nodes["missing_go_to_left"].astype(bool)
+        self.leaf = nodes["is_leaf"].astype(bool)
+        self.value = nodes["value"]
+        # Child of node i is childs[2 * i + goes_left]
+        self.childs = np.stack(
+            [nodes["right"] + offsets, nodes["left"] + offsets], axis=1
+        ).reshape(-1)
+        self.baseline = float(np.asarray(model._baseline_prediction).reshape(-1)[0])
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        n_rows, n_features = X.shape
+        flat = X.reshape(-1)
+        # Node of every (row, tree), only the ones out of a leaf are walked
+        node = np.tile(self.roots, n_rows)
+        start = np.repeat(np.arange(n_rows) * n_features, len(self.roots))
+        walking = np.flatnonzero(~self.leaf[node])
+        current = node[walking]
+        while len(walking):
+            x = flat[start[walking] + self.feature[current]]
+            goes_left = np.where(
+                np.isnan(x), self.missing_left[current], x <= self.threshold[current]
+            )
+            current = self.childs[2 * current + goes_left]
+            node[walking] = current
+            inner = ~self.leaf[current]
+            walking, current = walking[inner], current[inner]
+        return self.value[node].reshape(n_rows, -1).sum(axis=1) + self.baseline
+
+
+class GBTRegression(BaseRegression):
+    def __init__(
+        self,
+        max_iter=500,
+        learning_rate=0.1,
+        max_leaf_nodes=31,
+        l2_regularization=0.0,
+        eval_every=10,
+        hash_dim=64,
+        random_state=0,
+        flat_rows=64,
+        **kvargs
+    ):
+        """
+        :param max_iter: most boosting iterations.
+        :param eval_every: boosting iterations between evaluations on the
+        validation set, early_stop_patience evaluations without improvement
+        stop the training and the best model is kept.
+        :param hash_dim: buckets of the hashed cardinalities.
+        :param flat_rows: batches up to flat_rows rows are predicted by a
+        FlatForest, bigger ones by the sklearn predict.
+        """
+        super().__init__(**kvargs)
+        self.max_iter = max_iter
+        self.learning_rate = learning_rate
+        self.max_leaf_nodes = max_leaf_nodes
+        self.l2_regularization = l2_regularization
+        self.eval_every = eval_every
+        self.hash_dim = hash_dim
+        self.random_state = random_state
+        self.flat_rows = flat_rows
+        self.model = None
+        self.forest = None
+        self.target_transform = None
+
+    def net_config(self):
+        """Hyperparameters of the regressor, json serializable"""
+        return {
+            "max_iter": self.max_iter,
+            "learning_rate": self.learning_rate,
+            "max_leaf_nodes": self.max_leaf_nodes,
+            "l2_regularization": self.l2_regularization,
+            "eval_every": self.eval_every,
+            "hash_dim": self.hash_dim,
+            "random_state": self.random_state,
+            "flat_rows": self.flat_rows,
+            "ignore_first_aec_data": self.ignore_first_aec_data,
+        }
+
+    def configure(self, config):
+        for name, value in config.items():
+            setattr(self, name, value)
+
+    def features(self, trees, X_query, X_card=None, fit=False):
+        """
+        Features of the rows with valid json trees, and those rows. trees can be
+        a json column or ParsedTrees. If X_card is None the cardinalities are
+        json strings in the last column of X_query. The query features are
+        standardized by query_scaler if set.
+        """
+        if X_card is None:
+            X_query = np.asarray(X_query, dtype=object)
+            X_card = self.encode_cardinalities(X_query[:, -1], fit=fit)
+            X_query = X_query[:, :-1]
+        if not isinstance(trees, ParsedTrees):
+            trees = self.parse_trees(trees)
+        rows = np.asarray(trees.rows, dtype=np.int64)
+        packed = self.tree_transform.transform_packed(trees.trees)
+        return (
+            np.hstack(
+                [
+                    np.asarray(self.scale_queries(X_query), dtype=np.float32)[rows],
+                    hash_cardinalities(X_card, self.hash_dim)[rows],
+                    plan_statistics(packed, self.ignore_first_aec_data),
+                ]
+            ),
+            rows,
+        )
+
+    def fit(
+        self, X, X_query, y, X_val, X_val_query, y_val, X_card=None, X_val_card=None
+    ):
+        y = np.asarray(y, dtype=np.float64).reshape(-1)
+        y_val = np.asarray(y_val, dtype=np.float64).reshape(-1)
+        features, rows = self.features(X, X_query, X_card, fit=X_card is None)
+        features_val, rows_val = self.features(X_val, X_val_query, X_val_card)
+        y, y_val = y[rows], y_val[rows_val]
+        self.n = len(features)
+        self.query_input_size = features.shape[1]
+        self.log("Features of the gradient boosted trees:", self.query_input_size)
+
+        self.pipeline.fit(y.reshape(-1, 1))
+        y_scaled = self.pipeline.transform(y.reshape(-1, 1)).reshape(-1)
+
+        model = HistGradientBoostingRegressor(
+            max_iter=0,
+            learning_rate=self.learning_rate,
+            max_leaf_nodes=self.max_leaf_nodes,
+            l2_regularization=self.l2_regularization,
+            early_stopping=False,
+            warm_start=True,
+            random_state=self.random_state,
+        )
+        # As train_loop, an evaluation every eval_every iterations is an epoch
+        best_rmse = np.inf
+        best_model = None
+        patience = self.early_stop_patience
+        for epoch, max_iter in enumerate(
+            range(self.eval_every, self.max_iter + self.eval_every, self.eval_every)
+        ):
+            model.max_iter = min(max_iter, self.max_iter)
+            model.fit(features, y_scaled)
+            pred = self._inverse(model.predict(features), self.pipeline)
+            pred_val = self._inverse(model.predict(features_val), self.pipeline)
+            rmse = np.sqrt(mean_squared_error(y, pred))
+            rmse_val = np.sqrt(mean_squared_error(y_val, pred_val))
+            self.history["mse_by_epoch"].append(rmse**2)
+            self.history["rmse_by_epoch"].append(rmse)
+            self.history["mae_by_epoch"].append(mean_absolute_error(y, pred))
+            self.history["mse_val_by_epoch"].append(rmse_val**2)
+            self.history["rmse_val_by_epoch"].append(rmse_val)
+            self.history["mae_val_by_epoch"].append(
+                mean_absolute_error(y_val, pred_val)
+            )
+            self.logger.info(
+                "==> Iterations {}, \tTRAIN_RMSE: {}, \tVAL_RMSE: {}".format(
+                    model.n_iter_, rmse, rmse_val
+                )
+            )
+            if rmse_val < best_rmse:
+                best_rmse, best_model = rmse_val, copy.deepcopy(model)
+                patience = self.early_stop_patience
+            else:
+                patience -= 1
+                if patience <= 0:
+                    print("Early stopping the training.")
+                    break
+        self.best_model = best_model
+        self.set_model(best_model)
+
+    def set_model(self, model):
+        """Predict with a fitted HistGradientBoostingRegressor, see FlatForest"""
+        self.model = model
+        try:
+            self.forest = FlatForest(model)
+        except (AttributeError, KeyError, TypeError, ValueError) as ex:
+            print("WARNING: predicting with the sklearn predict, {!r}".format(ex))
+            self.forest = None
+        # The sklearn pipeline costs more than the trees on small batches
+        self.target_transform = self.pipeline
+        if not isinstance(self.pipeline, LogMinMaxTransform):
+            self.target_transform = LogMinMaxTransform.from_pipeline(self.pipeline)
+        self.invalidate_caches()
+
+    def _inverse(self, y_scaled, pipeline=None):
+        pipeline = self.target_transform if pipeline is None else pipeline
+        return pipeline.inverse_transform(y_scaled.reshape(-1, 1)).reshape(-1)
+
+    def predict_raw_data(self, trees, queries, cards=None):
+        """Predictions of the rows with valid json trees"""
+        features, _ = self.features(trees, queries, cards)
+        if not len(features):
+            return []
+        if self.forest is not None and len(features) <= self.flat_rows:
+            return list(self._inverse(self.forest.predict(features)))
+        return list(self._inverse(self.model.predict(features)))
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        with open(_gbt_path(path), "wb") as f:
+            joblib.dump(self.model, f)
+        with open(_y_transform_path(path), "wb") as f:
+            joblib.dump(self.pipeline, f)
+        with open(_x_transform_path(path), "wb") as f:
+            joblib.dump(self.tree_transform, f)
+        with open(_n_path(path), "wb") as f:
+            joblib.dump(self.n, f)
+        if self.card_encoder is not None:
+            with open(_card_encoder_path(path), "wb") as f:
+                joblib.dump(self.card_encoder, f)
+        with open(_config_path(path), "w") as f:
+            json.dump(
+                {
+                    "model": "{}.{}".format(type(self).__module__, type(self).__name__),
+                    "config": self.net_config(),
+                    "maxcardinality": self.maxcardinality,
+                    "io_dim": len(self.get_pred()),
+                    "query_scaler": _dump_query_scaler(self.query_scaler),
+                },
+                f,
+                indent=2,
+            )
+
+    def load(self, path, best_model_path=None, map_location=None, lazy=False):
+        """Load a model saved by save, the arguments of the nets are ignored"""
+        with open(_config_path(path)) as f:
+            saved = json.load(f)
+        self.configure(saved["config"])
+        self.maxcardinality = saved["maxcardinality"]
+        self.query_scaler = _load_query_scaler(saved)
+        with open(_gbt_path(path), "rb") as f:
+            model = joblib.load(f)
+        with open(_y_transform_path(path), "rb") as f:
+            self.pipeline = joblib.load(f)
+        with open(_x_transform_path(path), "rb") as f:
+            self.tree_transform = joblib.load(f)
+        with open(_n_path(path), "rb") as f:
+            self.n = joblib.load(f)
+        if os.path.exists(_card_encoder_path(path)):
+            with open(_card_encoder_path(path), "rb") as f:
+                self.card_encoder = joblib.load(f)
+        self.set_model(model)
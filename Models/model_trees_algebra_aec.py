@@ -3,18 +3,12 @@ from __future__ import division
 from __future__ import print_function
 import logging
 
-import gc
 import numpy as np
 import torch
-import torch.optim
-import datetime
-from torch.utils.data import DataLoader
 import matplotlib.pyplot as plt
 from torch import from_numpy, float32
 
 from .model_autoencoder import AECTraining
-import os.path as osp
-
 from .model_base import BaseRegression
 
 logger = logging.getLogger(__name__)
@@ -34,9 +28,10 @@ logger.addHandler(ch)
 
 plt.rcParams.update({"figure.max_open_warning": 0})
 
-from early_stopping import EarlyStopping
-from net import NeoNet, Autoencoder
-from sklearn.metrics import mean_squared_error, mean_absolute_error
+import distributed
+from embedding_table import NodeEmbeddingTable
+from featurize import map_tree
+from net import EmbeddingBagEncoder, NeoNet, autoencoder_for_state
 
 CUDA = torch.cuda.is_available()
 
@@ -49,6 +44,7 @@ print(f"IS CUDA AVAILABLE: {CUDA}")
 class NeoRegression(BaseRegression):
     def __init__(self, aec=None, **kvargs):
         super().__init__(**kvargs)
+        self.logger = logger
         if aec is None:
             aec = {"train_aec": False, "aec_file": None, "aec_epochs": 200}
         if aec["train_aec"]:
@@ -71,25 +67,41 @@ class NeoRegression(BaseRegression):
         self.train_aec = aec["train_aec"]
         self.aec_file = aec["aec_file"]
         self.aec_epochs = aec["aec_epochs"]
+        # Train a SparseAutoencoder, see AECTraining
+        self.aec_sparse = aec.get("aec_sparse", False)
+        # Encode the distinct nodes once after training the autoencoder, see
+        # embedding_table, in memory or mapped from aec_table_path
+        self.aec_table = aec.get("aec_table", True)
+        self.aec_table_path = aec.get("aec_table_path")
+        self.embedding_table = None
 
     def load_aec(self):
         self.log("Loading pretrained Autoencoder", "...")
-        self.aec_net = Autoencoder(self.in_channels)
-        self.aec_net.load_state_dict(torch.load(self.aec_file))
+        state = torch.load(self.aec_file)
+        self.aec_net = autoencoder_for_state(state, self.in_channels)
+        self.aec_net.load_state_dict(state)
         self.aec_net.cuda()
         self.aec_net.eval()
         return self.aec_net
 
-    def fit(self, X, X_query, y, X_val, X_val_query, y_val):
+    def fit(
+        self, X, X_query, y, X_val, X_val_query, y_val, X_card=None, X_val_card=None
+    ):
         if isinstance(y, list):
             y = np.array(y)
 
+        features = features_val = None
+        if self.maxcardinality != 0:
+            # Query features are served by row number from the features matrices
+            features = self.query_features(X_query, X_card, fit=X_card is None)
+            features_val = self.query_features(X_val_query, X_val_card)
+            X_query = np.arange(features.shape[0])
+            X_val_query = np.arange(features_val.shape[0])
+
         X, X_query, y = self.json_loads(X, X_query, y)
-        X = [self.fix_tree(x) for x in X]
         print("X_train loaded")
 
         X_val, X_val_query, y_val = self.json_loads(X_val, X_val_query, y_val)
-        X_val = [self.fix_tree(x) for x in X_val]
         print("X_val loaded")
 
         self.n = len(X)
@@ -99,15 +111,15 @@ class NeoRegression(BaseRegression):
         self.pipeline.fit_transform(y.reshape(-1, 1))
 
         print("Transforming Trees")
-        X = self.tree_transform.transform(X)
-        X_val = self.tree_transform.transform(X_val)
+        X = self.tree_transform.transform_packed(X)
+        X_val = self.tree_transform.transform_packed(X_val)
 
         # determine the initial number of channels
         io_dim = len(self.get_pred()) - self.ignore_first_aec_data
-        io_dim_model_data = len(self.get_pred())
 
         print("AEC data", self.train_aec)
-        if self.train_aec:
+        # Distributed, rank 0 trains the autoencoder and the rest load it
+        if self.train_aec and self.is_main_process():
             print(
                 "Initial input channels of tree for input autoencoder:",
                 self.in_channels,
@@ -129,58 +141,60 @@ class NeoRegression(BaseRegression):
                 transform=self.tree_transform.get_one_hot_from_tuple,
                 epochs=self.aec_epochs,
                 output_path=self.output_path,
+                sparse=self.aec_sparse,
             )
             self.aec_net = aec_training.fit(self.aec_file)
-        else:
+        if self.train_aec and self.is_distributed():
+            distributed.barrier()
+        if not self.train_aec or not self.is_main_process():
             print("Loading pretrained Autoencoder", "...")
-            self.aec_net = Autoencoder(io_dim)
-            self.aec_net.load_state_dict(torch.load(self.aec_file))
+            state = torch.load(self.aec_file, map_location="cpu")
+            self.aec_net = autoencoder_for_state(state, io_dim)
+            self.aec_net.load_state_dict(state)
             if CUDA:
                 self.aec_net = self.aec_net.cuda()
             self.aec_net.eval()
 
-        pairs = list(zip(list(zip(X, X_query)), y))
-        pairs_val = list(zip(list(zip(X_val, X_val_query)), y_val))
-
-        if self.maxcardinality == 0:
-            # Case for no cardinalities encoded data
-            dataset = DataLoader(
-                pairs,
-                batch_size=64,
-                num_workers=0,
-                shuffle=True,
-                collate_fn=self.collate,
-            )
-            dataset_val = DataLoader(
-                pairs_val,
-                batch_size=64,
-                num_workers=0,
-                shuffle=True,
-                collate_fn=self.collate,
-            )
-        else:
-            dataset = DataLoader(
-                pairs,
-                batch_size=64,
-                num_workers=0,
-                shuffle=True,
-                collate_fn=self.collate_with_card,
-            )
-            dataset_val = DataLoader(
-                pairs_val,
-                batch_size=64,
-                num_workers=0,
-                shuffle=True,
-                collate_fn=self.collate_with_card,
+        if self.aec_table:
+            # The encoder is frozen, the nodes of the epochs are read from the table
+            table = NodeEmbeddingTable.build(
+                X + X_val,
+                self.aec_net.encoder,
+                self.ignore_first_aec_data,
+                path=self.aec_table_path,
             )
+            self.log("AEC embedding table, distinct nodes:", len(table))
+            self.set_embedding_table(table)
 
-        self.query_input_size = len(X_query[0])
-        if self.maxcardinality != 0:
-            # Case when cardinalities are added. We need to extend queries features to queries features+ len(pred2index) - 1
-            self.query_input_size = self.query_input_size + io_dim_model_data - 1
+        dataset = self.get_dataloader(X, X_query, y, features)
+        dataset_val = self.get_dataloader(
+            X_val, X_val_query, y_val, features_val, shuffle=False
+        )
+
+        if features is None:
+            self.query_input_size = len(X_query[0])
+        else:
+            # Case when cardinalities are added, queries features + len(pred2index)
+            self.query_input_size = features.shape[1]
 
         self.log("Initial input channels of tree model:", io_dim)
-        self.net = NeoNet(
+        self.net = self.build_net(io_dim)
+
+        self.train_loop(dataset, dataset_val, y_val, max_y)
+
+    def set_embedding_table(self, table):
+        """Read node embeddings from a NodeEmbeddingTable, None to encode them"""
+        self.embedding_table = table
+        self.invalidate_caches()
+
+    def load(self, path, best_model_path=None, map_location=None, lazy=False):
+        # The table was built with the previous autoencoder
+        self.embedding_table = None
+        super().load(path, best_model_path, map_location=map_location, lazy=lazy)
+
+    def build_net(self, io_dim):
+        """NeoNet over the nodes encoded by the autoencoder, io_dim is its input size"""
+        net = NeoNet(
             self.in_channels_neo_net
             + self.ignore_first_aec_data,  # Dimension of Autoencoder for Preds + other tree features like predicate type
             self.query_input_size,
@@ -193,183 +207,64 @@ class NeoRegression(BaseRegression):
             in_cuda=CUDA,
         )
         if CUDA:
-            self.net = self.net.cuda()
-
-        # initialize the early_stopping object
-        early_stopping = EarlyStopping(
-            initial_patience=self.early_stop_initial_patience,
-            patience=self.early_stop_patience,
-            verbose=True,
-            path=osp.join(self.output_path, "../checkpoint.pt"),
+            net = net.cuda()
+        return net
+
+    def encode_nodes(self, indices, counts, sizeindexes, trees=None):
+        """
+        Predicates are read from the embedding table when set, and encoded from
+        their indexes with an EmbeddingBagEncoder.
+        """
+        table = self.embedding_table
+        sparse = isinstance(self.aec_net.encoder, EmbeddingBagEncoder)
+        if not sparse and (table is None or trees is None):
+            return super().encode_nodes(indices, counts, sizeindexes, trees)
+        rows = np.repeat(np.arange(len(counts)), counts)
+        first = indices < self.ignore_first_aec_data
+        types = np.zeros((len(counts), self.ignore_first_aec_data), dtype=np.float32)
+        np.add.at(types, (rows[first], indices[first]), 1)
+        if table is not None and trees is not None:
+            pred = table.lookup(trees, self.aec_net.encoder)
+            return np.concatenate((types, pred), axis=1)
+
+        # Flat indexes of the predicates of every node, in rows order
+        preds = from_numpy(indices[~first] - self.ignore_first_aec_data)
+        offsets = np.zeros(len(counts), dtype=np.int64)
+        np.cumsum(
+            np.bincount(rows[~first], minlength=len(counts))[:-1], out=offsets[1:]
         )
-
-        if self.optimizer["optimizer"] == "Adam":
-            optimizer = torch.optim.Adam(
-                self.net.parameters(), **self.optimizer["args"]
+        device = next(self.aec_net.parameters()).device
+        with torch.no_grad():
+            pred = self.aec_net.encoder(
+                preds.to(device), from_numpy(offsets).to(device)
             )
-        elif self.optimizer["optimizer"] == "Adagrad":
-            optimizer = torch.optim.Adagrad(
-                self.net.parameters(), **self.optimizer["args"]
-            )
-        else:
-            optimizer = torch.optim.SGD(self.net.parameters(), **self.optimizer["args"])
+        return np.concatenate((types, pred.cpu().numpy()), axis=1)
 
-        loss_fn = torch.nn.MSELoss()
+    def node_features(self, onehot):
+        # Split in 9 because it are de init index for predicates, @see SparqlTreeBuilder.get_index_seq
+        onehot2pred = from_numpy(
+            np.ascontiguousarray(onehot[:, self.ignore_first_aec_data :])
+        ).to(float32)
 
-        losses = []
-
-        assert np.mean(y_val) > 5, "y_val must be in real scale"
-        print("Max epochs to run:", self.epochs)
-        for epoch in range(self.epochs):
-            self.net.train()
-            loss_accum = 0
-            results_train = []
-            for (x, y_train) in dataset:
-                y_train_scaled = torch.tensor(
-                    self.pipeline.transform(y_train.reshape(-1, 1)).astype(np.float32)
-                )
-                if CUDA:
-                    y_train_scaled = y_train_scaled.cuda()
-                y_pred = self.net(x)
-                loss = loss_fn(y_pred, y_train_scaled)
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-                lost_item = loss.item()
-                loss_accum += lost_item
-
-                results_train.extend(
-                    list(
-                        zip(
-                            self.pipeline.inverse_transform(
-                                y_pred.cpu().detach().numpy()
-                            ),
-                            y_train,
-                        )
-                    )
-                )
-
-            loss_accum /= len(dataset)
-            losses.append(loss_accum)
-
-            print(
-                "{} Epoch {}, Training loss {}".format(
-                    datetime.datetime.now(), epoch, loss_accum / len(dataset)
-                )
-            )
-
-            # Prediction in subsample of train
-            torch.cuda.empty_cache()
-
-            y_pred_train, y_real_train = zip(*results_train)
-            msetrain = mean_squared_error(y_real_train, y_pred_train)
-            maetrain = mean_absolute_error(y_real_train, y_pred_train)
-            rmsetrain = np.sqrt(msetrain)
-            self.history["mse_by_epoch"].append(msetrain)
-            self.history["rmse_by_epoch"].append(rmsetrain)
-            self.history["mae_by_epoch"].append(maetrain)
-
-            # Testing the model
-
-            results_val = self.predict(dataset_val)
-            y_pred_val, y_real_val = zip(*results_val)
-            mseval = mean_squared_error(y_real_val, y_pred_val)
-            maeval = mean_absolute_error(y_real_val, y_pred_val)
-            rmseval = np.sqrt(mseval)
-            self.history["mse_val_by_epoch"].append(mseval)
-            self.history["rmse_val_by_epoch"].append(rmseval)
-            self.history["mae_val_by_epoch"].append(maeval)
-            #             print(f"RMSE in TRAIN: {rmsetrain} : RMSE in VAL: {rmseval}")
-            logger.info(
-                "==> Epoch {},\tTRAIN_LOSS: {}\t_TRAIN_RMSE: {},\tVAL_LOSS: {},\tVAL_RMSE: {}".format(
-                    epoch, msetrain, rmsetrain, mseval, rmseval
-                )
-            )
-            # early_stopping needs the validation loss to check if it has decresed,
-            # and if it has, it will make a checkpoint of the current model
-            best_model = early_stopping(
-                np.average(
-                    self.history["rmse_val_by_epoch"][-self.early_stop_patience :]
-                ),
-                self.net,
-            )
-            if best_model is not None:
-                self.best_model = best_model
-            if early_stopping.early_stop:
-                print("Early stopping the training.")
-                break
-
-            if epoch:  # % 4 == 0:
-                self.scatter_plot_history(
-                    y_pred_train,
-                    y_real_train,
-                    y_pred_val,
-                    y_real_val,
-                    "Scatter real latency vs prediction on: ",
-                    osp.join(
-                        self.output_path,
-                        "neo_with_aec_scatter_train_val_epoch_"
-                        + "{:03d}".format(epoch),
-                    ),
-                    self.history,
-                    max_reference=int(max_y + 10),
-                    figsize=self.figimage_size,
-                    title_all=f"Scatter and history, RMSE Train: {rmsetrain}, RMSE VAL: {rmseval}, Epoch: {epoch}",
-                    start_history_from_epoch=self.start_history_from_epoch,
-                )
-            gc.collect()
+        # On the device of the autoencoder, the cpu when loaded with map_location="cpu"
+        onehot2pred = onehot2pred.to(next(self.aec_net.parameters()).device)
+        with torch.no_grad():
+            pred = self.aec_net.encoder(onehot2pred).cpu().numpy()
+        return np.concatenate((onehot[:, : self.ignore_first_aec_data], pred), axis=1)
 
     def index2sparse(self, tree, sizeindexes):
-        resp = []
-        for el in tree:
-            if type(el[0]) == tuple:
-                resp.append(self.index2sparse(el, sizeindexes))
-            else:
-                a = np.array(el)
-                b = np.zeros((a.size, sizeindexes))
-                b[np.arange(a.size), a] = 1
-                onehot = np.sum(b, axis=0, keepdims=True)[0]
-                # Split in 9 because it are de init index for predicates, @see SparqlTreeBuilder.get_index_seq
-                #                 onehot2pred = from_numpy(onehot[self.ignore_first_aec_data:]).to(float32)
-                onehot2pred = from_numpy(onehot[self.ignore_first_aec_data :]).to(
-                    float32
-                )
+        """Nodes of the tree are encoded with one call of aec_net.encoder"""
 
-                # Avoid errors on not Cuda environments.
-                if CUDA:
-                    onehot2pred = onehot2pred.cuda()
-                    pred = self.aec_net.encoder(onehot2pred).cpu().detach().numpy()
-                else:
-                    pred = self.aec_net.encoder(onehot2pred).detach().numpy()
-                resp.append(
-                    np.concatenate((onehot[: self.ignore_first_aec_data], pred))
-                )
-        return tuple(resp)
+        def is_subtree(el):
+            return type(el[0]) == tuple
 
-    def index2sparse2(self, tree, sizeindexes):
-        resp = []
-        for el in tree:
-            if type(el[0]) == tuple:
-                resp.append(self.index2sparse2(el, sizeindexes))
-            else:
-                a = np.array(el)
-                b = np.zeros((a.size, sizeindexes))
-                b[np.arange(a.size), a] = 1
-                onehot = np.sum(b, axis=0, keepdims=True)[0]
-                # Split in 9 because it are de init index for predicates, @see SparqlTreeBuilder.get_index_seq
-                onehot2pred = from_numpy(onehot[self.ignore_first_aec_data :]).to(
-                    float32
-                )
+        nodes = []
+        map_tree(tree, is_subtree, nodes.append)
+        onehot = np.zeros((len(nodes), sizeindexes))
+        for i, el in enumerate(nodes):
+            onehot[i] = np.bincount(el, minlength=sizeindexes)
+        features = iter(self.node_features(onehot))
+        return map_tree(tree, is_subtree, lambda el: next(features))
 
-                # Avoid errors on not Cuda environments.
-                if CUDA:
-                    onehot2pred = onehot2pred.cuda()
-                if CUDA:
-                    pred = self.aec_net.encoder(onehot2pred).cpu().detach().numpy()
-                else:
-                    pred = self.aec_net.encoder(onehot2pred).detach().numpy()
-                resp.append(
-                    np.concatenate((onehot[: self.ignore_first_aec_data], pred))
-                )
-        #                 resp.append(onehot)
-        return tuple(resp)
+    def index2sparse2(self, tree, sizeindexes):
+        return self.index2sparse(tree, sizeindexes)
@@ -138,15 +138,7 @@ x_train_query =pd.concat([ pd.DataFrame(x_train_scaled, index=xqtrain.index, col
 x_val_query = pd.concat([pd.DataFrame(x_val_scaled, index=xqval.index, columns=xqval.columns),x_val_query[['json_cardinality']]], axis=1)
 x_test_query = pd.concat([pd.DataFrame(x_test_scaled, index=xqtest.index, columns=xqtest.columns),x_test_query[['json_cardinality']]], axis=1)
 
-def pred2index_dict(x, pred_to_index):
-    resp = {}
-    x = json.loads(x)
-    for el in x.keys():
-        if el in pred_to_index:
-            resp[pred_to_index[el]] = float(x[el])/maximotrain
-    return resp
-x_train_query['json_cardinality'] = x_train_query['json_cardinality'].apply(lambda x: pred2index_dict(x, reg.get_pred()))
-
+# json_cardinality is left as json, reg.fit encodes it over reg.get_pred() normalized by the train max
 del xqtrain
 del xqval
 del xqtest
@@ -1,6 +1,7 @@
 import unittest
 import numpy as np
-from util import prepare_trees, TreeConvolutionError
+import torch
+from util import _pad_and_combine, prepare_trees, TreeConvolutionError, FlatTree
 
 
 class TestUtils(unittest.TestCase):
@@ -76,6 +77,87 @@ class TestUtils(unittest.TestCase):
         with self.assertRaises(TreeConvolutionError):
             prepare_trees(trees, transformer, left_child, right_child)
 
+    def test_deep_tree(self):
+        # left deep tree deeper than the recursion limit
+        depth = 5000
+        tree = ((0, 1),)
+        for i in range(depth):
+            tree = ((i, 1), tree, ((1, 0),))
+
+        def left_child(x):
+            return None if len(x) == 1 else x[1]
+
+        def right_child(x):
+            return None if len(x) == 1 else x[2]
+
+        def transformer(x):
+            return np.array(x[0])
+
+        flat, indexes = prepare_trees([tree], transformer, left_child, right_child)
+        self.assertEqual(tuple(flat.shape), (1, 2, 2 * depth + 2))
+        self.assertEqual(tuple(indexes.shape), (1, 3 * (2 * depth + 1), 1))
+        # root is the first node, its left child the second one
+        self.assertEqual(indexes[0, :3, 0].tolist(), [1, 2, 2 * depth + 1])
+
+    def test_pad_and_combine(self):
+        x = [np.ones((2, 3)), np.full((4, 3), 2.0), np.full((1, 3), 3.0)]
+        combined = _pad_and_combine(x)
+        self.assertEqual(combined.dtype, np.float32)
+        self.assertEqual(combined.shape, (3, 4, 3))
+        self.assertTrue(np.array_equal(combined[0, 2:], np.zeros((2, 3))))
+        self.assertTrue(np.array_equal(combined[1], x[1]))
+        self.assertEqual(combined[2].sum(), 9)
+
+        # written in place in a larger buffer
+        out = np.zeros((4, 5, 3), dtype=np.float16)
+        combined = _pad_and_combine(x, out=out)
+        self.assertTrue(np.shares_memory(combined, out))
+        self.assertEqual(combined.shape, (3, 4, 3))
+        self.assertEqual(out[1].sum(), 24)
+
+    def test_dtype(self):
+        tree = ((16, 3), ((0, 1),), ((2, 9),))
+
+        def left_child(x):
+            return None if len(x) == 1 else x[1]
+
+        def right_child(x):
+            return None if len(x) == 1 else x[2]
+
+        def transformer(x):
+            return np.array(x[0])
+
+        flat, indexes = prepare_trees([tree], transformer, left_child, right_child)
+        self.assertEqual(flat.dtype, torch.float32)
+        self.assertEqual(indexes.dtype, torch.int64)
+        half, half_indexes = prepare_trees(
+            [tree], transformer, left_child, right_child, dtype=torch.float16
+        )
+        self.assertEqual(half.dtype, torch.float16)
+        self.assertTrue(torch.equal(half.float(), flat))
+        self.assertTrue(torch.equal(half_indexes, indexes))
+
+    def test_flat_tree(self):
+        tree = ((16, 3), ((0, 1),), ((2, 9),))
+
+        def left_child(x):
+            return None if len(x) == 1 else x[1]
+
+        def right_child(x):
+            return None if len(x) == 1 else x[2]
+
+        def transformer(x):
+            return np.array(x[0])
+
+        expected = prepare_trees([tree], transformer, left_child, right_child)
+        features = np.array([[0, 0], [16, 3], [0, 1], [2, 9]], dtype=np.float32)
+        indexes = np.array([[1], [2], [3], [2], [0], [0], [3], [0], [0]])
+        flat = prepare_trees(
+            [FlatTree(features, indexes)], transformer, left_child, right_child
+        )
+        self.assertTrue(np.array_equal(flat[0].numpy(), expected[0].numpy()))
+        self.assertTrue(np.array_equal(flat[1].numpy(), expected[1].numpy()))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -18,13 +18,25 @@ def _is_leaf(x, left_child, right_child):
     return not has_left
 
 
-def _flatten(root, transformer, left_child, right_child):
-    """ turns a tree into a flattened vector, preorder """
+class FlatTree:
+    """
+    A tree already flattened: features of the nodes in preorder after a zero
+    vector, as `_flatten`, and the indexes of `_tree_conv_indexes`.
+    prepare_trees takes them as they are.
+    """
 
-    if not callable(transformer):
-        raise TreeConvolutionError(
-            "Transformer must be a function mapping a tree node to a vector"
-        )
+    __slots__ = ("features", "indexes")
+
+    def __init__(self, features, indexes):
+        self.features = features
+        self.indexes = indexes
+
+
+def _preorder(root, left_child, right_child):
+    """
+    Iterative preorder walk. Returns the nodes in preorder and, for each one,
+    the preorder positions of its (left, right) childs or None for leaves.
+    """
 
     if not callable(left_child) or not callable(right_child):
         raise TreeConvolutionError(
@@ -32,18 +44,33 @@ def _flatten(root, transformer, left_child, right_child):
             + "tree node to its child, or None"
         )
 
-    accum = []
+    nodes = []
+    childs = []
+    stack = [(root, -1, 0)]
+    while stack:
+        x, parent, side = stack.pop()
+        pos = len(nodes)
+        nodes.append(x)
+        childs.append(None)
+        if parent >= 0:
+            childs[parent][side] = pos
+        if not _is_leaf(x, left_child, right_child):
+            childs[pos] = [0, 0]
+            stack.append((right_child(x), pos, 1))
+            stack.append((left_child(x), pos, 0))
+    return nodes, childs
 
-    def recurse(x):
-        if _is_leaf(x, left_child, right_child):
-            accum.append(transformer(x))
-            return
 
-        accum.append(transformer(x))
-        recurse(left_child(x))
-        recurse(right_child(x))
+def _flatten(root, transformer, left_child, right_child):
+    """ turns a tree into a flattened vector, preorder """
+
+    if not callable(transformer):
+        raise TreeConvolutionError(
+            "Transformer must be a function mapping a tree node to a vector"
+        )
 
-    recurse(root)
+    nodes, _ = _preorder(root, left_child, right_child)
+    accum = [transformer(x) for x in nodes]
 
     try:
         accum = [np.zeros(accum[0].shape)] + accum
@@ -52,37 +79,31 @@ def _flatten(root, transformer, left_child, right_child):
             "Output of transformer must have a .shape (e.g., numpy array)"
         )
 
-    return np.array(accum)
-
-
-def _preorder_indexes(root, left_child, right_child, idx=1):
-    """ transforms a tree into a tree of preorder indexes """
-
-    if not callable(left_child) or not callable(right_child):
+    try:
+        return np.array(accum)
+    except ValueError:
         raise TreeConvolutionError(
-            "left_child and right_child must be a function mapping a "
-            + "tree node to its child, or None"
+            "Transformer outputs could not be unified into an array. "
+            + "Are they all the same size?"
         )
 
-    if _is_leaf(root, left_child, right_child):
-        # leaf
-        return idx
 
-    def rightmost(tree):
-        if isinstance(tree, tuple):
-            return rightmost(tree[2])
-        return tree
+def _preorder_indexes(root, left_child, right_child, idx=1):
+    """ transforms a tree into a tree of preorder indexes """
 
-    left_subtree = _preorder_indexes(
-        left_child(root), left_child, right_child, idx=idx + 1
-    )
+    _, childs = _preorder(root, left_child, right_child)
 
-    max_index_in_left = rightmost(left_subtree)
-    right_subtree = _preorder_indexes(
-        right_child(root), left_child, right_child, idx=max_index_in_left + 1
-    )
+    # childs come after their parent in preorder, build the tree backwards
+    index_tree = [None] * len(childs)
+    for pos in range(len(childs) - 1, -1, -1):
+        if childs[pos] is None:
+            # leaf
+            index_tree[pos] = idx + pos
+        else:
+            left, right = childs[pos]
+            index_tree[pos] = (idx + pos, index_tree[left], index_tree[right])
 
-    return (idx, left_subtree, right_subtree)
+    return index_tree[0]
 
 
 def _tree_conv_indexes(root, left_child, right_child):
@@ -92,30 +113,24 @@ def _tree_conv_indexes(root, left_child, right_child):
     tree convolution.
     """
 
-    if not callable(left_child) or not callable(right_child):
-        raise TreeConvolutionError(
-            "left_child and right_child must be a function mapping a "
-            + "tree node to its child, or None"
-        )
-
-    index_tree = _preorder_indexes(root, left_child, right_child)
-
-    def recurse(root):
-        if isinstance(root, tuple):
-            my_id = root[0]
-            left_id = root[1][0] if isinstance(root[1], tuple) else root[1]
-            right_id = root[2][0] if isinstance(root[2], tuple) else root[2]
-            yield [my_id, left_id, right_id]
+    _, childs = _preorder(root, left_child, right_child)
 
-            yield from recurse(root[1])
-            yield from recurse(root[2])
-        else:
-            yield [root, 0, 0]
+    indexes = np.zeros((len(childs), 3), dtype=np.int64)
+    for pos, node_childs in enumerate(childs):
+        indexes[pos, 0] = pos + 1
+        if node_childs is not None:
+            indexes[pos, 1] = node_childs[0] + 1
+            indexes[pos, 2] = node_childs[1] + 1
 
-    return np.array(list(recurse(index_tree))).flatten().reshape(-1, 1)
+    return indexes.reshape(-1, 1)
 
 
-def _pad_and_combine(x):
+def _pad_and_combine(x, out=None, dtype=np.float32):
+    """
+    Stack the 2D arrays of x, zero padded to the longest one, in a batch x
+    max rows x columns array of dtype. With out (an array of zeros, as large or
+    larger) the arrays are written in it and its used part is returned.
+    """
     assert len(x) >= 1
     assert len(x[0].shape) == 2
 
@@ -131,31 +146,55 @@ def _pad_and_combine(x):
         assert itm.shape[1] == second_dim
 
     max_first_dim = max(arr.shape[0] for arr in x)
+    if out is None:
+        out = np.zeros((len(x), max_first_dim, second_dim), dtype=dtype)
+    else:
+        out = out[: len(x), :max_first_dim, :second_dim]
+
+    for i, arr in enumerate(x):
+        out[i, : arr.shape[0]] = arr
 
-    vecs = []
-    for arr in x:
-        padded = np.zeros((max_first_dim, second_dim))
-        padded[0 : arr.shape[0]] = arr
-        vecs.append(padded)
+    return out
 
-    return np.array(vecs)
 
+def _combined_tensor(x, dtype, pin_memory=False):
+    """
+    _pad_and_combine of x written in place in a tensor of zeros of dtype, pinned
+    with pin_memory so it is copied to the gpu asynchronously.
+    """
+    shape = (len(x), max(arr.shape[0] for arr in x), x[0].shape[1])
+    tensor = torch.zeros(shape, dtype=dtype, pin_memory=pin_memory)
+    _pad_and_combine(x, out=tensor.numpy())
+    return tensor
+
+
+def prepare_trees(
+    trees, transformer, left_child, right_child, cuda=False, dtype=torch.float32
+):
+    """
+    Tensors of a batch of trees for the tree convolution: the features, batch x
+    channels x max tree nodes, of dtype (torch.float32 or torch.float16), and
+    the int64 indexes. Both are written once in their buffer, pinned when cuda.
+    """
+    if all(isinstance(x, FlatTree) for x in trees):
+        flat_trees = [x.features for x in trees]
+        indexes = [x.indexes for x in trees]
+    else:
+        flat_trees = [
+            _flatten(x, transformer, left_child, right_child) for x in trees
+        ]
+        indexes = [_tree_conv_indexes(x, left_child, right_child) for x in trees]
 
-def prepare_trees(trees, transformer, left_child, right_child, cuda=False):
-    flat_trees = [_flatten(x, transformer, left_child, right_child) for x in trees]
-    flat_trees = _pad_and_combine(flat_trees)
-    flat_trees = torch.Tensor(flat_trees)
+    flat_trees = _combined_tensor(flat_trees, dtype, pin_memory=cuda)
 
     # flat trees is now batch x max tree nodes x channels
     flat_trees = flat_trees.transpose(1, 2)
     if cuda:
-        flat_trees = flat_trees.cuda()
+        flat_trees = flat_trees.cuda(non_blocking=True)
 
-    indexes = [_tree_conv_indexes(x, left_child, right_child) for x in trees]
-    indexes = _pad_and_combine(indexes)
-    indexes = torch.Tensor(indexes).long()
+    indexes = _combined_tensor(indexes, torch.int64, pin_memory=cuda)
 
     if cuda:
-        indexes = indexes.cuda()
+        indexes = indexes.cuda(non_blocking=True)
 
     return (flat_trees, indexes)
@@ -0,0 +1,337 @@
+"""
+Self describing model artifact, one file without pickles.
+
+The file has the layout of safetensors (written without the library): the size
+of a json header as a little endian uint64, the header, and the raw little
+endian tensors at the offsets the header gives. The header keeps in
+``__metadata__`` the class of the model, its hyperparameters (see
+BaseRegression.net_config), the target transform, the scaler of the query
+features and the cardinality encoder.
+
+Tensors:
+    net.*          NeoNet state_dict
+    aec.*          autoencoder state_dict of the models with autoencoder
+    vocab.blob     uint8, the utf-8 predicates in sorted order one after the other
+    vocab.offsets  int64, start of every predicate in blob and the end of the last
+    vocab.index    int64, index of every sorted predicate in the node features
+
+Reading maps the file (numpy.memmap), so loading a model costs about copying
+its weights once; the featurizer looks the vocabulary up by binary search in
+the mapped table, without building the dict (Vocabulary). Loading needs numpy,
+scipy and torch, not sklearn.
+
+    save_artifact(reg, "model.safetensors")
+    reg = load_artifact("model.safetensors")
+"""
+
+import bisect
+import importlib
+import json
+import struct
+from collections.abc import Mapping
+
+import numpy as np
+
+from transforms import LogMinMaxTransform, QueryScaler
+
+FORMAT = "sparql-latency-prediction"
+VERSION = 1
+
+_DTYPES = {
+    "F64": np.float64,
+    "F32": np.float32,
+    "F16": np.float16,
+    "I64": np.int64,
+    "I32": np.int32,
+    "I16": np.int16,
+    "I8": np.int8,
+    "U8": np.uint8,
+    "BOOL": np.bool_,
+}
+_NAMES = {np.dtype(dtype): name for name, dtype in _DTYPES.items()}
+
+
+class ArtifactError(Exception):
+    pass
+
+
+def write_tensors(path, tensors, metadata=None):
+    """
+    Write numpy arrays in the safetensors layout.
+    :param tensors: dict of name to array.
+    :param metadata: dict of str to str.
+    """
+    header = {}
+    offset = 0
+    arrays = []
+    for name, array in tensors.items():
+        array = np.ascontiguousarray(array)
+        if array.dtype not in _NAMES:
+            raise ArtifactError("Unsupported dtype {} of {}".format(array.dtype, name))
+        array = array.astype(array.dtype.newbyteorder("<"), copy=False)
+        header[name] = {
+            "dtype": _NAMES[array.dtype],
+            "shape": list(array.shape),
+            "data_offsets": [offset, offset + array.nbytes],
+        }
+        offset += array.nbytes
+        arrays.append(array)
+    if metadata:
+        header["__metadata__"] = metadata
+    header = json.dumps(header, separators=(",", ":")).encode()
+    # Tensors start aligned on 8 bytes
+    header += b" " * (-len(header) % 8)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for array in arrays:
+            f.write(array.tobytes())
+
+
+def read_tensors(path, mmap=True):
+    """
+    Arrays and metadata of a file of write_tensors, or of safetensors. With mmap
+    the arrays are copy on write views of the file.
+    """
+    with open(path, "rb") as f:
+        (size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(size))
+    metadata = header.pop("__metadata__", {})
+    start = 8 + size
+    if mmap:
+        data = np.memmap(path, dtype=np.uint8, mode="c", offset=start)
+    else:
+        with open(path, "rb") as f:
+            f.seek(start)
+            data = np.frombuffer(bytearray(f.read()), dtype=np.uint8)
+    tensors = {}
+    for name, info in header.items():
+        begin, end = info["data_offsets"]
+        dtype = np.dtype(_DTYPES[info["dtype"]]).newbyteorder("<")
+        tensors[name] = data[begin:end].view(dtype).reshape(info["shape"])
+    return tensors, metadata
+
+
+class Vocabulary(Mapping):
+    """
+    Sorted string table of the predicates, a read only mapping of predicate to
+    index looked up by binary search on the mapped file. The featurizer of
+    load_artifact looks its predicates up here, the ones found are remembered;
+    the table is only decoded whole when iterated.
+    """
+
+    def __init__(self, blob, offsets, index):
+        self.blob = blob
+        self.offsets = offsets
+        self.index = index
+        self._found = {}
+
+    @classmethod
+    def from_dict(cls, preds_to_index):
+        preds = sorted(preds_to_index)
+        encoded = [pred.encode() for pred in preds]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(pred) for pred in encoded], out=offsets[1:])
+        return cls(
+            np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            offsets,
+            np.asarray([preds_to_index[pred] for pred in preds], dtype=np.int64),
+        )
+
+    def __len__(self):
+        return len(self.index)
+
+    def key(self, i):
+        return self._encoded(i).decode()
+
+    def _encoded(self, i):
+        return self.blob[self.offsets[i] : self.offsets[i + 1]].tobytes()
+
+    def get(self, pred, default=None):
+        index = self._found.get(pred)
+        if index is not None:
+            return index
+        # utf-8 keeps the order of the code points, the table is sorted by both
+        encoded = pred.encode()
+        keys = _Keys(self)
+        i = bisect.bisect_left(keys, encoded)
+        if i < len(self) and keys[i] == encoded:
+            index = self._found[pred] = int(self.index[i])
+            return index
+        return default
+
+    def __getitem__(self, pred):
+        index = self.get(pred)
+        if index is None:
+            raise KeyError(pred)
+        return index
+
+    def __contains__(self, pred):
+        return self.get(pred) is not None
+
+    def __iter__(self):
+        return iter(self.to_dict())
+
+    def to_dict(self):
+        """Predicate to index dict, in index order as the featurizer builds it"""
+        blob = self.blob.tobytes()
+        offsets = self.offsets.tolist()
+        preds = [blob[start:end].decode() for start, end in zip(offsets, offsets[1:])]
+        order = np.argsort(self.index, kind="stable")
+        index = self.index.tolist()
+        return {preds[i]: index[i] for i in order}
+
+
+class _Keys:
+    """Sequence of the sorted utf-8 predicates of a Vocabulary, for bisect"""
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    def __getitem__(self, i):
+        return self.vocabulary._encoded(i)
+
+
+def save_artifact(reg, path):
+    """Save a fitted regressor, with NeoNet net, as an artifact"""
+    tensors = {
+        "net." + name: value.detach().cpu().numpy()
+        for name, value in reg.net.state_dict().items()
+    }
+    if reg.aec_net is not None:
+        tensors.update(
+            {
+                "aec." + name: value.detach().cpu().numpy()
+                for name, value in reg.aec_net.state_dict().items()
+            }
+        )
+    vocabulary = Vocabulary.from_dict(reg.get_pred())
+    tensors["vocab.blob"] = vocabulary.blob
+    tensors["vocab.offsets"] = vocabulary.offsets
+    tensors["vocab.index"] = vocabulary.index
+
+    target = reg.pipeline
+    if not isinstance(target, LogMinMaxTransform):
+        target = LogMinMaxTransform.from_pipeline(target)
+    card_encoder = reg.card_encoder
+    metadata = {
+        "format": FORMAT,
+        "version": str(VERSION),
+        "model": "{}.{}".format(type(reg).__module__, type(reg).__name__),
+        "config": json.dumps(reg.net_config()),
+        "target_transform": json.dumps(
+            {"type": "log1p_minmax", "scale": target.scale, "offset": target.offset}
+        ),
+        "cardinality": json.dumps(
+            {
+                "max_cardinality": (
+                    None if card_encoder is None else card_encoder.max_cardinality
+                ),
+                "unknown": "ignore" if card_encoder is None else card_encoder.unknown,
+                "maxcardinality": reg.maxcardinality,
+            }
+        ),
+        "n": str(reg.n),
+        "query_scaler": json.dumps(
+            None if reg.query_scaler is None else reg.query_scaler.to_dict()
+        ),
+    }
+    write_tensors(path, tensors, metadata)
+
+
+class Artifact:
+    """Contents of an artifact file, see read_artifact"""
+
+    def __init__(self, tensors, metadata):
+        if metadata.get("format") != FORMAT:
+            raise ArtifactError("Not a model artifact")
+        if int(metadata["version"]) > VERSION:
+            raise ArtifactError(
+                "Artifact version {} is newer than {}".format(
+                    metadata["version"], VERSION
+                )
+            )
+        self.tensors = tensors
+        self.metadata = metadata
+        self.model = metadata["model"]
+        self.config = json.loads(metadata["config"])
+        self.cardinality = json.loads(metadata["cardinality"])
+        self.n = int(metadata["n"])
+        target = json.loads(metadata["target_transform"])
+        self.target_transform = LogMinMaxTransform(target["scale"], target["offset"])
+        # Artifacts saved before the query scaler was saved have none
+        scaler = json.loads(metadata.get("query_scaler", "null"))
+        self.query_scaler = None if scaler is None else QueryScaler.from_dict(scaler)
+        self.vocabulary = Vocabulary(
+            tensors["vocab.blob"], tensors["vocab.offsets"], tensors["vocab.index"]
+        )
+
+    def state_dict(self, prefix):
+        """Arrays of the tensors named prefix.*, without the prefix"""
+        prefix += "."
+        return {
+            name[len(prefix) :]: value
+            for name, value in self.tensors.items()
+            if name.startswith(prefix)
+        }
+
+
+def read_artifact(path, mmap=True):
+    """Artifact of path, only numpy is needed to read it"""
+    return Artifact(*read_tensors(path, mmap=mmap))
+
+
+def load_artifact(path, map_location=None):
+    """
+    Regressor saved in path by save_artifact, in eval mode.
+    :param map_location: device of the nets, "cpu" on hosts without CUDA. The
+    default device of the models if None.
+    """
+    import torch
+    import torch.nn as nn
+
+    from featurize import SPARQLTreeFeaturizer
+    from net import autoencoder_for_state
+    from transforms import CardinalityEncoder
+
+    artifact = read_artifact(path)
+    module, name = artifact.model.rsplit(".", 1)
+    cls = getattr(importlib.import_module(module), name)
+    config = dict(artifact.config)
+    query_input_size = config.pop("query_input_size")
+    config["tree_activation_tree"] = getattr(nn, config["tree_activation_tree"])
+    config["tree_activation_dense"] = getattr(nn, config["tree_activation_dense"])
+    reg = cls(maxcardinality=artifact.cardinality["maxcardinality"], **config)
+    reg.query_input_size = query_input_size
+    reg.n = artifact.n
+    reg.pipeline = artifact.target_transform
+    reg.query_scaler = artifact.query_scaler
+    reg.tree_transform = SPARQLTreeFeaturizer.from_vocabulary(artifact.vocabulary)
+    if artifact.cardinality["max_cardinality"] is not None:
+        reg.card_encoder = CardinalityEncoder(
+            reg.get_pred(), unknown=artifact.cardinality["unknown"]
+        )
+        reg.card_encoder.max_cardinality = artifact.cardinality["max_cardinality"]
+
+    def load_state(module, prefix):
+        state = {
+            name: torch.from_numpy(value)
+            for name, value in artifact.state_dict(prefix).items()
+        }
+        if map_location is not None and torch.device(map_location).type == "cpu":
+            module = module.cpu()
+        module.load_state_dict(state)
+        return module.eval()
+
+    io_dim = len(reg.get_pred())
+    if artifact.state_dict("aec"):
+        io_dim -= reg.ignore_first_aec_data
+        aec_net = autoencoder_for_state(artifact.state_dict("aec"), io_dim)
+        if torch.cuda.is_available():
+            aec_net = aec_net.cuda()
+        reg.aec_net = load_state(aec_net, "aec")
+    reg.net = load_state(reg.build_net(io_dim), "net")
+    return reg
@@ -0,0 +1,112 @@
+"""
+Benchmark of the inference of the gradient boosted trees baseline against NeoNet.
+
+Both regressors predict the same synthetic rows with predict_raw_data, by
+batch size; the time of the model alone is also taken, the FlatForest (and
+the sklearn predict) on the features and the NeoNet forward on a collated batch. The NeoNet
+is not trained, its inference costs the same.
+
+    python -m benchmarks.bench_gbt --output gbt.json
+"""
+
+import argparse
+from functools import partial
+
+import numpy as np
+import torch
+
+from benchmarks.bench_pipeline import setup
+from benchmarks.timing import default_output, timeit, write_results
+from Models.model_gbt import GBTRegression
+
+
+def fit_gbt(reg, ds, queries, cards, max_iter):
+    """GBTRegression with the featurizer of reg, trained on the rows of ds"""
+    gbt = GBTRegression(max_iter=max_iter, eval_every=max_iter)
+    gbt.tree_transform = reg.tree_transform
+    gbt.card_encoder = reg.card_encoder
+    trees = gbt.parse_trees(ds["trees"].values)
+    y = ds["time"].values
+    gbt.fit(trees, queries, y, trees, queries, y, cards, cards)
+    return gbt, trees
+
+
+def bench(depth, batch_sizes, n_rows, n_preds, max_iter, repeat, seed=0):
+    reg, ds, queries, cards = setup(depth, n_rows, n_preds, seed)
+    gbt, _ = fit_gbt(reg, ds, queries, cards, max_iter)
+    reg.net.eval()
+    results = []
+    for batch_size in batch_sizes:
+        column = ds["trees"].values[:batch_size]
+        batch = (column, queries[:batch_size], cards[:batch_size])
+        times = {}
+        times["gbt_predict_raw_data"], _ = timeit(
+            lambda: gbt.predict_raw_data(*batch), repeat
+        )
+        times["neo_predict_raw_data"], _ = timeit(
+            lambda: reg.predict_raw_data(*batch), repeat
+        )
+        features, _ = gbt.features(*batch)
+        times["gbt_model"], _ = timeit(lambda: gbt.forest.predict(features), repeat)
+        times["gbt_sklearn_predict"], _ = timeit(
+            lambda: gbt.model.predict(features), repeat
+        )
+        packed = reg.tree_transform.transform_packed(reg.parse_trees(column).trees)
+        x = reg.collate_predict_with_card(
+            list(zip(packed, range(batch_size))),
+            reg.query_features(batch[1], batch[2]),
+        )
+        with torch.no_grad():
+            times["neo_model"], _ = timeit(partial(reg.net, x), repeat)
+        per_row = {name: 1e6 * value / batch_size for name, value in times.items()}
+        print(
+            "depth {} batch {}: ".format(depth, batch_size)
+            + " ".join("{} {:.1f}us/row".format(k, v) for k, v in per_row.items())
+        )
+        results.append(
+            {
+                "depth": depth,
+                "batch_size": batch_size,
+                "times": times,
+                "us_per_row": per_row,
+            }
+        )
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the gradient boosted trees inference against NeoNet"
+    )
+    parser.add_argument("--depths", type=int, nargs="+", default=[4, 16])
+    parser.add_argument(
+        "--batch-sizes", dest="batch_sizes", type=int, nargs="+", default=[1, 128]
+    )
+    parser.add_argument("--rows", type=int, default=512, help="training rows")
+    parser.add_argument("--preds", type=int, default=200, help="vocabulary size")
+    parser.add_argument("--max-iter", dest="max_iter", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", help="json file to store the results, default benchmarks/results"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(args.seed)
+    results = []
+    for depth in args.depths:
+        results.extend(
+            bench(
+                depth,
+                args.batch_sizes,
+                args.rows,
+                args.preds,
+                args.max_iter,
+                args.repeat,
+                args.seed,
+            )
+        )
+    write_results(args.output or default_output("gbt"), "gbt", vars(args), results)
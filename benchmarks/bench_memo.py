@@ -0,0 +1,115 @@
+"""
+Benchmark of NodeMemo on a replayed log of queries with repeated plans.
+
+The log draws its plans from a pool of distinct plans with Zipf frequencies,
+every entry with the query features of another row, as the same plan with
+other filters or limits. The log is predicted in batches with predict_raw_data,
+without memo, with the memo shared only inside a batch and with the memo
+cache kept across batches.
+
+    python -m benchmarks.bench_memo --output memo.json
+"""
+
+import argparse
+
+import numpy as np
+import torch
+
+from benchmarks.bench_pipeline import setup
+from benchmarks.timing import default_output, write_results
+from node_memo import NodeMemo
+import time
+
+
+def replay_log(ds, queries, cards, n_entries, n_plans, zipf, seed):
+    """Trees, queries and cardinalities of a log drawn from the first n_plans plans"""
+    rng = np.random.RandomState(seed)
+    plans = np.minimum(rng.zipf(zipf, n_entries) - 1, n_plans - 1)
+    rows = rng.randint(0, len(ds), n_entries)
+    return ds["trees"].values[plans], queries[rows], cards[rows]
+
+
+def replay(reg, log, batch_size, memo):
+    trees, queries, cards = log
+    reg.set_node_memo(memo)
+    predictions = []
+    start = time.perf_counter()
+    for i in range(0, len(trees), batch_size):
+        predictions.extend(
+            reg.predict_raw_data(
+                trees[i : i + batch_size],
+                queries[i : i + batch_size],
+                cards[i : i + batch_size],
+            )
+        )
+    elapsed = time.perf_counter() - start
+    reg.set_node_memo(None)
+    return elapsed, np.asarray(predictions).reshape(-1)
+
+
+def bench(depth, n_entries, n_plans, zipf, batch_size, n_preds, seed=0):
+    reg, ds, queries, cards = setup(depth, max(n_plans, 256), n_preds, seed)
+    log = replay_log(ds, queries, cards, n_entries, n_plans, zipf, seed)
+    times = {}
+    times["no_memo"], expected = replay(reg, log, batch_size, None)
+    stats = {}
+    max_error = 0.0
+    for name, max_entries in (("batch_memo", 0), ("cached_memo", 200000)):
+        memo = NodeMemo(max_entries=max_entries)
+        times[name], predictions = replay(reg, log, batch_size, memo)
+        stats[name] = memo.stats()
+        max_error = max(max_error, float(np.abs(predictions - expected).max()))
+    result = {
+        "depth": depth,
+        "batch_size": batch_size,
+        "times": times,
+        "stats": stats,
+        "max_abs_error": max_error,
+    }
+    print(
+        "depth {} batch {}: ".format(depth, batch_size)
+        + " ".join("{} {:.3f}s".format(k, v) for k, v in times.items())
+    )
+    for name, values in stats.items():
+        print(
+            "\t{}: unique nodes {:.1%}, projected {}, cache hit rate {:.1%}".format(
+                name,
+                values["unique_rate"],
+                values["projected"],
+                values.get("cache_hit_rate", 0.0),
+            )
+        )
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark of NodeMemo")
+    parser.add_argument("--depths", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--entries", type=int, default=2048, help="log size")
+    parser.add_argument("--plans", type=int, default=64, help="distinct plans")
+    parser.add_argument("--zipf", type=float, default=1.5)
+    parser.add_argument("--batch-size", dest="batch_size", type=int, default=128)
+    parser.add_argument("--preds", type=int, default=200, help="vocabulary size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", help="json file to store the results, default benchmarks/results"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(args.seed)
+    results = [
+        bench(
+            depth,
+            args.entries,
+            args.plans,
+            args.zipf,
+            args.batch_size,
+            args.preds,
+            args.seed,
+        )
+        for depth in args.depths
+    ]
+    write_results(args.output or default_output("memo"), "memo", vars(args), results)
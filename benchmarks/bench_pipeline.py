@@ -0,0 +1,151 @@
+"""
+End to end benchmark of the pipeline on a synthetic dataset: fix_tree,
+SPARQLTreeFeaturizer.transform (legacy path), transform_packed,
+collate_with_card, prepare_trees, a NeoNet training step (forward and
+backward) and predict_raw_data, sweeping the batch size and the depth of
+left deep plans.
+
+    python -m benchmarks.bench_pipeline --output pipeline.json
+    python -m benchmarks.bench_pipeline --output new.json --compare pipeline.json
+"""
+
+import argparse
+import sys
+
+import numpy as np
+import torch
+
+from benchmarks.synthetic import random_dataset
+from benchmarks.timing import compare_results, default_output, timeit, write_results
+from data_preprocessing import LIST_QUERY_COLUMNS
+from Models.model_trees_algebra import NeoRegression
+from net import NeoNet, left_child, right_child
+from TreeConvolution.util import prepare_trees
+
+KEYS = ["depth", "batch_size"]
+
+
+def features(x):
+    return x[0]
+
+
+def setup(depth, n_rows, n_preds, seed):
+    """NeoRegression fitted on a synthetic dataset, without training"""
+    ds = random_dataset(n_rows, 2 * depth + 1, "left_deep", n_preds, seed)
+    reg = NeoRegression(verbose=False)
+    trees = reg.parse_trees(ds["trees"].values)
+    reg.tree_transform.fit(trees)
+    cards = reg.encode_cardinalities(ds["json_cardinality"].values, fit=True)
+    queries = ds[LIST_QUERY_COLUMNS].values.astype(np.float64)
+    reg.pipeline.fit(ds["time"].values.reshape(-1, 1))
+    reg.query_input_size = reg.query_features(queries, cards).shape[1]
+    reg.net = NeoNet(
+        len(reg.get_pred()),
+        reg.query_input_size,
+        reg.query_hidden_inputs,
+        reg.query_output,
+        tree_units=reg.tree_units,
+        tree_units_dense=reg.tree_units_dense,
+        in_cuda=False,
+    )
+    return reg, ds, queries, cards
+
+
+def bench_batch(reg, ds, queries, cards, batch_size, repeat):
+    column = ds["trees"].values[:batch_size]
+    y = ds["time"].values[:batch_size]
+    query_features = reg.query_features(queries[:batch_size], cards[:batch_size])
+    times = {}
+
+    # fix_tree mutates the trees, a fresh copy for each repeat
+    copies = [list(reg.parse_trees(column)) for _ in range(repeat)]
+    times["fix_tree"], fixed = timeit(
+        lambda: [reg.fix_tree(x) for x in copies.pop()], repeat
+    )
+    times["transform"], _ = timeit(lambda: reg.tree_transform.transform(fixed), repeat)
+
+    trees = list(reg.parse_trees(column))
+    times["transform_packed"], packed = timeit(
+        lambda: reg.tree_transform.transform_packed(trees), repeat
+    )
+    items = list(zip(zip(packed, range(batch_size)), y))
+    times["collate_with_card"], (x, targets) = timeit(
+        lambda: reg.collate_with_card(items, query_features), repeat
+    )
+    times["prepare_trees"], _ = timeit(
+        lambda: prepare_trees(
+            [tree for tree, _ in x], features, left_child, right_child
+        ),
+        repeat,
+    )
+
+    optimizer = torch.optim.Adam(reg.net.parameters(), **reg.optimizer["args"])
+    loss_fn = torch.nn.MSELoss()
+    y_scaled = torch.tensor(reg.pipeline.transform(y.reshape(-1, 1))).float()
+
+    def train_step():
+        reg.net.train()
+        loss = loss_fn(reg.net(x), y_scaled)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    times["train_step"], _ = timeit(train_step, repeat)
+    times["predict_raw_data"], _ = timeit(
+        lambda: reg.predict_raw_data(column, queries[:batch_size], cards[:batch_size]),
+        repeat,
+    )
+    return times
+
+
+def bench(depths, batch_sizes, n_preds, repeat, seed=0):
+    results = []
+    for depth in depths:
+        reg, ds, queries, cards = setup(depth, max(batch_sizes), n_preds, seed)
+        for batch_size in batch_sizes:
+            times = bench_batch(reg, ds, queries, cards, batch_size, repeat)
+            results.append({"depth": depth, "batch_size": batch_size, "times": times})
+            print(
+                "depth {:>5} batch {:>5}: ".format(depth, batch_size)
+                + " ".join("{} {:.4f}s".format(k, v) for k, v in times.items())
+            )
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark of the whole pipeline")
+    parser.add_argument("--depths", type=int, nargs="+", default=[2, 8, 32, 128])
+    parser.add_argument(
+        "--batch-sizes", dest="batch_sizes", type=int, nargs="+", default=[16, 64, 256]
+    )
+    parser.add_argument("--preds", type=int, default=200, help="vocabulary size")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", help="json file to store the results, default benchmarks/results"
+    )
+    parser.add_argument(
+        "--compare", help="results json of a previous run, fails on regressions"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=1.25, help="max ratio against --compare"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(args.seed)
+    results = bench(args.depths, args.batch_sizes, args.preds, args.repeat, args.seed)
+    output = args.output or default_output("pipeline")
+    write_results(output, "pipeline", vars(args), results)
+    if args.compare:
+        regressions = compare_results(output, args.compare, KEYS, args.threshold)
+        for key, name, base, value, ratio in regressions:
+            print(
+                "REGRESSION {} {}: {:.4f}s -> {:.4f}s (x{:.2f})".format(
+                    dict(zip(KEYS, key)), name, base, value, ratio
+                )
+            )
+        if regressions:
+            sys.exit(1)
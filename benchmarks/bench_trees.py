@@ -0,0 +1,124 @@
+"""
+Benchmark of tree fixing, encoding and flattening on synthetic plans of 10 to
+10,000 nodes.
+
+Compares the legacy path (fix_tree, SPARQLTreeFeaturizer.transform,
+index2sparse, prepare_trees) with the packed one (transform_packed,
+packed2flat, prepare_trees).
+
+    python -m benchmarks.bench_trees --output bench_trees.json
+"""
+
+import argparse
+import sys
+
+from benchmarks.synthetic import random_trees
+from benchmarks.timing import compare_results, default_output, timeit, write_results
+from Models.model_trees_algebra import NeoRegression
+from net import left_child, right_child
+from TreeConvolution.util import prepare_trees
+
+KEYS = ["shape", "nodes"]
+
+
+def features(x):
+    return x[0]
+
+
+def bench(sizes, shapes, n_trees, n_preds, repeat):
+    results = []
+    for shape in shapes:
+        for size in sizes:
+            reg = NeoRegression()
+            reg.tree_transform.fit(random_trees(n_trees, size, shape, n_preds))
+            sizeindexes = len(reg.get_pred())
+            row = {"shape": shape, "nodes": size, "times": {}}
+
+            # fix_tree mutates the trees, a fresh copy for each repeat
+            t_fix, fixed = timeit(
+                lambda: [
+                    reg.fix_tree(x) for x in random_trees(n_trees, size, shape, n_preds)
+                ],
+                repeat,
+            )
+            t_transform, encoded = timeit(
+                lambda: reg.tree_transform.transform(fixed), repeat
+            )
+            t_sparse, flat = timeit(
+                lambda: [reg.index2sparse(x, sizeindexes) for x in encoded], repeat
+            )
+            t_prepare, _ = timeit(
+                lambda: prepare_trees(flat, features, left_child, right_child),
+                repeat,
+            )
+            row["times"]["legacy"] = {
+                "fix_tree": t_fix,
+                "transform": t_transform,
+                "index2sparse": t_sparse,
+                "prepare_trees": t_prepare,
+                "total": t_fix + t_transform + t_sparse + t_prepare,
+            }
+
+            trees = random_trees(n_trees, size, shape, n_preds)
+            t_packed, packed = timeit(
+                lambda: reg.tree_transform.transform_packed(trees), repeat
+            )
+            t_flat, flat = timeit(lambda: reg.packed2flat(packed, sizeindexes), repeat)
+            t_prepare, _ = timeit(
+                lambda: prepare_trees(flat, features, left_child, right_child),
+                repeat,
+            )
+            row["times"]["packed"] = {
+                "transform_packed": t_packed,
+                "packed2flat": t_flat,
+                "prepare_trees": t_prepare,
+                "total": t_packed + t_flat + t_prepare,
+            }
+            results.append(row)
+            print(
+                "{:>10} {:>6} nodes: legacy {:.4f}s packed {:.4f}s".format(
+                    shape,
+                    size,
+                    row["times"]["legacy"]["total"],
+                    row["times"]["packed"]["total"],
+                )
+            )
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark tree encoding")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument(
+        "--shapes", nargs="+", default=["left_deep", "balanced", "random"]
+    )
+    parser.add_argument("--trees", type=int, default=8, help="trees by batch")
+    parser.add_argument("--preds", type=int, default=200, help="vocabulary size")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--output", help="json file to store the results, default benchmarks/results"
+    )
+    parser.add_argument(
+        "--compare", help="results json of a previous run, fails on regressions"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=1.25, help="max ratio against --compare"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = bench(args.sizes, args.shapes, args.trees, args.preds, args.repeat)
+    output = args.output or default_output("trees")
+    write_results(output, "trees", vars(args), results)
+    if args.compare:
+        regressions = compare_results(output, args.compare, KEYS, args.threshold)
+        for key, name, base, value, ratio in regressions:
+            print(
+                "REGRESSION {} {}: {:.4f}s -> {:.4f}s (x{:.2f})".format(
+                    dict(zip(KEYS, key)), name, base, value, ratio
+                )
+            )
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,114 @@
+"""
+Synthetic plans and datasets with the schema of the kaggle/huggingface data:
+json ``trees``, ``json_cardinality``, the LIST_QUERY_COLUMNS features and the
+``time`` target.
+"""
+
+import json
+import random
+
+import pandas as pd
+
+from data_preprocessing import LIST_QUERY_COLUMNS
+
+TPF_TYPES = [
+    "VAR_VAR_VAR",
+    "VAR_VAR_URI",
+    "VAR_URI_VAR",
+    "VAR_URI_URI",
+    "VAR_URI_LITERAL",
+    "URI_URI_VAR",
+    "URI_VAR_VAR",
+]
+
+JOIN_TYPES = ["JOIN", "LEFT_JOIN"]
+
+
+def predicates(n_preds):
+    return ["http://www.wikidata.org/prop/direct/P{}".format(i) for i in range(n_preds)]
+
+
+def random_tree(rng, n_leaves, preds, shape="random", max_preds_leaf=2):
+    """
+    Plan tree as in the json ``trees`` column, joins are not fixed (no predicates).
+    :param shape: 'left_deep', 'balanced' or 'random'.
+    :return: tree with 2 * n_leaves - 1 nodes.
+    """
+    nodes = []
+    for _ in range(n_leaves):
+        leaf_preds = rng.sample(preds, rng.randint(1, max_preds_leaf))
+        nodes.append(["ᶲ".join([rng.choice(TPF_TYPES)] + leaf_preds)])
+
+    if shape == "left_deep":
+        tree = nodes[0]
+        for node in nodes[1:]:
+            tree = [rng.choice(JOIN_TYPES), tree, node]
+        return tree
+
+    while len(nodes) > 1:
+        if shape == "balanced":
+            nodes = [
+                (
+                    [rng.choice(JOIN_TYPES), nodes[i], nodes[i + 1]]
+                    if i + 1 < len(nodes)
+                    else nodes[i]
+                )
+                for i in range(0, len(nodes), 2)
+            ]
+        else:
+            i = rng.randrange(len(nodes) - 1)
+            nodes[i : i + 2] = [[rng.choice(JOIN_TYPES), nodes[i], nodes[i + 1]]]
+    return nodes[0]
+
+
+def random_trees(n_trees, n_nodes, shape="random", n_preds=200, seed=0):
+    """n_trees trees of n_nodes nodes (rounded to odd) over n_preds predicates"""
+    rng = random.Random(seed)
+    preds = predicates(n_preds)
+    n_leaves = max(1, (n_nodes + 1) // 2)
+    return [random_tree(rng, n_leaves, preds, shape) for _ in range(n_trees)]
+
+
+def tree_predicates(tree):
+    """Predicates in the leaves of a tree, in order"""
+    preds = {}
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if len(node) == 3:
+            stack.append(node[2])
+            stack.append(node[1])
+        else:
+            preds.update(dict.fromkeys(node[0].split("ᶲ")[1:]))
+    return list(preds)
+
+
+def random_dataset(n_rows, n_nodes, shape="random", n_preds=200, seed=0):
+    """
+    DataFrame of n_rows queries with plans of n_nodes nodes. Latencies grow
+    with the size of the plan and the cardinalities of its predicates.
+    """
+    rng = random.Random(seed)
+    preds = predicates(n_preds)
+    n_leaves = max(1, (n_nodes + 1) // 2)
+    rows = []
+    for _ in range(n_rows):
+        tree = random_tree(rng, n_leaves, preds, shape)
+        cardinality = {pred: rng.randint(1, 10**6) for pred in tree_predicates(tree)}
+        row = {column: 0 for column in LIST_QUERY_COLUMNS}
+        for column in rng.sample(LIST_QUERY_COLUMNS[:-3], rng.randint(0, 3)):
+            row[column] = rng.randint(1, 3)
+        if rng.random() < 0.3:
+            row["has_slice"] = 1
+            row["max_slice_limit"] = rng.choice([1, 10, 100, 1000])
+            row["max_slice_start"] = rng.choice([0, 0, 10])
+        row["trees"] = json.dumps(tree)
+        row["json_cardinality"] = json.dumps(
+            {pred: str(card) for pred, card in cardinality.items()}
+        )
+        row["time"] = (
+            n_leaves * 0.5 + sum(cardinality.values()) / 10**5 + rng.uniform(1, 5)
+        )
+        rows.append(row)
+    return pd.DataFrame(rows)
+
@@ -0,0 +1,83 @@
+"""
+Timing helpers and the results file shared by the benchmarks.
+
+Results are stored as json with the environment they were taken in, two files
+can be compared with compare_results to catch regressions between versions.
+Without --output they go to benchmarks/results, which git ignores.
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+
+from runtime import environment
+
+
+def timeit(fn, repeat):
+    """Best wall time of repeat calls of fn, and its result"""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def default_output(benchmark):
+    """Results file of benchmark in RESULTS_DIR, for runs without --output"""
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    return os.path.join(RESULTS_DIR, "bench_{}.json".format(benchmark))
+
+
+def write_results(path, benchmark, params, results):
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "benchmark": benchmark,
+                "environment": environment(),
+                "params": params,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+
+
+def compare_results(path, baseline_path, keys, threshold=1.25):
+    """
+    Compare the timings of two results files of the same benchmark. Rows are
+    matched by keys, their timings are in "times", nested dicts are flattened.
+    :return: list of (row key, timing, baseline time, time, ratio) of timings
+    slower than threshold times the baseline.
+    """
+    with open(path) as f:
+        results = json.load(f)["results"]
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+
+    def flatten(row):
+        times = {}
+        stack = [("", row["times"])]
+        while stack:
+            prefix, values = stack.pop()
+            for name, value in values.items():
+                if isinstance(value, dict):
+                    stack.append((prefix + name + ".", value))
+                else:
+                    times[prefix + name] = value
+        return tuple(row[k] for k in keys), times
+
+    baseline = dict(flatten(row) for row in baseline)
+    regressions = []
+    for row in results:
+        key, times = flatten(row)
+        for name, value in times.items():
+            base = baseline.get(key, {}).get(name)
+            if base and value / base > threshold:
+                regressions.append((key, name, base, value, value / base))
+    return regressions
@@ -0,0 +1,346 @@
+"""
+K-fold cross-validation of NeoRegression.
+
+The trees of the dataset are parsed, the featurizer fitted and the trees packed
+once (see featurize); the cardinality encoder and the query scaler are fitted
+by fold on its training rows. Folds are stratified by the time ranges of
+split_train_data and trained concurrently in a pool of processes that share the
+featurized data. Every fold runs in its own process, which exits when the fold
+is done, so at most ``processes`` folds are in memory.
+
+    python cross_validation.py --data-dir DATA --output-dir OUT --folds 5 --processes 5
+
+The RMSE and MAE of every fold, their mean and std and the errors by time range
+of the out of fold predictions are written in the output directory, the model
+of every fold in fold_{fold}/model (see BaseRegression.load_model).
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing as mp
+import os
+import os.path as osp
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from sklearn.metrics import mean_absolute_error, mean_squared_error
+from sklearn.preprocessing import StandardScaler
+
+import data_preprocessing
+from hyperparameter_search import configure
+from Models.model_trees_algebra import NeoRegression
+from transforms import QueryScaler
+
+
+class CVData:
+    """Featurized dataset shared by the folds, see featurize"""
+
+    def __init__(self, reg, trees, rows, y, query, json_cardinality):
+        # NeoRegression with the fitted featurizer
+        self.reg = reg
+        # Packed trees, their rows in the dataset and their times
+        self.trees = trees
+        self.rows = rows
+        self.y = y
+        # Query features and json cardinalities of every row of the dataset
+        self.query = query
+        self.json_cardinality = json_cardinality
+
+
+def featurize(ds, json_backend="auto"):
+    """Parse and pack the trees of ds once"""
+    reg = NeoRegression(verbose=False, json_backend=json_backend)
+    trees, _, _ = reg.fit_transform_tree_data(ds, ds.iloc[:0], ds.iloc[:0])
+    packed = reg.tree_transform.transform_packed(trees)
+    # Samples for the autoencoder are not used
+    reg.tree_transform.get_aec_ds().clear()
+    rows = np.asarray(trees.rows)
+    return CVData(
+        reg,
+        packed,
+        rows,
+        ds["time"].values[rows],
+        ds[data_preprocessing.LIST_QUERY_COLUMNS].values.astype(np.float64),
+        ds["json_cardinality"].values,
+    )
+
+
+def stratified_folds(times, n_folds, seed=0):
+    """Fold of every time, the times of every time range are spread over the folds"""
+    rng = np.random.RandomState(seed)
+    ranges = data_preprocessing.time_range_index(times)
+    folds = np.empty(len(ranges), dtype=np.int64)
+    start = 0
+    for time_range in np.unique(ranges):
+        index = rng.permutation(np.flatnonzero(ranges == time_range))
+        folds[index] = (start + np.arange(len(index))) % n_folds
+        start += len(index)
+    return folds
+
+
+def time_range_names(times):
+    names = np.asarray(list(data_preprocessing.TIME_RANGES) + ["0"], dtype=object)
+    # -1, times out of the ranges, is the last name
+    return names[data_preprocessing.time_range_index(times)]
+
+
+def fold_features(reg, data, train):
+    """
+    Query features of every row of data, with the cardinality encoder and the
+    query scaler of reg fitted on the rows train of the dataset.
+    """
+    reg.encode_cardinalities(data.json_cardinality[train], fit=True)
+    card = reg.encode_cardinalities(data.json_cardinality)
+    reg.query_scaler = QueryScaler.from_scaler(StandardScaler().fit(data.query[train]))
+    return reg.query_features(data.query, card)
+
+
+_data = None
+
+
+def _init_worker(data, threads):
+    global _data
+    _data = data
+    torch.set_num_threads(threads)
+
+
+def run_fold(
+    fold, folds, output_path, config=None, val_rate=0.2, seed=0, verbose=False
+):
+    """
+    Train on every fold but fold and predict fold. The validation set of early
+    stopping is split from the training folds with split_train_data, the
+    cardinality encoder and the query scaler are fitted on the training rows.
+    The model is saved in output_path/fold_{fold}/model.
+    """
+    start = time.time()
+    data = _data
+    model_path = osp.join(output_path, "fold_{}".format(fold), "model")
+    os.makedirs(model_path, exist_ok=True)
+
+    test = np.flatnonzero(folds == fold)
+    train_val = np.flatnonzero(folds != fold)
+    ds_train, ds_val = data_preprocessing.split_train_data(
+        pd.DataFrame({"time": data.y[train_val], "index": train_val}), val_rate, seed
+    )
+    train = ds_train["index"].values
+    val = ds_val["index"].values
+
+    reg = NeoRegression(verbose=verbose, output_path=model_path)
+    reg.tree_transform = data.reg.tree_transform
+    if config:
+        reg = configure(reg, config)
+
+    features = fold_features(reg, data, data.rows[train])
+    reg.query_input_size = features.shape[1]
+    reg.pipeline.fit(data.y[train].reshape(-1, 1))
+
+    def loader(index, shuffle):
+        return reg.get_dataloader(
+            [data.trees[i] for i in index],
+            data.rows[index],
+            data.y[index],
+            features,
+            shuffle=shuffle,
+        )
+
+    reg.net = reg.build_net(len(reg.get_pred()))
+    reg.train_loop(
+        loader(train, True), loader(val, False), data.y[val], np.max(data.y[train])
+    )
+
+    reg.save(model_path)
+
+    results = reg.predict(loader(test, False))
+    prediction = np.asarray([pred for pred, _ in results]).reshape(-1)
+    y_test = data.y[test]
+    return {
+        "fold": fold,
+        "train": len(train),
+        "val": len(val),
+        "test": len(test),
+        "epochs": len(reg.history["rmse_val_by_epoch"]),
+        "rmse": float(np.sqrt(mean_squared_error(y_test, prediction))),
+        "mae": float(mean_absolute_error(y_test, prediction)),
+        "seconds": time.time() - start,
+        "index": test,
+        "prediction": prediction,
+    }
+
+
+def errors_by_time_range(predictions):
+    rows = []
+    for name, group in predictions.groupby("time_range", sort=False):
+        rows.append(
+            {
+                "time_range": name,
+                "n": len(group),
+                "rmse": np.sqrt(mean_squared_error(group["time"], group["prediction"])),
+                "mae": mean_absolute_error(group["time"], group["prediction"]),
+                "mean_error": (group["prediction"] - group["time"]).mean(),
+            }
+        )
+    order = list(data_preprocessing.TIME_RANGES) + ["0"]
+    return pd.DataFrame(rows).sort_values(
+        "time_range", key=lambda names: names.map(order.index)
+    )
+
+
+def cross_validate(
+    data,
+    output_path,
+    n_folds=5,
+    processes=None,
+    config=None,
+    val_rate=0.2,
+    seed=0,
+    verbose=False,
+):
+    """
+    K-fold cross-validation of NeoRegression over data of featurize.
+    :param config: hyperparameters of the model, as best_config.json of
+    hyperparameter_search.
+    :return: dict with the summary and the DataFrames by fold, by time range and
+    of the out of fold predictions, also written in output_path.
+    """
+    if processes is None:
+        processes = min(n_folds, os.cpu_count() or 1)
+    threads = max(1, (os.cpu_count() or 1) // processes)
+    os.makedirs(output_path, exist_ok=True)
+    folds = stratified_folds(data.y, n_folds, seed)
+
+    results = []
+    method = "fork" if "fork" in mp.get_all_start_methods() else "spawn"
+    # A new process by fold releases its memory when the fold is done
+    with mp.get_context(method).Pool(
+        processes,
+        initializer=_init_worker,
+        initargs=(data, threads),
+        maxtasksperchild=1,
+    ) as pool:
+        jobs = [
+            pool.apply_async(
+                run_fold,
+                (fold, folds, output_path, config, val_rate, seed, verbose),
+            )
+            for fold in range(n_folds)
+        ]
+        for job in jobs:
+            result = job.get()
+            print(
+                "{} Fold {}: RMSE {:.4f}, MAE {:.4f} ({} epochs, {:.1f}s)".format(
+                    datetime.datetime.now(),
+                    result["fold"],
+                    result["rmse"],
+                    result["mae"],
+                    result["epochs"],
+                    result["seconds"],
+                )
+            )
+            results.append(result)
+
+    by_fold = pd.DataFrame(
+        [
+            {k: v for k, v in result.items() if k not in ("index", "prediction")}
+            for result in results
+        ]
+    )
+    index = np.concatenate([result["index"] for result in results])
+    predictions = pd.DataFrame(
+        {
+            "row": data.rows[index],
+            "fold": folds[index],
+            "time": data.y[index],
+            "prediction": np.concatenate([result["prediction"] for result in results]),
+        }
+    ).sort_values("row")
+    predictions["time_range"] = time_range_names(predictions["time"].values)
+    by_time_range = errors_by_time_range(predictions)
+    summary = {
+        "folds": n_folds,
+        "rmse_mean": by_fold["rmse"].mean(),
+        "rmse_std": by_fold["rmse"].std(ddof=0),
+        "mae_mean": by_fold["mae"].mean(),
+        "mae_std": by_fold["mae"].std(ddof=0),
+        "config": config,
+    }
+
+    by_fold.to_csv(osp.join(output_path, "folds.csv"), index=False)
+    by_time_range.to_csv(osp.join(output_path, "time_ranges.csv"), index=False)
+    predictions.to_csv(osp.join(output_path, "predictions.csv"), index=False)
+    with open(osp.join(output_path, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    print(
+        "RMSE {:.4f} +- {:.4f}, MAE {:.4f} +- {:.4f}".format(
+            summary["rmse_mean"],
+            summary["rmse_std"],
+            summary["mae_mean"],
+            summary["mae_std"],
+        )
+    )
+    return {
+        "summary": summary,
+        "folds": by_fold,
+        "time_ranges": by_time_range,
+        "predictions": predictions,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="K-fold cross-validation of NeoRegression"
+    )
+    parser.add_argument(
+        "--data-dir", dest="data_dir", help="Where is the data stored", required=True
+    )
+    parser.add_argument(
+        "--output-dir",
+        dest="output_dir",
+        help="Where to store the results of the folds",
+        required=True,
+    )
+    parser.add_argument(
+        "--data-file",
+        dest="data_file",
+        default="ds_train_val.csv",
+        help="csv of the data dir to cross validate",
+    )
+    parser.add_argument("--seed", dest="seed", default=0, type=int)
+    parser.add_argument("--val-rate", dest="val_rate", default=0.2, type=float)
+    parser.add_argument("--folds", dest="folds", default=5, type=int)
+    parser.add_argument(
+        "--processes", dest="processes", default=None, type=int, help="default: folds"
+    )
+    parser.add_argument(
+        "--config",
+        dest="config",
+        default=None,
+        help="json file with hyperparameters, as best_config.json",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    ds = pd.read_csv(
+        osp.join(args.data_dir, args.data_file), delimiter="ᶶ", engine="python"
+    )
+    # Same threshold as prepare_datasets
+    ds = ds[ds["time"] <= 65]
+    config = None
+    if args.config is not None:
+        with open(args.config) as f:
+            config = json.load(f)
+    output = osp.join(args.output_dir, datetime.datetime.now().strftime("%Y%m%d%H%M%S"))
+    cross_validate(
+        featurize(ds),
+        output,
+        n_folds=args.folds,
+        processes=args.processes,
+        config=config,
+        val_rate=args.val_rate,
+        seed=args.seed,
+    )
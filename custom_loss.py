@@ -1,30 +1,44 @@
+"""
+Regression losses of the models, computed on the scaled targets (log1p then
+min max scaling, see BaseRegression.pipeline).
+
+Every loss is an elementwise error optionally weighted by threshold: the
+examples predicted over threshold weigh weight_factor, as CustomMSELoss did.
+The weights are a scalar torch.where, no tensor of ones is built nor copied to
+the device. With compile=True the elementwise ops are fused by torch.compile.
+
+    loss_fn = make_loss({"func": "huber", "delta": 0.1, "threshold": 0.8,
+                         "weight_factor": 2})
+    loss_fn = make_loss("qerror", log_scale=1 / scaler.scale_[0])
+"""
+
+import math
 import warnings
+
 import torch
+import torch.nn.functional as F
 from torch import Tensor
-from torch.nn import MSELoss
+from torch.nn import MSELoss, Module
 
 
-class CustomMSELoss(MSELoss):
+class WeightedLoss(Module):
+    """Mean (or sum, or none) of errors, weighted by threshold if given"""
 
     __constants__ = ["reduction"]
 
-    def __init__(
-        self,
-        threshold,
-        weight_factor,
-        size_average=None,
-        reduce=None,
-        reduction: str = "mean",
-        CUDA=False,
-    ) -> None:
-        super(CustomMSELoss, self).__init__(size_average, reduce, reduction)
+    def __init__(self, threshold=None, weight_factor=1.0, reduction="mean"):
+        super().__init__()
+        if reduction not in ("mean", "sum", "none"):
+            raise ValueError("Unknown reduction: " + reduction)
         self.threshold = threshold
-        self.weight_factor = (weight_factor,)
-        self.CUDA = CUDA
+        self.weight_factor = float(weight_factor)
+        self.reduction = reduction
 
-    def mse_loss(self, input, target, size_average=None, reduce=None, reduction="mean"):
+    def errors(self, input, target):
+        raise NotImplementedError
 
-        if not (target.size() == input.size()):
+    def forward(self, input: Tensor, target: Tensor) -> Tensor:
+        if target.size() != input.size():
             warnings.warn(
                 "Using a target size ({}) that is different to the input size ({}). "
                 "This will likely lead to incorrect results due to broadcasting. "
@@ -33,22 +47,118 @@ class CustomMSELoss(MSELoss):
                 ),
                 stacklevel=2,
             )
+        errors = self.errors(input, target)
+        if self.threshold is not None and self.weight_factor != 1.0:
+            errors = torch.where(
+                input <= self.threshold, errors, errors * self.weight_factor
+            )
+        if self.reduction == "mean":
+            return errors.mean()
+        if self.reduction == "sum":
+            return errors.sum()
+        return errors
 
-        expanded_input, expanded_target = torch.broadcast_tensors(input, target)
-        """Get vector of weights to apply, for each example if greater than  threshold apply factor weight_factor"""
-        weights = torch.ones(expanded_input.size())
-        if self.CUDA:
-            weights = weights.cuda()
-        expanded_input_threshold = expanded_input <= self.threshold
-        weights = torch.where(
-            expanded_input_threshold, weights, weights * self.weight_factor
-        )
-        return self.weighted_mse_loss(input, target, weights)
 
-    def weighted_mse_loss(self, input, target, weight):
-        return torch.mean(weight * ((input - target) ** 2))
+class CustomMSELoss(WeightedLoss):
+    """MSE with the examples predicted over threshold weighted by weight_factor"""
 
-    def forward(self, input: Tensor, target: Tensor) -> Tensor:
+    def __init__(
+        self,
+        threshold,
+        weight_factor=1.0,
+        size_average=None,
+        reduce=None,
+        reduction: str = "mean",
+        CUDA=False,
+    ) -> None:
+        # size_average, reduce and CUDA are kept for compatibility, the weights
+        # are on the device of the input
+        super().__init__(threshold, weight_factor, reduction)
+
+    def errors(self, input, target):
+        diff = input - target
+        return diff * diff
+
+
+class HuberLoss(WeightedLoss):
+    """Squared error under delta, linear over it"""
+
+    def __init__(self, delta=1.0, threshold=None, weight_factor=1.0, reduction="mean"):
+        super().__init__(threshold, weight_factor, reduction)
+        self.delta = delta
+
+    def errors(self, input, target):
+        return F.huber_loss(input, target, reduction="none", delta=self.delta)
+
+
+class LogCoshLoss(WeightedLoss):
+    """log(cosh(error)), computed without overflow as |x| + softplus(-2|x|) - log 2"""
+
+    def errors(self, input, target):
+        diff = (input - target).abs()
+        return diff + F.softplus(-2 * diff) - math.log(2.0)
 
-        loss = self.mse_loss(input, target, reduction=self.reduction)
-        return loss
+
+class QErrorLoss(WeightedLoss):
+    """
+    q-error max(pred / real, real / pred) of 1 + latency. On log targets it is
+    exp(|input - target| * log_scale), log_scale undoes the scaling of the log,
+    1 / MinMaxScaler.scale_ of the pipeline. The exponent is clamped at
+    max_log so early predictions don't overflow.
+    """
+
+    def __init__(
+        self,
+        log_scale=1.0,
+        max_log=20.0,
+        threshold=None,
+        weight_factor=1.0,
+        reduction="mean",
+    ):
+        super().__init__(threshold, weight_factor, reduction)
+        self.log_scale = float(log_scale)
+        self.max_log = max_log
+
+    def errors(self, input, target):
+        log_q = (input - target).abs() * self.log_scale
+        return log_q.clamp(max=self.max_log).exp()
+
+
+LOSSES = {
+    "mse": CustomMSELoss,
+    "CustomMSELoss": CustomMSELoss,
+    "huber": HuberLoss,
+    "logcosh": LogCoshLoss,
+    "qerror": QErrorLoss,
+}
+
+
+def make_loss(config=None, log_scale=None):
+    """
+    Loss of a model configuration: None or "mse" for torch MSELoss, a name of
+    LOSSES, or a dict with the name in "func" and the arguments of the loss,
+    "compile": True to torch.compile it.
+    :param log_scale: 1 / scale of the log targets, given to QErrorLoss.
+    """
+    if config is None:
+        config = "mse"
+    if isinstance(config, str):
+        config = {"func": config}
+    config = dict(config)
+    name = config.pop("func")
+    compile_loss = config.pop("compile", False)
+    if name not in LOSSES:
+        raise ValueError(
+            "Unknown loss {}, one of {}".format(name, ", ".join(sorted(LOSSES)))
+        )
+    if name == "mse" and not config:
+        loss = MSELoss()
+    elif name in ("mse", "CustomMSELoss"):
+        loss = CustomMSELoss(config.pop("threshold", None), **config)
+    else:
+        if LOSSES[name] is QErrorLoss and log_scale is not None:
+            config.setdefault("log_scale", log_scale)
+        loss = LOSSES[name](**config)
+    if compile_loss:
+        return torch.compile(loss)
+    return loss
@@ -2,11 +2,14 @@ import datetime
 import logging
 import os
 
-from sklearn.model_selection import train_test_split
+import numpy as np
 import pandas as pd
 import os.path as osp
 import json
 
+# Kept here for the code that imports them from data_preprocessing
+from transforms import CardinalityEncoder, query_card_matrix
+
 LIST_QUERY_COLUMNS = [
     "filter_bound",
     "filter_contains",
@@ -47,24 +50,39 @@ def concat_dataframes(df1, df2):
     return pd.concat([df1, df2], axis=1)
 
 
+# Ranges of the execution time (low, high] in seconds that stratify the splits
+TIME_RANGES = {
+    "1_2": (0, 2),
+    "2_3": (2, 3),
+    "3_4": (3, 4),
+    "4_5": (4, 5),
+    "5_8": (5, 8),
+    "8_10": (8, 10),
+    "10_20": (10, 20),
+    "20_30": (20, 30),
+    "30_40": (30, 40),
+    "40_50": (40, 50),
+    "50_60": (50, 60),
+    "60_80": (60, 80),
+    "80_100": (80, 100),
+    "100_150": (100, 150),
+    "150_last": (150, np.inf),
+}
+
+
+def time_range_index(times):
+    """Index of the range of TIME_RANGES of every time, -1 for times <= 0"""
+    lows = [low for low, _ in TIME_RANGES.values()]
+    return np.searchsorted(lows, np.asarray(times, dtype=np.float64), side="left") - 1
+
+
 def split_train_data(all_data: pd.DataFrame, val_rate: float, seed: int):
+    # sklearn is only needed to split the data, not to predict
+    from sklearn.model_selection import train_test_split
 
     ranges = {
-        "1_2": all_data[(all_data["time"] > 0) & (all_data["time"] <= 2)],
-        "2_3": all_data[(all_data["time"] > 2) & (all_data["time"] <= 3)],
-        "3_4": all_data[(all_data["time"] > 3) & (all_data["time"] <= 4)],
-        "4_5": all_data[(all_data["time"] > 4) & (all_data["time"] <= 5)],
-        "5_8": all_data[(all_data["time"] > 5) & (all_data["time"] <= 8)],
-        "8_10": all_data[(all_data["time"] > 8) & (all_data["time"] <= 10)],
-        "10_20": all_data[(all_data["time"] > 10) & (all_data["time"] <= 20)],
-        "20_30": all_data[(all_data["time"] > 20) & (all_data["time"] <= 30)],
-        "30_40": all_data[(all_data["time"] > 30) & (all_data["time"] <= 40)],
-        "40_50": all_data[(all_data["time"] > 40) & (all_data["time"] <= 50)],
-        "50_60": all_data[(all_data["time"] > 50) & (all_data["time"] <= 60)],
-        "60_80": all_data[(all_data["time"] > 60) & (all_data["time"] <= 80)],
-        "80_100": all_data[(all_data["time"] > 80) & (all_data["time"] <= 100)],
-        "100_150": all_data[(all_data["time"] > 100) & (all_data["time"] <= 150)],
-        "150_last": all_data[(all_data["time"] > 150)],
+        name: all_data[(all_data["time"] > low) & (all_data["time"] <= high)]
+        for name, (low, high) in TIME_RANGES.items()
     }
     train_data = []
     val_data = []
@@ -0,0 +1,118 @@
+"""
+Dense baseline data as float32 tensors assembled once.
+
+The rows of DenseRegression are the scaled query features, with the
+cardinalities of the predicates as a dict of predicate index to cardinality in
+the last column when encode_cardinalities (see pred2index_dict). DenseDataset
+stacks the features and the cardinality block in one float32 matrix, filters
+the targets out of range and keeps both on the device; the batches of an epoch
+are slices of a torch.randperm, so an epoch costs the forward and backward
+passes only.
+
+    dataset = DenseDataset.from_queries(X_query, y, num_preds=len(preds2index))
+    for query_data, target in dataset.batches(256, shuffle=True):
+        ...
+"""
+
+import itertools
+
+import numpy as np
+import torch
+from scipy import sparse
+from torch.utils.data import TensorDataset
+
+
+def dense_features(X_query, num_preds=None):
+    """
+    float32 matrix of the rows of X_query. With num_preds the last column holds
+    the cardinality dicts, expanded in a block of num_preds columns.
+    """
+    X_query = getattr(X_query, "values", X_query)
+    if num_preds is None:
+        return np.asarray(X_query, dtype=np.float32)
+    rows = list(X_query)
+    query = np.asarray([row[:-1] for row in rows], dtype=np.float32).reshape(
+        len(rows), -1
+    )
+    cards = [row[-1] for row in rows]
+    lengths = np.fromiter(map(len, cards), dtype=np.int64, count=len(cards))
+    total = int(lengths.sum())
+    indices = np.fromiter(
+        itertools.chain.from_iterable(card.keys() for card in cards),
+        dtype=np.int64,
+        count=total,
+    )
+    values = np.fromiter(
+        itertools.chain.from_iterable(card.values() for card in cards),
+        dtype=np.float32,
+        count=total,
+    )
+    block = sparse.csr_matrix(
+        (values, indices, np.concatenate(([0], np.cumsum(lengths)))),
+        shape=(len(cards), num_preds),
+    )
+    return np.hstack([query, block.toarray()])
+
+
+class DenseDataset(TensorDataset):
+    """TensorDataset of the features and the targets of the dense baseline"""
+
+    def __init__(self, features, targets, device=None):
+        super().__init__(
+            torch.as_tensor(features, dtype=torch.float32, device=device),
+            torch.as_tensor(targets, dtype=torch.float32, device=device).reshape(-1, 1),
+        )
+
+    @classmethod
+    def from_queries(
+        cls, X_query, y, num_preds=None, target_range=None, cards=None, device=None
+    ):
+        """
+        :param num_preds: size of the cardinality block, see dense_features.
+        :param target_range: (low, high), rows with y <= low or y > high are
+        dropped, as DenseRegression.collate did.
+        :param cards: sparse cardinality block (see CardinalityEncoder) stacked
+        after the features, instead of the dicts of the last column.
+        """
+        if cards is None:
+            features = dense_features(X_query, num_preds)
+        else:
+            features = np.hstack(
+                [np.asarray(X_query, dtype=np.float32), cards.toarray()]
+            ).astype(np.float32)
+        y = np.asarray(y, dtype=np.float32).reshape(-1)
+        if target_range is not None:
+            low, high = target_range
+            keep = (y > low) & (y <= high)
+            if not keep.all():
+                print("Targets out of range dropped: {}".format(int((~keep).sum())))
+            features, y = features[keep], y[keep]
+        return cls(features, y, device=device)
+
+    @property
+    def features(self):
+        return self.tensors[0]
+
+    @property
+    def targets(self):
+        return self.tensors[1]
+
+    @property
+    def device(self):
+        return self.features.device
+
+    def to(self, device):
+        return DenseDataset(self.features.to(device), self.targets.to(device))
+
+    def num_batches(self, batch_size):
+        return -(-len(self) // batch_size)
+
+    def batches(self, batch_size, shuffle=False, generator=None):
+        """(features, targets) slices, shuffled on the device of the tensors"""
+        features, targets = self.tensors
+        if shuffle:
+            order = torch.randperm(len(self), device=self.device, generator=generator)
+            features, targets = features[order], targets[order]
+        for start in range(0, len(self), batch_size):
+            end = start + batch_size
+            yield features[start:end], targets[start:end]
@@ -0,0 +1,111 @@
+"""
+Data parallel training on CPU processes with the gloo backend.
+
+Processes are started on the local machine with ``spawn`` or by ``torchrun``
+(one or several nodes), which sets RANK, WORLD_SIZE, MASTER_ADDR and
+MASTER_PORT, see ``setup_from_env``. Models built with ``distributed=True``
+shard their dataloaders with a DistributedSampler and train through
+DistributedDataParallel, rank 0 coordinates early stopping and saves the
+checkpoints, see BaseRegression.train_loop.
+"""
+
+import os
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def setup(rank, world_size, master_addr="127.0.0.1", master_port=29500, threads=None):
+    """
+    Join the process group. CPU threads are split between the local processes,
+    threads by process default to cpu_count // world_size.
+    """
+    os.environ["MASTER_ADDR"] = master_addr
+    os.environ["MASTER_PORT"] = str(master_port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // local_world_size)
+    torch.set_num_threads(threads)
+
+
+def setup_from_env(threads=None):
+    """Join the process group described by the torchrun environment, if any"""
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size <= 1:
+        return False
+    setup(
+        int(os.environ["RANK"]),
+        world_size,
+        os.environ.get("MASTER_ADDR", "127.0.0.1"),
+        int(os.environ.get("MASTER_PORT", 29500)),
+        threads=threads,
+    )
+    return True
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def _worker(rank, world_size, master_port, fn, args):
+    setup(rank, world_size, master_port=master_port)
+    try:
+        fn(*args)
+    finally:
+        cleanup()
+
+
+def spawn(fn, world_size, *args):
+    """Run fn(*args) in world_size local processes joined in a gloo group"""
+    mp.spawn(
+        _worker, args=(world_size, free_port(), fn, args), nprocs=world_size, join=True
+    )
+
+
+def broadcast_object(obj, src=0):
+    """obj of rank src in every rank"""
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def all_gather_list(values):
+    """Concatenation of the lists of every rank, in rank order"""
+    if not is_distributed():
+        return list(values)
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, list(values))
+    return [value for rank_values in gathered for value in rank_values]
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
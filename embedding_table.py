@@ -0,0 +1,157 @@
+"""
+Table of the autoencoder embeddings of the distinct nodes, for the AEC
+regression.
+
+The encoder of the autoencoder is frozen once trained, so the embedding of a
+node depends only on its predicates. A NodeEmbeddingTable encodes every
+distinct predicate set of the trees once, gives the nodes of every PackedTree
+the row of their set (PackedTree.node_ids) and the regression reads the node
+features from the table instead of running the encoder in every epoch. The
+embeddings can be kept in a memory mapped .npy file for large vocabularies.
+Nodes with predicate sets the table has not seen are encoded on the fly.
+
+    table = NodeEmbeddingTable.build(trees, reg.aec_net.encoder, 18, path="emb.npy")
+    reg.set_embedding_table(table)
+"""
+
+import numpy as np
+import torch
+
+from net import EmbeddingBagEncoder
+
+
+class NodeEmbeddingTable:
+    def __init__(self, keys, embeddings, ignore_first=18):
+        """
+        :param keys: dict of the key of a predicate set (see node_keys) to its row.
+        :param embeddings: array, one embedding by row, can be a memmap.
+        :param ignore_first: the first indexes of the nodes are not predicates.
+        """
+        self.keys = keys
+        self.embeddings = embeddings
+        self.ignore_first = ignore_first
+        # node_ids of the trees are only valid for the table that assigned them
+        self._token = object()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def node_keys(self, tree):
+        """Keys of the predicate sets of the nodes of a PackedTree"""
+        keys = []
+        for start, end in zip(tree.indptr[:-1], tree.indptr[1:]):
+            preds = tree.indices[start:end]
+            keys.append(np.sort(preds[preds >= self.ignore_first]).tobytes())
+        return keys
+
+    def node_ids(self, tree):
+        """Rows of the nodes of a PackedTree, -1 for the sets not in the table"""
+        if tree.node_ids is None or tree.node_ids[0] is not self._token:
+            ids = np.fromiter(
+                (self.keys.get(key, -1) for key in self.node_keys(tree)),
+                dtype=np.int64,
+                count=len(tree),
+            )
+            tree.node_ids = (self._token, ids)
+        return tree.node_ids[1]
+
+    @classmethod
+    def build(cls, trees, encoder, ignore_first=18, path=None, batch_size=4096):
+        """
+        Table of the predicate sets of the nodes of PackedTrees, encoded by
+        encoder. The nodes of the trees get their rows.
+        :param path: .npy file of the embeddings, mapped in memory. In memory if
+        None.
+        """
+        table = cls({}, None, ignore_first)
+        sets = []
+        for tree in trees:
+            ids = np.empty(len(tree), dtype=np.int64)
+            for i, key in enumerate(table.node_keys(tree)):
+                row = table.keys.get(key)
+                if row is None:
+                    row = table.keys[key] = len(sets)
+                    sets.append(np.frombuffer(key, dtype=np.int64))
+                ids[i] = row
+            tree.node_ids = (table._token, ids)
+
+        device = next(encoder.parameters()).device
+        with torch.no_grad():
+            hidden = encoder(*_encoder_input(sets[:1], ignore_first, encoder, device))
+        shape = (len(sets), hidden.shape[1])
+        if path is None:
+            table.embeddings = np.empty(shape, dtype=np.float32)
+        else:
+            table.embeddings = np.lib.format.open_memmap(
+                path, mode="w+", dtype=np.float32, shape=shape
+            )
+        for start in range(0, len(sets), batch_size):
+            batch = sets[start : start + batch_size]
+            with torch.no_grad():
+                hidden = encoder(*_encoder_input(batch, ignore_first, encoder, device))
+            table.embeddings[start : start + len(batch)] = hidden.cpu().numpy()
+        if path is not None:
+            table.embeddings.flush()
+        return table
+
+    def lookup(self, trees, encoder):
+        """
+        Embeddings of the nodes of PackedTrees in order, the sets missing from
+        the table encoded by encoder.
+        """
+        ids = np.concatenate([self.node_ids(tree) for tree in trees])
+        features = np.asarray(self.embeddings[np.maximum(ids, 0)])
+        missing = np.flatnonzero(ids < 0)
+        if len(missing):
+            keys = [key for tree in trees for key in self.node_keys(tree)]
+            sets = [np.frombuffer(keys[i], dtype=np.int64) for i in missing]
+            device = next(encoder.parameters()).device
+            with torch.no_grad():
+                hidden = encoder(
+                    *_encoder_input(sets, self.ignore_first, encoder, device)
+                )
+            features[missing] = hidden.cpu().numpy()
+        return features
+
+    def save(self, path):
+        """Embeddings in path.npy and the predicate sets in path.keys.npz"""
+        np.save(path + ".npy", np.asarray(self.embeddings))
+        sets = sorted(self.keys.items(), key=lambda item: item[1])
+        lengths = [len(key) // 8 for key, _ in sets]
+        indptr = np.zeros(len(sets) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        indices = np.frombuffer(b"".join(key for key, _ in sets), dtype=np.int64)
+        np.savez(
+            path + ".keys.npz",
+            indptr=indptr,
+            indices=indices,
+            ignore_first=self.ignore_first,
+        )
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        keys = np.load(path + ".keys.npz")
+        indptr, indices = keys["indptr"], keys["indices"]
+        table = {
+            indices[start:end].tobytes(): row
+            for row, (start, end) in enumerate(zip(indptr[:-1], indptr[1:]))
+        }
+        embeddings = np.load(path + ".npy", mmap_mode="r" if mmap else None)
+        return cls(table, embeddings, int(keys["ignore_first"]))
+
+
+def _encoder_input(sets, ignore_first, encoder, device):
+    """Input of encoder for predicate sets, indexes for an EmbeddingBagEncoder"""
+    lengths = np.fromiter(map(len, sets), dtype=np.int64, count=len(sets))
+    indices = np.concatenate(sets) - ignore_first if sets else np.zeros(0, np.int64)
+    if isinstance(encoder, EmbeddingBagEncoder):
+        offsets = np.zeros(len(sets), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+        return (
+            torch.from_numpy(indices).to(device),
+            torch.from_numpy(offsets).to(device),
+        )
+    io_dim = encoder[0].in_features
+    onehot = np.zeros((len(sets), io_dim), dtype=np.float32)
+    np.add.at(onehot, (np.repeat(np.arange(len(sets)), lengths), indices), 1)
+    return (torch.from_numpy(onehot).to(device),)
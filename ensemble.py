@@ -0,0 +1,169 @@
+"""
+Ensemble inference over several NeoRegression models, like the models of the
+folds of cross_validation.
+
+The members share the featurizer, so the input is parsed, packed, collated and
+prepared (prepare_trees) once by batch and every member runs on the same
+trees, see NeoNet.prepare and NeoNet.forward_prepared. The query features are
+built by member, with its own cardinality encoder and query scaler, so the
+models of different folds can be members. With stacked=True the weights of
+members with the same architecture are stacked once and run in one vmapped
+call, on CPU running the members one after the other is faster.
+
+    ensemble = EnsemblePredictor([reg_fold0, reg_fold1, reg_fold2])
+    mean, variance, members = ensemble.predict_raw_data(trees, queries, cards)
+"""
+
+import copy
+from functools import partial
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.func import functional_call, stack_module_state, vmap
+from torch.utils.data import DataLoader
+
+
+class _PreparedForward(nn.Module):
+    """Module with the forward of NeoNet.forward_prepared, for functional_call"""
+
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, flat_trees, indexes, query_data):
+        return self.net.forward_prepared((flat_trees, indexes), query_data)
+
+
+def _same_weights(net, other):
+    """Both nets None, or with equal weights"""
+    if net is None or other is None:
+        return net is other
+    state, other_state = net.state_dict(), other.state_dict()
+    return state.keys() == other_state.keys() and all(
+        torch.equal(value, other_state[name]) for name, value in state.items()
+    )
+
+
+class EnsemblePredictor:
+    def __init__(self, members, stacked=False):
+        """
+        :param members: fitted regressors with NeoNet nets, the same featurizer
+        and the same autoencoder, if any. Every member keeps its own cardinality
+        encoder, query scaler and target transformer.
+        :param stacked: run the members in one vmapped call when their weights
+        have the same shapes, one after the other otherwise. Weights are stacked
+        on the first prediction.
+        """
+        if not members:
+            raise ValueError("An ensemble needs at least one member")
+        self.members = members
+        first = members[0]
+        for member in members[1:]:
+            if member.get_pred() != first.get_pred():
+                raise ValueError("Members of an ensemble must share the featurizer")
+            if not _same_weights(member.aec_net, first.aec_net):
+                raise ValueError("Members of an ensemble must share the autoencoder")
+        self.stacked = stacked and self._same_architecture()
+        self._params = None
+
+    def __len__(self):
+        return len(self.members)
+
+    def _same_architecture(self):
+        shapes = [
+            [(name, value.shape) for name, value in member.net.state_dict().items()]
+            for member in self.members
+        ]
+        return all(shape == shapes[0] for shape in shapes[1:])
+
+    def _stack(self):
+        modules = [_PreparedForward(member.net) for member in self.members]
+        params, buffers = stack_module_state(modules)
+        base = copy.deepcopy(modules[0]).to("meta")
+
+        def call(params, buffers, flat_trees, indexes, query_data):
+            return functional_call(
+                base, (params, buffers), (flat_trees, indexes, query_data)
+            )
+
+        self._params = (params, buffers)
+        self._call = vmap(call, in_dims=(0, 0, None, None, 0))
+
+    def collate(self, x, features):
+        """
+        Batch of (packed tree, row) pairs as the flat trees and the query
+        features of every member, features has the features of every member.
+        """
+        first = self.members[0]
+        trees, rows = zip(*x)
+        trees = first.packed2flat(trees, len(first.get_pred()))
+        rows = list(rows)
+        return trees, [member_features[rows].toarray() for member_features in features]
+
+    def forward(self, x):
+        """Outputs of every member for a batch of collate, members x batch x 1"""
+        flat_trees, queries = x
+        trees, query_data = self.members[0].net.prepare(
+            list(zip(flat_trees, queries[0]))
+        )
+        query_data = [query_data] + [
+            torch.from_numpy(query).to(query_data.dtype).to(query_data.device)
+            for query in queries[1:]
+        ]
+        if not self.stacked:
+            return torch.stack(
+                [
+                    member.net.forward_prepared(trees, query)
+                    for member, query in zip(self.members, query_data)
+                ]
+            )
+        if self._params is None:
+            self._stack()
+        params, buffers = self._params
+        return self._call(params, buffers, trees[0], trees[1], torch.stack(query_data))
+
+    def predict_raw_data(self, trees, queries, cards=None, batch_size=128):
+        """
+        Predict raw data as BaseRegression.predict_raw_data, featurizing the
+        trees once for all the members.
+        :param cards: encoded cardinalities, only when the members have the same
+        cardinality encoder. If None every member encodes the json cardinalities
+        of the last column of queries.
+        :return: mean and variance of the members' predictions, and the
+        predictions of every member as a members x rows matrix.
+        """
+        first = self.members[0]
+        if (
+            cards is not None
+            and len({member.maxcardinality for member in self.members}) > 1
+        ):
+            raise ValueError(
+                "The members encode cardinalities differently, pass them as json"
+            )
+        features = [member.query_features(queries, cards) for member in self.members]
+        trees, rows, _ = first.json_loads(
+            trees, np.arange(len(queries)), [None for _ in range(len(queries))]
+        )
+        trees = first.tree_transform.transform_packed(trees)
+        dataloader = DataLoader(
+            list(zip(trees, rows)),
+            batch_size=batch_size,
+            shuffle=False,
+            collate_fn=partial(self.collate, features=features),
+        )
+        for member in self.members:
+            member.net.eval()
+        outputs = []
+        with torch.no_grad():
+            for x in dataloader:
+                outputs.append(self.forward(x).cpu().numpy())
+        outputs = np.concatenate(outputs, axis=1)
+
+        predictions = np.stack(
+            [
+                member.pipeline.inverse_transform(output).reshape(-1)
+                for member, output in zip(self.members, outputs)
+            ]
+        )
+        return predictions.mean(axis=0), predictions.var(axis=0), predictions
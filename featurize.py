@@ -5,14 +5,66 @@ LEAF_TYPES = ["Seq Scan", "Index Scan", "Index Only Scan", "Bitmap Index Scan"]
 ALL_TYPES = JOIN_TYPES + LEAF_TYPES
 
 
+def map_tree(tree, is_subtree, fn):
+    """
+    Iterative map over a nested tree: elements where is_subtree is True are
+    walked, fn is applied to the rest. Returns the same structure as tuples.
+    """
+    stack = [(iter(tree), [], None, 0)]
+    while True:
+        elements, resp, parent, pos = stack[-1]
+        for el in elements:
+            if is_subtree(el):
+                stack.append((iter(el), [], resp, len(resp)))
+                resp.append(None)
+                break
+            resp.append(fn(el))
+        else:
+            stack.pop()
+            if parent is None:
+                return tuple(resp)
+            parent[pos] = tuple(resp)
+
+
+def bits_to_indexes(bits):
+    """Positions of the bits set in a python int, ascending"""
+    if not bits:
+        return []
+    data = np.frombuffer(
+        bits.to_bytes((bits.bit_length() + 7) // 8, "little"), np.uint8
+    )
+    return np.flatnonzero(np.unpackbits(data, bitorder="little")).tolist()
+
+
+class PackedTree:
+    """
+    Tree encoded in preorder. The indexes of node i are
+    indices[indptr[i]:indptr[i + 1]] and conv_indexes are the tree convolution
+    indexes, see TreeConvolution.util._tree_conv_indexes. node_ids keeps the
+    rows of the nodes in a NodeEmbeddingTable, see NodeEmbeddingTable.node_ids.
+    """
+
+    __slots__ = ("indptr", "indices", "conv_indexes", "node_ids")
+
+    def __init__(self, indptr, indices, conv_indexes):
+        self.indptr = indptr
+        self.indices = indices
+        self.conv_indexes = conv_indexes
+        self.node_ids = None
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+
 class SparqlTreeBuilder:
-    def __init__(self, preds_map, preds_to_index):
+    def __init__(self, preds_map, preds_to_index, frozen=False):
+        # Frozen builders record neither the autoencoder samples nor unknown tokens
+        self.frozen = frozen
         self.__preds_map = preds_map
         self.__preds_to_index = preds_to_index
-        self.__index_to_preds = {
-            index: pred for (pred, index) in preds_to_index.items()
-        }
         self.lista_samples_aec = []
+        # Tokens encoded as OTHER_TPF or OTHER_PRED by encode_tree
+        self.unknown_tokens = {}
 
     def lista_samples_aec_ds(self):
         return self.lista_samples_aec
@@ -21,14 +73,11 @@ class SparqlTreeBuilder:
         """
         Extraer dado un tree en forma de lista los predicados.
         """
-        lista = listaorg.copy()
-        for i in range(len(lista)):
-            if type(lista[i]) == str:
-                # Split by symbol to get list of tokens
-                lista[i] = self.get_index_seq(lista[i])
-            elif type(lista[i]) == list:
-                lista[i] = self.preds2onehot_tree(lista[i])
-        return tuple(lista)
+        return map_tree(
+            listaorg,
+            lambda el: type(el) == list,
+            lambda el: self.get_index_seq(el) if type(el) == str else el,
+        )
 
     def get_index_seq(self, cadena):
         row = []
@@ -92,6 +141,101 @@ class SparqlTreeBuilder:
     def codificar_tree(self, tree):
         return self.preds2onehot_tree(tree)
 
+    def encode_tree(self, tree):
+        """
+        Encode a json tree in one iterative pass. Join nodes without predicates
+        get the predicates of their childs, as BaseRegression.fix_tree, nodes are
+        encoded as get_index_seq and numbered in preorder.
+        The predicates of the joins are merged bottom up as bitsets (python int)
+        over the vocabulary, no label is built. Unlike fix_tree, distinct unknown
+        predicates under a join count once, as the OTHER_PRED bit.
+        :return: PackedTree
+        """
+        # Preorder walk, childs positions of every node and whether it is a join
+        # to fix. As fix_tree, the childs of a join already fixed are not fixed.
+        nodes = []
+        childs = []
+        to_fix = []
+        stack = [(tree, -1, 0, True)]
+        while stack:
+            node, parent, side, fix = stack.pop()
+            pos = len(nodes)
+            nodes.append(node)
+            childs.append(None)
+            to_fix.append(fix and len(node) == 3 and "ᶲ" not in node[0])
+            if parent >= 0:
+                childs[parent][side] = pos
+            if len(node) == 3:
+                childs[pos] = [0, 0]
+                stack.append((node[2], pos, 1, to_fix[pos]))
+                stack.append((node[1], pos, 0, to_fix[pos]))
+
+        # Childs come after their parent in preorder, so the bitsets of the
+        # childs are ready when walking backwards.
+        other_pred = 1 << self.__preds_to_index["OTHER_PRED"]
+        rows = [None] * len(nodes)
+        bits = [0] * len(nodes)
+        for pos in range(len(nodes) - 1, -1, -1):
+            if to_fix[pos]:
+                left, right = childs[pos]
+                # As fix_tree, a join without predicates is labeled "JOINᶲ"
+                bits[pos] = (bits[left] | bits[right]) or other_pred
+                rows[pos] = self.get_index_seq_bits(nodes[pos][0], bits[pos])
+            else:
+                rows[pos] = self.get_index_seq_tokens(nodes[pos][0].split("ᶲ"))
+                for index in rows[pos][1:]:
+                    bits[pos] |= 1 << index
+
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        indices = []
+        conv_indexes = np.zeros((len(nodes), 3), dtype=np.int64)
+        for pos, row in enumerate(rows):
+            indices.extend(row)
+            indptr[pos + 1] = len(indices)
+            conv_indexes[pos, 0] = pos + 1
+            if childs[pos] is not None:
+                conv_indexes[pos, 1] = childs[pos][0] + 1
+                conv_indexes[pos, 2] = childs[pos][1] + 1
+
+        return PackedTree(
+            indptr, np.asarray(indices, dtype=np.int64), conv_indexes.reshape(-1, 1)
+        )
+
+    def get_index_seq_bits(self, label, bits):
+        """Indexes of a join label and the predicates set in bits, in vocabulary order"""
+        if label in self.__preds_to_index:
+            row = [self.__preds_to_index[label]]
+        else:
+            self.count_unknown(label)
+            row = [self.__preds_to_index["OTHER_TPF"]]
+        row.extend(bits_to_indexes(bits))
+        if not self.frozen:
+            self.lista_samples_aec.append(row)
+        return row
+
+    def get_index_seq_tokens(self, cadena_list):
+        """As get_index_seq for a label already split, unknown tokens are counted"""
+        preds_to_index = self.__preds_to_index
+        if cadena_list[0] in preds_to_index:
+            row = [preds_to_index[cadena_list[0]]]
+        else:
+            self.count_unknown(cadena_list[0])
+            row = [preds_to_index["OTHER_TPF"]]
+        for el in cadena_list[1:]:
+            if el in preds_to_index:
+                row.append(preds_to_index[el])
+            else:
+                self.count_unknown(el)
+                row.append(preds_to_index["OTHER_PRED"])
+        if not self.frozen:
+            self.lista_samples_aec.append(row)
+        return row
+
+    def count_unknown(self, token):
+        if self.frozen:
+            return
+        self.unknown_tokens[token] = self.unknown_tokens.get(token, 0) + 1
+
 
 class SPARQLTreeFeaturizer:
     def __init__(self):
@@ -99,6 +243,34 @@ class SPARQLTreeFeaturizer:
         self.__preds_map = {}
         self.__preds_to_index = {}
 
+    @classmethod
+    def from_vocabulary(cls, preds_to_index):
+        """
+        Featurizer fitted with the predicate index of another one, a dict or the
+        Vocabulary of an artifact, which is looked up as it is.
+        """
+        featurizer = cls()
+        if isinstance(preds_to_index, dict):
+            preds_to_index = dict(preds_to_index)
+        featurizer.__preds_to_index = preds_to_index
+        featurizer.__tree_builder = SparqlTreeBuilder(
+            featurizer.__preds_map, featurizer.__preds_to_index
+        )
+        return featurizer
+
+    def frozen(self):
+        """
+        Copy of the fitted featurizer that records nothing while it transforms, so
+        it can transform from several threads at once. The vocabulary is shared.
+        """
+        featurizer = SPARQLTreeFeaturizer()
+        featurizer.__preds_map = self.__preds_map
+        featurizer.__preds_to_index = self.__preds_to_index
+        featurizer.__tree_builder = SparqlTreeBuilder(
+            self.__preds_map, self.__preds_to_index, frozen=True
+        )
+        return featurizer
+
     def get_aec_ds(self):
         return self.__tree_builder.lista_samples_aec_ds()
 
@@ -110,6 +282,7 @@ class SPARQLTreeFeaturizer:
 
     def fit(self, trees):
 
+        self._own_vocabulary()
         self.add_rest_indexes_features()
         self.extract_preds_index_map(trees)
         # stats_extractor = get_plan_stats(trees)
@@ -117,6 +290,7 @@ class SPARQLTreeFeaturizer:
 
     def fit_preds(self, train, val, test):
 
+        self._own_vocabulary()
         self.add_rest_indexes_features()
         self.extract_preds_index_map(train)
         self.extract_preds_index_map(val)
@@ -124,10 +298,19 @@ class SPARQLTreeFeaturizer:
 
         self.__tree_builder = SparqlTreeBuilder(self.__preds_map, self.__preds_to_index)
 
+    def _own_vocabulary(self):
+        # The read only Vocabulary of an artifact becomes a dict to be refitted
+        if not isinstance(self.__preds_to_index, dict):
+            self.__preds_to_index = dict(self.__preds_to_index)
+
     def transform(self, trees):
         # Select first tree
         return [self.__tree_builder.codificar_tree(x) for x in trees]
 
+    def transform_packed(self, trees):
+        """Encode json trees, not fixed, as PackedTree, see SparqlTreeBuilder.encode_tree"""
+        return [self.__tree_builder.encode_tree(x) for x in trees]
+
     def transform_with_aec(self, ds_aec, aec):
         aec.eval()
         newX = aec.encoder(ds_aec)
@@ -166,13 +349,17 @@ class SPARQLTreeFeaturizer:
         Extraer dado un tree en forma de lista los predicados.
         """
         preds_map = {}
-        for el in lista:
-            if type(el) == str:
-                upd = self.extract_preds_from_str(el)
-                preds_map.update(upd)
-            elif type(el) == list:
-                upd = self.extract_preds(el)
-                preds_map.update(upd)
+        stack = [iter(lista)]
+        while stack:
+            for el in stack[-1]:
+                if type(el) == str:
+                    upd = self.extract_preds_from_str(el)
+                    preds_map.update(upd)
+                elif type(el) == list:
+                    stack.append(iter(el))
+                    break
+            else:
+                stack.pop()
         return preds_map
 
     def extract_preds_index_map(self, trees):
@@ -0,0 +1,547 @@
+"""
+Parallel hyperparameter search of NeoRegression.
+
+The datasets are featurized once (see featurize): trees are parsed and packed
+and the query features built. The result is shared read only with a pool of
+processes, inherited on fork. Configurations are sampled at random or with a
+TPE sampler and scheduled on the validation RMSE with ASHA (asynchronous
+successive halving), synchronous successive halving or to the full budget.
+Every result updates the leaderboard of the output directory.
+
+    python hyperparameter_search.py --data-dir DATA --output-dir OUT --trials 60 --processes 16
+
+A search space maps hyperparameters (attributes of NeoRegression, plus lr) to
+a list of choices or to a distribution {"uniform" | "loguniform" | "int": [low, high]}.
+"""
+
+import argparse
+import copy
+import datetime
+import json
+import math
+import multiprocessing as mp
+import os
+import os.path as osp
+import queue
+import random
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from sklearn.metrics import mean_squared_error
+from sklearn.preprocessing import StandardScaler
+
+import data_preprocessing
+from Models.model_trees_algebra import NeoRegression
+
+DEFAULT_SPACE = {
+    "tree_units": [[256, 128, 64], [512, 256, 128], [1024, 512, 256, 128]],
+    "tree_units_dense": [[32, 28], [64, 32], [128, 64]],
+    "query_hidden_inputs": [[260, 300], [260, 380, 240], [512, 256]],
+    "query_output": [120, 240],
+    "lr": {"loguniform": [1e-5, 1e-2]},
+    "early_stop_patience": [3, 5, 10],
+}
+
+###################################################################
+
+
+def sample_param(rng, spec):
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    ((kind, (low, high)),) = spec.items()
+    if kind == "uniform":
+        return rng.uniform(low, high)
+    if kind == "loguniform":
+        return math.exp(rng.uniform(math.log(low), math.log(high)))
+    if kind == "int":
+        return rng.randint(low, high)
+    raise ValueError("Unknown distribution {}".format(kind))
+
+
+class RandomSampler:
+    def __init__(self, space, seed=0):
+        self.space = space
+        self.rng = random.Random(seed)
+
+    def sample(self):
+        return {name: sample_param(self.rng, spec) for name, spec in self.space.items()}
+
+    def tell(self, trial, config, value, rung=0):
+        pass
+
+
+class TPESampler(RandomSampler):
+    """
+    Independent Tree-structured Parzen Estimator. After n_startup random trials
+    every hyperparameter is drawn from the density of the best gamma of the
+    trials, the candidate with the highest ratio to the density of the rest wins.
+    Results are kept by rung of successive halving, RMSEs after different
+    epochs don't compare: the model is fitted on the highest rung with
+    n_startup results.
+    """
+
+    def __init__(self, space, seed=0, n_startup=8, gamma=0.25, n_candidates=24):
+        super().__init__(space, seed)
+        self.n_startup = n_startup
+        self.gamma = gamma
+        self.n_candidates = n_candidates
+        # (config, value) by trial, by rung
+        self.observations = {}
+
+    def tell(self, trial, config, value, rung=0):
+        if np.isfinite(value):
+            self.observations.setdefault(rung, {})[trial] = (config, value)
+
+    def sample(self):
+        rungs = [
+            rung
+            for rung, observations in self.observations.items()
+            if len(observations) >= self.n_startup
+        ]
+        if not rungs:
+            return super().sample()
+        observations = self.observations[max(rungs)]
+        ordered = sorted(observations.values(), key=lambda obs: obs[1])
+        n_good = max(1, int(math.ceil(self.gamma * len(ordered))))
+        good = [config for config, _ in ordered[:n_good]]
+        bad = [config for config, _ in ordered[n_good:]]
+        return {
+            name: self.sample_param(
+                spec,
+                [config[name] for config in good],
+                [config[name] for config in bad],
+            )
+            for name, spec in self.space.items()
+        }
+
+    def sample_param(self, spec, good, bad):
+        if isinstance(spec, list):
+            # Smoothed frequencies of the choices
+            def density(values):
+                counts = np.ones(len(spec))
+                for value in values:
+                    counts[spec.index(value)] += 1
+                return counts / counts.sum()
+
+            l, g = density(good), density(bad)
+            candidates = self.rng.choices(
+                range(len(spec)), weights=l, k=self.n_candidates
+            )
+            return spec[max(candidates, key=lambda i: l[i] / g[i])]
+
+        ((kind, (low, high)),) = spec.items()
+        log = kind == "loguniform"
+        z_low, z_high = (math.log(low), math.log(high)) if log else (low, high)
+        width = z_high - z_low
+
+        def to_z(values):
+            return np.log(values) if log else np.asarray(values, dtype=np.float64)
+
+        def density(z, points):
+            # Gaussian kernels and the uniform prior, with the same weight each
+            bandwidth = max(width * 0.05, width / math.sqrt(len(points) + 1))
+            resp = np.full(len(z), 1.0 / width)
+            for point in points:
+                resp += np.exp(-0.5 * ((z - point) / bandwidth) ** 2) / (
+                    bandwidth * math.sqrt(2 * math.pi)
+                )
+            return resp / (len(points) + 1)
+
+        good_z, bad_z = to_z(good), to_z(bad)
+        bandwidth = max(width * 0.05, width / math.sqrt(len(good_z) + 1))
+        candidates = []
+        for _ in range(self.n_candidates):
+            component = self.rng.randrange(len(good_z) + 1)
+            if component == len(good_z):
+                z = self.rng.uniform(z_low, z_high)
+            else:
+                z = self.rng.gauss(good_z[component], bandwidth)
+            candidates.append(min(max(z, z_low), z_high))
+        candidates = np.asarray(candidates)
+        best = candidates[
+            np.argmax(density(candidates, good_z) / density(candidates, bad_z))
+        ]
+        if log:
+            return float(math.exp(best))
+        if kind == "int":
+            return int(round(best))
+        return float(best)
+
+
+###################################################################
+
+
+class SuccessiveHalving:
+    """
+    Rungs of successive halving: trials run min_epochs and the best 1 / eta of
+    every rung are promoted to eta times more epochs, up to max_epochs.
+    Asynchronous (ASHA) promotes a trial as soon as it is in the top of its rung,
+    synchronous waits until every trial of the rung is done.
+    """
+
+    def __init__(self, min_epochs=1, max_epochs=27, eta=3, synchronous=False):
+        self.rungs = []
+        epochs = min_epochs
+        while epochs < max_epochs:
+            self.rungs.append(epochs)
+            epochs *= eta
+        self.rungs.append(max_epochs)
+        self.eta = eta
+        self.synchronous = synchronous
+        self.results = [{} for _ in self.rungs]
+        self.promoted = [set() for _ in self.rungs]
+        self.stopped = set()
+
+    def report(self, trial, rung, rmse, stopped=False):
+        self.results[rung][trial] = rmse
+        if stopped:
+            self.stopped.add(trial)
+
+    def promotion(self, running_rungs, all_started):
+        """(trial, rung) to run next from the results so far, None if there is none"""
+        for rung in range(len(self.rungs) - 2, -1, -1):
+            if self.synchronous and (
+                not all_started or any(r <= rung for r in running_rungs)
+            ):
+                continue
+            results = self.results[rung]
+            top = sorted(results, key=results.get)[: len(results) // self.eta]
+            for trial in top:
+                if trial not in self.promoted[rung] and trial not in self.stopped:
+                    self.promoted[rung].add(trial)
+                    return trial, rung + 1
+        return None
+
+
+###################################################################
+
+
+class SearchData:
+    """Featurized datasets shared by the trials, see featurize"""
+
+    def __init__(self, reg, train, val):
+        # NeoRegression with fitted transformers, train and val are
+        # (packed trees, rows, y, query features) as get_dataloader takes them
+        self.reg = reg
+        self.train = train
+        self.val = val
+
+
+def featurize(ds_train, ds_val, json_backend="auto"):
+    """Parse, pack and encode the datasets once for all the trials"""
+    reg = NeoRegression(verbose=False, json_backend=json_backend)
+    trees_train, trees_val, _ = reg.fit_transform_tree_data(
+        ds_train, ds_val, ds_val.iloc[:0]
+    )
+    scaler = StandardScaler()
+    query_train = scaler.fit_transform(ds_train[data_preprocessing.LIST_QUERY_COLUMNS])
+    query_val = scaler.transform(ds_val[data_preprocessing.LIST_QUERY_COLUMNS])
+    card_train = reg.encode_cardinalities(ds_train["json_cardinality"].values, fit=True)
+    card_val = reg.encode_cardinalities(ds_val["json_cardinality"].values)
+    features_train = reg.query_features(query_train, card_train)
+    features_val = reg.query_features(query_val, card_val)
+    reg.query_input_size = features_train.shape[1]
+
+    y_train = ds_train["time"].values[trees_train.rows]
+    y_val = ds_val["time"].values[trees_val.rows]
+    reg.pipeline.fit(y_train.reshape(-1, 1))
+    train = (
+        reg.tree_transform.transform_packed(trees_train),
+        trees_train.rows,
+        y_train,
+        features_train,
+    )
+    val = (
+        reg.tree_transform.transform_packed(trees_val),
+        trees_val.rows,
+        y_val,
+        features_val,
+    )
+    # Samples for the autoencoder are not used
+    reg.tree_transform.get_aec_ds().clear()
+    return SearchData(reg, train, val)
+
+
+def configure(reg, config):
+    """Copy of reg with the hyperparameters of config"""
+    reg = copy.copy(reg)
+    reg.optimizer = copy.deepcopy(reg.optimizer)
+    for name, value in config.items():
+        if name == "lr":
+            reg.optimizer["args"]["lr"] = value
+        elif name == "optimizer":
+            reg.optimizer["optimizer"] = value
+        elif hasattr(reg, name):
+            setattr(reg, name, value)
+        else:
+            raise ValueError("Unknown hyperparameter {}".format(name))
+    return reg
+
+
+_data = None
+
+
+def _init_worker(data, threads):
+    global _data
+    _data = data
+    torch.set_num_threads(threads)
+
+
+def run_trial(trial, config, start_epoch, end_epoch, work_dir, seed=0):
+    """
+    Train the trial from start_epoch to end_epoch in a worker, resuming from its
+    checkpoint in work_dir. It stops before end_epoch after early_stop_patience
+    epochs without improving its best validation RMSE.
+    """
+    start = time.time()
+    reg = configure(_data.reg, config)
+    torch.manual_seed(seed + trial)
+    reg.net = reg.build_net(len(reg.get_pred()))
+    optimizer = reg.make_optimizer()
+    path = osp.join(work_dir, "trial_{:04d}.pt".format(trial))
+    state = {"best_rmse": math.inf, "bad_epochs": 0, "history": []}
+    if start_epoch > 0:
+        checkpoint = torch.load(path)
+        reg.net.load_state_dict(checkpoint["net"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        state = checkpoint["state"]
+
+    dataset = reg.get_dataloader(*_data.train)
+    dataset_val = reg.get_dataloader(*_data.val, shuffle=False)
+    loss_fn = reg.make_loss()
+    stopped = False
+    epoch = start_epoch
+    while epoch < end_epoch and not stopped:
+        reg.train_epoch(reg.net, dataset, optimizer, loss_fn)
+        epoch += 1
+        y_pred, y_real = zip(*reg.predict(dataset_val))
+        rmse = float(np.sqrt(mean_squared_error(y_real, y_pred)))
+        state["history"].append(rmse)
+        if rmse < state["best_rmse"]:
+            state["best_rmse"] = rmse
+            state["bad_epochs"] = 0
+        else:
+            state["bad_epochs"] += 1
+        stopped = state["bad_epochs"] >= reg.early_stop_patience
+
+    torch.save(
+        {
+            "net": reg.net.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "state": state,
+        },
+        path,
+    )
+    return {
+        "trial": trial,
+        "epochs": epoch,
+        "val_rmse": state["best_rmse"],
+        "last_val_rmse": state["history"][-1],
+        "stopped": stopped,
+        "seconds": time.time() - start,
+    }
+
+
+###################################################################
+
+
+def write_leaderboard(leaderboard, output_path):
+    rows = sorted(leaderboard.values(), key=lambda row: row["val_rmse"])
+    df = pd.DataFrame(rows)
+    df.to_csv(osp.join(output_path, "leaderboard.csv"), index=False)
+    return df
+
+
+def search(
+    data,
+    output_path,
+    space=None,
+    n_trials=20,
+    processes=None,
+    sampler="random",
+    scheduler="asha",
+    min_epochs=1,
+    max_epochs=27,
+    eta=3,
+    seed=0,
+):
+    """
+    Run n_trials configurations of space in a pool of processes.
+    :param data: SearchData of featurize.
+    :param sampler: 'random' or 'tpe'.
+    :param scheduler: 'asha', 'sha' (synchronous successive halving) or 'none'
+    (every trial to max_epochs).
+    :return: leaderboard DataFrame, also in output_path/leaderboard.csv. Trial
+    checkpoints are in output_path/trials.
+    """
+    if n_trials < 1:
+        raise ValueError("n_trials must be at least 1, got {}".format(n_trials))
+    if space is None:
+        space = DEFAULT_SPACE
+    if processes is None:
+        processes = os.cpu_count() or 1
+    threads = max(1, (os.cpu_count() or 1) // processes)
+    work_dir = osp.join(output_path, "trials")
+    os.makedirs(work_dir, exist_ok=True)
+
+    if sampler == "tpe":
+        sampler = TPESampler(space, seed)
+    elif sampler == "random":
+        sampler = RandomSampler(space, seed)
+    else:
+        raise ValueError("Unknown sampler {}".format(sampler))
+    if scheduler not in ("asha", "sha", "none"):
+        raise ValueError("Unknown scheduler {}".format(scheduler))
+    halving = SuccessiveHalving(
+        max_epochs if scheduler == "none" else min_epochs,
+        max_epochs,
+        eta,
+        synchronous=scheduler == "sha",
+    )
+
+    configs = {}
+    leaderboard = {}
+    df = pd.DataFrame()
+    running = {}
+    results = queue.Queue()
+    method = "fork" if "fork" in mp.get_all_start_methods() else "spawn"
+    with mp.get_context(method).Pool(
+        processes, initializer=_init_worker, initargs=(data, threads)
+    ) as pool:
+        while True:
+            while len(running) < processes:
+                job = halving.promotion(
+                    list(running.values()), len(configs) >= n_trials
+                )
+                if job is None:
+                    if len(configs) >= n_trials:
+                        break
+                    job = (len(configs), 0)
+                    configs[job[0]] = sampler.sample()
+                trial, rung = job
+                running[trial] = rung
+                pool.apply_async(
+                    run_trial,
+                    (
+                        trial,
+                        configs[trial],
+                        halving.rungs[rung - 1] if rung else 0,
+                        halving.rungs[rung],
+                        work_dir,
+                        seed,
+                    ),
+                    callback=results.put,
+                    error_callback=lambda ex, trial=trial: results.put(
+                        {"trial": trial, "error": repr(ex)}
+                    ),
+                )
+            if not running:
+                break
+
+            result = results.get()
+            trial = result["trial"]
+            rung = running.pop(trial)
+            row = leaderboard.setdefault(trial, {"trial": trial, "seconds": 0.0})
+            if "error" in result:
+                print("Trial {} failed: {}".format(trial, result["error"]))
+                halving.report(trial, rung, math.inf, stopped=True)
+                row.update(val_rmse=math.inf, status="error", error=result["error"])
+            else:
+                halving.report(trial, rung, result["val_rmse"], result["stopped"])
+                sampler.tell(trial, configs[trial], result["val_rmse"], rung)
+                row.update(
+                    val_rmse=result["val_rmse"],
+                    last_val_rmse=result["last_val_rmse"],
+                    epochs=result["epochs"],
+                    rung=rung,
+                    status="stopped" if result["stopped"] else "done",
+                    seconds=row["seconds"] + result["seconds"],
+                )
+                print(
+                    "{} Trial {} rung {} ({} epochs): val RMSE {:.4f}".format(
+                        datetime.datetime.now(),
+                        trial,
+                        rung,
+                        result["epochs"],
+                        result["val_rmse"],
+                    )
+                )
+            row.update(
+                {
+                    name: json.dumps(value) if isinstance(value, list) else value
+                    for name, value in configs[trial].items()
+                }
+            )
+            df = write_leaderboard(leaderboard, output_path)
+
+    if df.empty:
+        return df
+    best = df.iloc[0]
+    with open(osp.join(output_path, "best_config.json"), "w") as f:
+        json.dump(configs[int(best["trial"])], f, indent=2)
+    return df
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Parallel hyperparameter search of NeoRegression"
+    )
+    parser.add_argument(
+        "--data-dir", dest="data_dir", help="Where is the data stored", required=True
+    )
+    parser.add_argument(
+        "--output-dir",
+        dest="output_dir",
+        help="Where to store the leaderboard and trials",
+        required=True,
+    )
+    parser.add_argument("--seed", dest="seed", default=0, type=int)
+    parser.add_argument("--val-rate", dest="val_rate", default=0.2, type=float)
+    parser.add_argument("--trials", dest="trials", default=20, type=int)
+    parser.add_argument(
+        "--processes", dest="processes", default=None, type=int, help="default: cpus"
+    )
+    parser.add_argument(
+        "--sampler", dest="sampler", default="random", choices=["random", "tpe"]
+    )
+    parser.add_argument(
+        "--scheduler", dest="scheduler", default="asha", choices=["asha", "sha", "none"]
+    )
+    parser.add_argument("--min-epochs", dest="min_epochs", default=1, type=int)
+    parser.add_argument("--max-epochs", dest="max_epochs", default=27, type=int)
+    parser.add_argument("--eta", dest="eta", default=3, type=int)
+    parser.add_argument(
+        "--space", dest="space", default=None, help="json file with the search space"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    model_id = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    ds_train, ds_val, _ = data_preprocessing.prepare_datasets(
+        args.data_dir, val_rate=args.val_rate, seed=args.seed, model_id=model_id
+    )
+    space = None
+    if args.space is not None:
+        with open(args.space) as f:
+            space = json.load(f)
+    output = osp.join(args.output_dir, model_id)
+    os.makedirs(output, exist_ok=True)
+    data = featurize(ds_train, ds_val)
+    leaderboard = search(
+        data,
+        output,
+        space=space,
+        n_trials=args.trials,
+        processes=args.processes,
+        sampler=args.sampler,
+        scheduler=args.scheduler,
+        min_epochs=args.min_epochs,
+        max_epochs=args.max_epochs,
+        eta=args.eta,
+        seed=args.seed,
+    )
+    print(leaderboard.head(10))
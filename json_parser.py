@@ -0,0 +1,161 @@
+"""
+Column level parsing of the json ``trees`` of the datasets.
+
+The json backend is pluggable: ``orjson`` or ``simdjson`` are used when they are
+installed and the standard ``json`` module otherwise. A column is parsed with a
+single call on the whole column, if that fails rows are parsed one by one and
+the bad ones are collected in the report of the result instead of printed.
+Every tree is validated against the plan schema, see validate_tree.
+"""
+
+import gc
+import json
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+
+BACKENDS = ["orjson", "simdjson", "json"]
+
+
+class TreeSchemaError(ValueError):
+    pass
+
+
+def get_backend(backend="auto"):
+    """Return (name, loads) of the json backend, 'auto' picks the fastest available"""
+    available = {
+        "orjson": orjson.loads if orjson is not None else None,
+        "simdjson": simdjson.loads if simdjson is not None else None,
+        "json": json.loads,
+    }
+    if backend == "auto":
+        for name in BACKENDS:
+            if available[name] is not None:
+                return name, available[name]
+    if backend not in available:
+        raise ValueError(
+            "Unknown json backend {}, use one of {}".format(backend, BACKENDS)
+        )
+    if available[backend] is None:
+        raise ImportError("json backend {} is not installed".format(backend))
+    return backend, available[backend]
+
+
+def validate_tree(tree):
+    """
+    Check the tree follows the plan schema: every node is a list with its label
+    (str) in first position, leaves have no more elements and operators have left
+    and right childs.
+    """
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, list) or len(node) == 0:
+            raise TreeSchemaError("Node must be a non empty list: {}".format(node))
+        if not isinstance(node[0], str):
+            raise TreeSchemaError("Node label must be a str: {}".format(node[0]))
+        if len(node) == 3:
+            stack.append(node[1])
+            stack.append(node[2])
+        elif len(node) != 1:
+            raise TreeSchemaError(
+                "Node must have 0 or 2 childs, has {}".format(len(node) - 1)
+            )
+
+
+class ParsedTrees:
+    """Trees parsed from a column, row numbers of the kept rows and errors of the rest"""
+
+    def __init__(self, trees, rows, errors, size):
+        self.trees = trees
+        self.rows = rows
+        self.errors = errors
+        self.size = size
+
+    def __len__(self):
+        return len(self.trees)
+
+    def __iter__(self):
+        return iter(self.trees)
+
+    def __getitem__(self, index):
+        return self.trees[index]
+
+    def report(self):
+        return {
+            "rows": self.size,
+            "parsed": len(self.trees),
+            "errors": [{"row": row, "error": error} for row, error in self.errors],
+        }
+
+
+def parse_trees(column, backend="auto", validate=True):
+    """
+    Parse a column (iterable of json strings) of trees.
+    :param backend: json backend, 'auto', 'orjson', 'simdjson' or 'json'.
+    :param validate: check every tree with validate_tree.
+    :return: ParsedTrees
+    """
+    _, loads = get_backend(backend)
+    column = list(column)
+
+    # Parsing creates lots of lists, the cyclic gc would run many times for nothing
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _parse_trees(column, loads, validate)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def _parse_trees(column, loads, validate):
+    trees = None
+    if all(isinstance(value, str) for value in column):
+        try:
+            trees = loads("[" + ",".join(column) + "]")
+        except (ValueError, RecursionError):
+            trees = None
+        # Bad rows could merge or split when joined, parse one by one then
+        if trees is not None and len(trees) != len(column):
+            trees = None
+
+    if trees is None:
+        trees, errors = [], []
+        for row, value in enumerate(column):
+            try:
+                trees.append(loads(value))
+            except (ValueError, TypeError, RecursionError) as ex:
+                trees.append(None)
+                errors.append((row, "{}: {}".format(type(ex).__name__, ex)))
+    else:
+        errors = []
+
+    failed = {row for row, _ in errors}
+    kept_trees, kept_rows = [], []
+    for row, tree in enumerate(trees):
+        if row in failed:
+            continue
+        if validate:
+            try:
+                validate_tree(tree)
+            except TreeSchemaError as ex:
+                errors.append((row, "TreeSchemaError: {}".format(ex)))
+                continue
+        kept_trees.append(tree)
+        kept_rows.append(row)
+
+    errors.sort()
+    return ParsedTrees(
+        kept_trees, np.asarray(kept_rows, dtype=np.int64), errors, len(column)
+    )
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 from torch import from_numpy, float32
 import numpy as np
+import profiling
 from TreeConvolution.tcnn import BinaryTreeConv, TreeLayerNorm, BinaryTreeConvWithQData
 from TreeConvolution.tcnn import TreeActivation, DynamicPooling
 from TreeConvolution.util import prepare_trees
@@ -104,6 +105,92 @@ class Autoencoder(nn.Module):
         return x
 
 
+class EmbeddingBagEncoder(nn.Module):
+    """
+    Encoder of Autoencoder, Linear and ReLU, over the indexes of the non zeros
+    of the multi-hot input: a sum EmbeddingBag adds the rows of the weights of
+    the predicates present, so the cost follows their number and not io_dim.
+    """
+
+    def __init__(self, io_dim, hidden=512):
+        super(EmbeddingBagEncoder, self).__init__()
+        # Rows are the columns of the weights of the Linear
+        self.bag = nn.EmbeddingBag(io_dim, hidden, mode="sum")
+        self.bias = nn.Parameter(torch.zeros(hidden))
+        self.activation = nn.ReLU()
+        bound = 1 / np.sqrt(io_dim)
+        nn.init.uniform_(self.bag.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x, offsets=None, per_sample_weights=None):
+        """
+        Encode the nodes of the flat indexes x starting at offsets, the values of
+        the non zeros in per_sample_weights (1 if None). Without offsets x is a
+        dense multi-hot matrix, as the input of Autoencoder.
+        """
+        if offsets is None:
+            return self.activation(x @ self.bag.weight + self.bias)
+        x = self.bag(x, offsets, per_sample_weights=per_sample_weights)
+        return self.activation(x + self.bias)
+
+
+class SparseAutoencoder(nn.Module):
+    """Autoencoder with an EmbeddingBagEncoder, trained with sampled_loss"""
+
+    def __init__(self, io_dim, hidden=512):
+        super(SparseAutoencoder, self).__init__()
+        self.encoder = EmbeddingBagEncoder(io_dim, hidden)
+        self.decoder = nn.Sequential(nn.Linear(hidden, io_dim), nn.Sigmoid())
+
+    def forward(self, x, offsets=None, per_sample_weights=None):
+        return self.decoder(self.encoder(x, offsets, per_sample_weights))
+
+    def sampled_loss(self, indices, offsets, values, weights=None, negatives=256):
+        """
+        Estimate of the binary cross entropy of the reconstruction of a batch,
+        averaged as weighted_bce, computed on the columns present in the batch
+        and negatives columns sampled from the rest. Sampled columns count for
+        all the columns they stand for.
+        :param indices, offsets, values: the batch as flat indexes of its non
+        zeros, the start of every row and the values.
+        :param weights: weight of every row, 1 if None.
+        """
+        linear = self.decoder[0]
+        io_dim = linear.out_features
+        hidden = self.encoder(indices, offsets, values)
+
+        positives = torch.unique(indices)
+        rest = torch.ones(io_dim, dtype=torch.bool, device=indices.device)
+        rest[positives] = False
+        rest = rest.nonzero().squeeze(1)
+        sampled = rest[torch.randint(len(rest), (min(negatives, len(rest)),))]
+        columns = torch.cat((positives, sampled))
+        logits = hidden @ linear.weight[columns].t() + linear.bias[columns]
+
+        lengths = torch.diff(offsets, append=offsets.new_tensor([len(indices)]))
+        rows = torch.repeat_interleave(torch.arange(len(offsets)), lengths.cpu())
+        target = torch.zeros_like(logits)
+        target[rows.to(indices.device), torch.searchsorted(positives, indices)] = values
+        column_weights = torch.ones(len(columns), device=logits.device)
+        if len(sampled):
+            column_weights[len(positives) :] = len(rest) / len(sampled)
+
+        losses = nn.functional.binary_cross_entropy_with_logits(
+            logits, target, reduction="none"
+        )
+        losses = (losses * column_weights).sum(1) / io_dim
+        if weights is None:
+            return losses.mean()
+        return (losses * weights).sum() / weights.sum()
+
+
+def autoencoder_for_state(state_dict, io_dim):
+    """Autoencoder or SparseAutoencoder, as the one that saved state_dict"""
+    if "encoder.bag.weight" in state_dict:
+        return SparseAutoencoder(io_dim, state_dict["encoder.bias"].shape[0])
+    return Autoencoder(io_dim)
+
+
 class QueryDataModel(nn.Module):
     """QueryLevel leyers used in NeoNet to concat query-level features to the tree features."""
 
@@ -217,28 +304,38 @@ class NeoNet(nn.Module):
 
     def forward(self, data):
         """"""
+        trees, query_data = self.prepare(data)
+        conv_result = self.forward_prepared(trees, query_data)
+        del trees
+        return conv_result
+
+    def prepare(self, data):
+        """Tensors of a batch of (tree, query features) pairs, see forward_prepared"""
         tree_data = [tree[0] for tree in data]
         query_data = [tree[1] for tree in data]
         query_data = torch.from_numpy(np.asarray(query_data)).to(torch.float32)
         if self.in_cuda:
             query_data = query_data.cuda()
-
+        with profiling.stage("prepare_trees"):
+            trees = prepare_trees(
+                tree_data, self.features, left_child, right_child, cuda=self.__cuda
+            )
+        return trees, query_data
+
+    def forward_prepared(self, trees, query_data):
+        """Forward of the tensors of prepare, they can be shared by several nets"""
         qm_output = self.query_model(query_data)
-
-        if self.in_cuda:
-            query_data.cpu()
-        del query_data
-        trees = prepare_trees(
-            tree_data, self.features, left_child, right_child, cuda=self.__cuda
-        )
-        conv_result = self.tree_conv((trees, qm_output))
-        del trees
-        return conv_result
+        return self.tree_conv((trees, qm_output))
 
     def cuda(self, device=None):
         self.__cuda = True
         return super().cuda(device)
 
+    def cpu(self):
+        self.__cuda = False
+        self.in_cuda = False
+        return super().cpu()
+
     def features(self, x):
         return x[0]
 
@@ -0,0 +1,114 @@
+"""
+Memoization of the first tree convolution of NeoNet at inference.
+
+The first layer (BinaryTreeConvWithQData) is linear in the features of a node,
+its two children and the query embedding:
+
+    conv(node) = W0 x[node] + W1 x[left] + W2 x[right] + Wq q + b
+
+so the projections W0 x, W1 x and W2 x of a node depend only on its features.
+A NodeMemo computes them once by distinct node of a batch, and keeps them across
+batches in a bounded LRU cache (a PredictionCache keyed by the node features).
+The query term is computed once by query. Fragments shared by the plans of a
+batch, or by plans of previous requests, are then projected once.
+
+Only the first layer is memoized: TreeLayerNorm normalizes every tree over all
+its nodes, so the activations of the next layers depend on the whole tree and
+not only on the subtree under the node.
+
+    memo = NodeMemo(max_entries=200000)
+    reg.set_node_memo(memo)
+    reg.predict_raw_data(trees, queries, cards)
+    memo.stats()  # nodes, distinct nodes by batch, cache hits and misses
+"""
+
+import torch
+
+from prediction_cache import PredictionCache
+
+
+class NodeMemo:
+    def __init__(self, max_entries=200000, max_bytes=None):
+        """
+        :param max_entries: projections of nodes kept across batches, 0 to only
+        share them inside a batch.
+        :param max_bytes: bound of the estimated memory of the projections.
+        """
+        self.cache = None
+        if max_entries:
+            self.cache = PredictionCache(max_entries=max_entries, max_bytes=max_bytes)
+        self.nodes = 0
+        self.unique = 0
+        self.projected = 0
+
+    def clear(self):
+        """Drop the projections, they are only valid for the weights that made them"""
+        if self.cache is not None:
+            self.cache.clear()
+
+    def stats(self):
+        stats = {
+            "nodes": self.nodes,
+            "unique": self.unique,
+            "projected": self.projected,
+            "unique_rate": self.unique / self.nodes if self.nodes else 0.0,
+        }
+        if self.cache is not None:
+            stats.update(
+                {"cache_" + name: value for name, value in self.cache.stats().items()}
+            )
+        return stats
+
+    def project(self, unique, weight):
+        """Projections (nodes x 3 x out) of the distinct nodes by the tree weights"""
+        # in_channels x (3 * out), the 3 positions of the kernel side by side
+        weight = weight.permute(1, 2, 0).reshape(weight.shape[1], -1)
+        if self.cache is None:
+            self.projected += len(unique)
+            return (unique @ weight).view(len(unique), 3, -1)
+
+        keys = [row.tobytes() for row in unique.cpu().numpy()]
+        cached = [self.cache.get(key) for key in keys]
+        missing = [i for i, value in enumerate(cached) if value is None]
+        if missing:
+            projections = (unique[missing] @ weight).view(len(missing), 3, -1)
+            self.projected += len(missing)
+            for i, projection in zip(missing, projections):
+                # a copy, a view would keep the projections of the batch alive
+                projection = projection.clone()
+                self.cache.put(keys[i], projection)
+                cached[i] = projection
+        return torch.stack(cached)
+
+    def conv(self, layer, flat_data, query_data):
+        """Output of the BinaryTreeConvWithQData layer, as layer(...)"""
+        trees, idxes = flat_data
+        batch, in_channels, positions = trees.shape
+        weight = layer.weights.weight
+        out_channels = weight.shape[0]
+
+        nodes = trees.transpose(1, 2).reshape(-1, in_channels)
+        unique, inverse = torch.unique(nodes, dim=0, return_inverse=True)
+        self.nodes += len(nodes)
+        self.unique += len(unique)
+        projections = self.project(unique, weight[:, :in_channels, :])
+
+        # distinct node of every (node, left, right) of the flat trees
+        offsets = torch.arange(batch, device=idxes.device).unsqueeze(1) * positions
+        triples = inverse[idxes.view(batch, -1) + offsets].view(batch, -1, 3)
+        results = projections[triples, torch.arange(3, device=idxes.device)].sum(2)
+
+        query = query_data @ weight[:, in_channels:, :].sum(2).t() + layer.weights.bias
+        results = (results + query.unsqueeze(1)).transpose(1, 2)
+
+        # add a zero vector back on
+        zero_vec = torch.zeros((batch, out_channels, 1), device=results.device)
+        return (torch.cat((zero_vec, results), dim=2), idxes)
+
+    def forward(self, net, data):
+        """NeoNet.forward of data with the memoized first layer, for inference"""
+        trees, query_data = net.prepare(data)
+        qm_output = net.query_model(query_data)
+        layers = net.tree_conv
+        flat_data = self.conv(layers[0], trees, qm_output)
+        return layers[1:](flat_data)
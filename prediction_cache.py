@@ -0,0 +1,139 @@
+"""
+Cache of predictions for repeated queries.
+
+Workloads repeat the same queries (dashboards, bots). A PredictionCache set in
+a regressor (BaseRegression.set_prediction_cache) is looked up by
+predict_raw_data before featurizing: only the rows missing from the cache are
+packed, collated and predicted. Keys hash the canonical json of the tree and the
+query features row, cardinalities included (see prediction_keys), so they are
+only valid for one featurizer and one model: the regressor clears its cache when
+it is fitted or loaded.
+
+    cache = PredictionCache(max_entries=100000, ttl=3600, max_bytes=64 * 2**20)
+    reg.set_prediction_cache(cache)
+    reg.predict_raw_data(trees, queries, cards)
+    cache.stats()  # hits, misses, evictions, expirations, entries, bytes
+"""
+
+import hashlib
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# Estimate of the bytes of an entry besides its key and value, dict node and tuple
+_ENTRY_OVERHEAD = 120
+
+
+def tree_key(tree):
+    """Canonical bytes of a parsed tree, whatever the whitespace of its json"""
+    return json.dumps(tree, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def prediction_keys(trees, rows, features):
+    """
+    Keys of the parsed trees and the rows of their query features in the CSR
+    matrix features, as built by BaseRegression.query_features.
+    """
+    features.sort_indices()
+    indptr, indices, data = features.indptr, features.indices, features.data
+    keys = []
+    for tree, row in zip(trees, rows):
+        start, end = indptr[row], indptr[row + 1]
+        digest = hashlib.blake2b(tree_key(tree), digest_size=16)
+        digest.update(indices[start:end].tobytes())
+        digest.update(data[start:end].tobytes())
+        keys.append(digest.digest())
+    return keys
+
+
+class PredictionCache:
+    def __init__(self, max_entries=100000, ttl=None, max_bytes=None):
+        """
+        Thread safe LRU cache with optional time to live.
+        :param max_entries: entries kept, least recently used are evicted first.
+        :param ttl: seconds an entry is valid, None for ever.
+        :param max_bytes: bound of the estimated memory of the entries.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getstate__(self):
+        # Copies are empty, entries are only valid for the model that made them
+        return {
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "max_bytes": self.max_bytes,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get(self, key):
+        """Cached value of key, None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires, size = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                self.bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = sys.getsizeof(key) + sys.getsizeof(value) + _ENTRY_OVERHEAD
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[2]
+            self._entries[key] = (value, expires, size)
+            self.bytes += size
+            while self._entries and (
+                len(self._entries) > self.max_entries
+                or (self.max_bytes is not None and self.bytes > self.max_bytes)
+            ):
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every entry, as when the model or the featurizer change"""
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+            }
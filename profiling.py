@@ -0,0 +1,232 @@
+"""
+Opt-in timing of the stages of training.
+
+A StageProfiler records the wall time, and the CUDA time when asked, of named
+stages (data loading, collate, prepare_trees, forward, backward...) and samples
+the peak memory of every epoch. Code marks its stages with ``stage(name)``,
+which does nothing while no profiler is active, so the marks can stay in the
+training and prediction paths.
+
+    profiler = StageProfiler(trace_path="trace.json")
+    with profiler:
+        reg.fit(...)
+    profiler.epochs  # per epoch summaries, logged by the training loop
+
+Stages can nest (prepare_trees inside forward): the summaries have the total
+time of every stage and its self time, without the stages nested in it. The
+self times of an epoch add up to at most its wall time.
+
+The trace is written in the Chrome trace format (chrome://tracing, Perfetto).
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+import torch
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_active = None
+_null = contextlib.nullcontext()
+
+
+def stage(name):
+    """Context that times the stage name in the active profiler, if any"""
+    if _active is None:
+        return _null
+    return _active.stage(name)
+
+
+def iterate(iterable, name):
+    """Iterate over iterable timing every next as the stage name, as data loading"""
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def active():
+    return _active
+
+
+def peak_rss():
+    """Peak resident memory of the process in bytes, None where unknown"""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageProfiler:
+    def __init__(self, cuda=False, trace_path=None, max_trace_events=200000):
+        """
+        :param cuda: also time the stages with CUDA events, they are read at the
+        end of every epoch so the stages do not synchronize.
+        :param trace_path: file to write the Chrome trace to on exit.
+        :param max_trace_events: events kept for the trace, the summaries count all.
+        """
+        self.cuda = cuda and torch.cuda.is_available()
+        self.trace_path = trace_path
+        self.max_trace_events = max_trace_events
+        self.epochs = []
+        self.events = []
+        self._stages = {}
+        # Stages open in every thread, with the time of the stages nested in them
+        self._open = threading.local()
+        self._cuda_events = []
+        self._origin = time.perf_counter()
+        self._epoch_start = self._origin
+        self._previous = None
+
+    def __enter__(self):
+        global _active
+        self._previous = _active
+        _active = self
+        self._epoch_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = self._previous
+        self._previous = None
+        if self.trace_path is not None:
+            self.export_chrome_trace(self.trace_path)
+        return False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.cuda:
+            cuda_start = torch.cuda.Event(enable_timing=True)
+            cuda_start.record()
+        opened = self._open.__dict__.setdefault("stages", [])
+        nested = [0.0]
+        opened.append(nested)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            opened.pop()
+            if opened:
+                opened[-1][0] += end - start
+            if self.cuda:
+                cuda_end = torch.cuda.Event(enable_timing=True)
+                cuda_end.record()
+                self._cuda_events.append((name, cuda_start, cuda_end))
+            stats = self._stages.get(name)
+            if stats is None:
+                stats = self._stages[name] = {
+                    "count": 0,
+                    "total": 0.0,
+                    "self": 0.0,
+                    "max": 0.0,
+                }
+            stats["count"] += 1
+            stats["total"] += end - start
+            stats["self"] += end - start - nested[0]
+            stats["max"] = max(stats["max"], end - start)
+            if len(self.events) < self.max_trace_events:
+                self.events.append(
+                    {
+                        "name": name,
+                        "ph": "X",
+                        "ts": (start - self._origin) * 1e6,
+                        "dur": (end - start) * 1e6,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident(),
+                    }
+                )
+
+    def end_epoch(self, epoch):
+        """Close the epoch: summary of its stages and peak memory, see format_summary"""
+        now = time.perf_counter()
+        if self._cuda_events:
+            torch.cuda.synchronize()
+            for name, cuda_start, cuda_end in self._cuda_events:
+                stats = self._stages[name]
+                stats["cuda_total"] = stats.get("cuda_total", 0.0) + (
+                    cuda_start.elapsed_time(cuda_end) / 1000
+                )
+            self._cuda_events = []
+
+        summary = {
+            "epoch": epoch,
+            "wall": now - self._epoch_start,
+            "stages": self._stages,
+            "peak_rss": peak_rss(),
+        }
+        if torch.cuda.is_available():
+            summary["peak_cuda_memory"] = torch.cuda.max_memory_allocated()
+            torch.cuda.reset_peak_memory_stats()
+        self.epochs.append(summary)
+        if len(self.events) < self.max_trace_events:
+            memory = {"rss": summary["peak_rss"] or 0}
+            if "peak_cuda_memory" in summary:
+                memory["cuda"] = summary["peak_cuda_memory"]
+            self.events.append(
+                {
+                    "name": "peak memory",
+                    "ph": "C",
+                    "ts": (now - self._origin) * 1e6,
+                    "pid": os.getpid(),
+                    "args": memory,
+                }
+            )
+
+        self._stages = {}
+        self._epoch_start = now
+        return summary
+
+    @staticmethod
+    def format_summary(summary):
+        """
+        Stages by self time. Their percentages of the epoch exclude the stages
+        nested in them, which count in their total time.
+        """
+        lines = [
+            "==> Epoch {} profile, {:.3f}s".format(summary["epoch"], summary["wall"])
+        ]
+        for name, stats in sorted(
+            summary["stages"].items(), key=lambda item: -item[1]["self"]
+        ):
+            line = (
+                "\t{}: self {:.3f}s ({:.1f}%), total {:.3f}s in {} calls, "
+                "max {:.4f}s"
+            ).format(
+                name,
+                stats["self"],
+                100 * stats["self"] / max(summary["wall"], 1e-12),
+                stats["total"],
+                stats["count"],
+                stats["max"],
+            )
+            if "cuda_total" in stats:
+                line += ", cuda {:.3f}s".format(stats["cuda_total"])
+            lines.append(line)
+        if summary["peak_rss"] is not None:
+            lines.append("\tpeak rss: {:.1f} MB".format(summary["peak_rss"] / 2**20))
+        if "peak_cuda_memory" in summary:
+            lines.append(
+                "\tpeak cuda memory: {:.1f} MB".format(
+                    summary["peak_cuda_memory"] / 2**20
+                )
+            )
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path):
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+    def export_json(self, path):
+        with open(path, "w") as f:
+            json.dump({"epochs": self.epochs}, f, indent=2)
@@ -0,0 +1,288 @@
+"""
+Replay of a query log through a saved regressor, to measure its inference
+offline before it is deployed.
+
+The log (csv with the ᶶ delimiter of prepare_datasets, or parquet) is read in
+batches of batch_size rows, predicted by threads workers and the predictions
+written as they come, in the order of the log. At most 2 * threads batches are
+in memory at once, the log is never loaded whole. The summary has the
+throughput, the latency of the batches and the memory (peak RSS) of the
+process.
+
+    python replay.py --model output/regressor --log ds_test.csv \
+        --output predictions.csv --batch-size 256 --threads 4
+
+The query features of the log are the raw columns of prepare_datasets, the
+regressor standardizes them with the query scaler saved with it (train.py).
+
+Predictions are written as csv (or parquet if the output ends in .parquet)
+with the row of the log, the prediction (NaN for bad json trees) and the time
+of the log if it has one. The summary is written next to them,
+predictions.replay.json.
+"""
+
+import argparse
+import json
+import os
+import resource
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from data_preprocessing import LIST_QUERY_COLUMNS
+from evaluation import evaluate
+from json_parser import parse_trees
+from runtime import environment
+from serving import ConcurrentPredictor, load_model, thread_safe_predictor
+
+COLUMNS = ["trees", "json_cardinality"] + LIST_QUERY_COLUMNS
+PERCENTILES = (50, 90, 99)
+
+
+def _parquet():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("parquet logs need pyarrow, pip install pyarrow")
+    return pyarrow
+
+
+def read_batches(path, batch_size, columns=COLUMNS + ["time"]):
+    """
+    DataFrames of batch_size rows of the log in path, with the columns it has of
+    columns. Only the batch being read is in memory.
+    """
+    if path.endswith(".parquet"):
+        pyarrow = _parquet()
+        log = pyarrow.parquet.ParquetFile(path)
+        names = [name for name in columns if name in log.schema_arrow.names]
+        for batch in log.iter_batches(batch_size=batch_size, columns=names):
+            yield batch.to_pandas()
+        return
+    yield from pd.read_csv(
+        path,
+        delimiter="ᶶ",
+        engine="python",
+        chunksize=batch_size,
+        usecols=lambda name: name in columns,
+    )
+
+
+class PredictionWriter:
+    """Writes the predictions of the batches to a csv or parquet file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        self._file = None
+        self._parquet = path.endswith(".parquet")
+
+    def write(self, predictions):
+        if self._parquet:
+            pyarrow = _parquet()
+            table = pyarrow.Table.from_pandas(predictions, preserve_index=False)
+            if self._file is None:
+                self._file = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+            self._file.write_table(table)
+        else:
+            header = self._file is None
+            if header:
+                self._file = open(self.path, "w")
+            predictions.to_csv(self._file, header=header, index=False)
+        self.rows += len(predictions)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def predict_batch(predictor, batch, start, json_backend="auto"):
+    """
+    DataFrame of the row in the log, prediction and time (if in batch) of the
+    rows of batch, which start at row start of the log, and the seconds taken.
+    """
+    begin = time.perf_counter()
+    trees = parse_trees(batch["trees"].values, backend=json_backend)
+    # The json cardinalities go last, encoded by the predictor
+    queries = batch[LIST_QUERY_COLUMNS + ["json_cardinality"]].values
+    y_pred = predictor.predict_raw_data(trees, queries)
+    predictions = np.full(len(batch), np.nan)
+    predictions[np.asarray(trees.rows, dtype=np.int64)] = np.asarray(
+        y_pred, dtype=np.float64
+    ).reshape(-1)
+    elapsed = time.perf_counter() - begin
+    result = pd.DataFrame(
+        {"row": np.arange(start, start + len(batch)), "prediction": predictions}
+    )
+    if "time" in batch:
+        result["time"] = batch["time"].values
+    return result, elapsed
+
+
+def peak_rss_mb():
+    """Peak resident memory of the process, in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def replay(
+    reg,
+    log_path,
+    output_path,
+    batch_size=256,
+    threads=1,
+    num_threads=None,
+    with_evaluation=False,
+):
+    """
+    Replay the log in log_path through reg, writing the predictions to
+    output_path. Returns the summary: rows, throughput, batch latencies and
+    peak RSS; with_evaluation the report of evaluation.evaluate too, for logs
+    with times (it keeps the predictions and times, 16 bytes by row).
+    """
+    if reg.card_encoder is None:
+        raise ValueError("The regressor has no cardinality encoder")
+    if reg.query_scaler is None:
+        print(
+            "WARNING: the regressor has no query scaler, the query features of "
+            "the log are predicted unscaled"
+        )
+    predictor = thread_safe_predictor(reg, num_threads)
+    rss_before = peak_rss_mb()
+    latencies = []
+    evaluated = ([], [])
+    rows = 0
+    pending = deque()
+
+    def collect(writer):
+        result, elapsed = pending.popleft().result()
+        latencies.append(elapsed)
+        writer.write(result)
+        if with_evaluation and "time" in result:
+            valid = result["prediction"].notna().values
+            evaluated[0].append(result["prediction"].values[valid])
+            evaluated[1].append(result["time"].values[valid])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor, PredictionWriter(
+        output_path
+    ) as writer:
+        for batch in read_batches(log_path, batch_size):
+            pending.append(
+                executor.submit(predict_batch, predictor, batch, rows, reg.json_backend)
+            )
+            rows += len(batch)
+            while len(pending) >= 2 * threads:
+                collect(writer)
+        while pending:
+            collect(writer)
+    wall = time.perf_counter() - start
+    if isinstance(predictor, ConcurrentPredictor):
+        predictor.close()
+
+    latencies = np.asarray(latencies)
+    summary = {
+        "rows": rows,
+        "batches": len(latencies),
+        "batch_size": batch_size,
+        "threads": threads,
+        "seconds": wall,
+        "rows_per_second": rows / wall if wall else 0.0,
+        "batch_latency_ms": {},
+        "peak_rss_mb": peak_rss_mb(),
+        "rss_growth_mb": peak_rss_mb() - rss_before,
+    }
+    if len(latencies):
+        summary["batch_latency_ms"] = {
+            "mean": 1e3 * latencies.mean(),
+            "max": 1e3 * latencies.max(),
+        }
+        summary["batch_latency_ms"].update(
+            {
+                "p{}".format(p): 1e3 * value
+                for p, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES))
+            }
+        )
+    if with_evaluation and evaluated[0]:
+        summary["evaluation"] = evaluate(
+            np.concatenate(evaluated[0]), np.concatenate(evaluated[1])
+        )
+    return summary
+
+
+def summary_path(output_path):
+    return os.path.splitext(output_path)[0] + ".replay.json"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Replay a query log through a saved regressor"
+    )
+    parser.add_argument(
+        "--model",
+        required=True,
+        help="directory of BaseRegression.save or file of save_artifact",
+    )
+    parser.add_argument(
+        "--log", required=True, help="csv (ᶶ delimited) or parquet of queries"
+    )
+    parser.add_argument(
+        "--output", required=True, help="csv or parquet file of the predictions"
+    )
+    parser.add_argument("--batch-size", dest="batch_size", type=int, default=256)
+    parser.add_argument(
+        "--threads", type=int, default=1, help="batches predicted at once"
+    )
+    parser.add_argument(
+        "--torch-threads",
+        dest="torch_threads",
+        type=int,
+        default=None,
+        help="torch.set_num_threads, 1 is usually best with several threads",
+    )
+    parser.add_argument(
+        "--evaluate",
+        action="store_true",
+        help="evaluate the predictions against the times of the log",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    reg = load_model(args.model, map_location="cpu")
+    summary = replay(
+        reg,
+        args.log,
+        args.output,
+        batch_size=args.batch_size,
+        threads=args.threads,
+        num_threads=args.torch_threads,
+        with_evaluation=args.evaluate,
+    )
+    print(
+        "{} rows in {:.1f}s, {:.0f} rows/s, batch p50 {:.1f}ms p99 {:.1f}ms, "
+        "peak RSS {:.0f}MB".format(
+            summary["rows"],
+            summary["seconds"],
+            summary["rows_per_second"],
+            summary["batch_latency_ms"].get("p50", 0.0),
+            summary["batch_latency_ms"].get("p99", 0.0),
+            summary["peak_rss_mb"],
+        )
+    )
+    with open(summary_path(args.output), "w") as f:
+        json.dump(
+            {"environment": environment(), "params": vars(args), "summary": summary},
+            f,
+            indent=2,
+        )
@@ -0,0 +1,36 @@
+"""
+Environment a run happened in, recorded with the results of the benchmarks and
+the summaries of replay.py.
+"""
+
+import datetime
+import platform
+import subprocess
+
+import numpy as np
+import torch
+
+
+def git_revision():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    return {
+        "date": datetime.datetime.now().isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "threads": torch.get_num_threads(),
+    }
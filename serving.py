@@ -0,0 +1,317 @@
+"""
+Serving of a regressor that can be replaced while it predicts.
+
+A HotSwapPredictor predicts with the regressor it holds, through a frozen
+ConcurrentPredictor so it can be called from several threads; reload loads a
+newer one (a directory of BaseRegression.save or a file of save_artifact),
+warms it up and swaps it in. Requests already running end with the regressor
+they started with, the next ones use the new regressor, none is dropped or
+waits for the load. The predictor of a regressor is built on its first request
+(or the warmup of reload), the one of the old regressor is closed when its
+requests end.
+
+    predictor = HotSwapPredictor(load_model("model_dir", map_location="cpu"))
+    predictor.predict_raw_data(trees, queries, cards)
+    # from another thread
+    predictor.reload("model_v2.safetensors", map_location="cpu")
+
+BaseRegression.predict_raw_data records the encoded nodes in the featurizer and
+sets the net in eval mode on every call. A ConcurrentPredictor predicts with a
+frozen copy of the featurizer and of the net, so it can be called from many
+threads, and runs a request split in chunks on its thread pool:
+
+    with ConcurrentPredictor(reg, workers=8, num_threads=1) as predictor:
+        predictor.predict_parallel(trees, queries, cards)
+        future = predictor.submit(trees, queries, cards)
+"""
+
+import copy
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from artifact import load_artifact
+from json_parser import ParsedTrees, parse_trees
+from Models.model_base import BaseRegression
+
+
+def load_model(path, map_location=None, lazy=False):
+    """
+    Regressor saved by BaseRegression.save (a directory) or save_artifact (a
+    file). lazy only applies to directories, see BaseRegression.load.
+    """
+    if os.path.isdir(path):
+        return BaseRegression.load_model(path, map_location=map_location, lazy=lazy)
+    return load_artifact(path, map_location=map_location)
+
+
+def thread_safe_predictor(reg, num_threads=None):
+    """
+    Predictor of reg that can be called from several threads, its
+    predict_raw_data accepts ParsedTrees and returns the predictions of their
+    rows. Regressors with a net predict through a ConcurrentPredictor, the
+    others (GBTRegression) with a frozen copy of the featurizer.
+    """
+    if reg.net is not None:
+        return ConcurrentPredictor(reg, workers=1, num_threads=num_threads)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    model = copy.copy(reg)
+    model.tree_transform = reg.tree_transform.frozen()
+    if reg.card_encoder is not None:
+        model.card_encoder = copy.copy(reg.card_encoder)
+        model.card_encoder.unknown_predicates = {}
+    return model
+
+
+def _serving_predictor(model):
+    """thread_safe_predictor of a regressor, other predictors as they are"""
+    if isinstance(model, BaseRegression):
+        return thread_safe_predictor(model)
+    return model
+
+
+def _close(predictor):
+    if isinstance(predictor, ConcurrentPredictor):
+        predictor.close()
+
+
+class HotSwapPredictor:
+    def __init__(self, model):
+        """
+        :param model: fitted regressor to serve, it is not modified. It predicts
+        through a thread_safe_predictor, so requests can come from several
+        threads. The predictor, a copy of the net, is built on the first
+        request: a model loaded with lazy=True loads then, not before.
+        """
+        self._model = model
+        self.generation = 0
+        # Requests running by generation of the model
+        self._running = {}
+        # Predictors by generation, built on their first request and closed when
+        # their generation is replaced and has no requests running
+        self._predictors = {}
+        self._condition = threading.Condition()
+        self._building = threading.Lock()
+
+    @property
+    def model(self):
+        return self._model
+
+    def _predictor(self, model, generation):
+        with self._building:
+            predictor = self._predictors.get(generation)
+            if predictor is None:
+                predictor = _serving_predictor(model)
+                with self._condition:
+                    self._predictors[generation] = predictor
+        return predictor
+
+    def predict_raw_data(self, trees, queries, cards=None):
+        """BaseRegression.predict_raw_data with the model served when called"""
+        with self._condition:
+            model, generation = self._model, self.generation
+            self._running[generation] = self._running.get(generation, 0) + 1
+            predictor = self._predictors.get(generation)
+        try:
+            if predictor is None:
+                predictor = self._predictor(model, generation)
+            return predictor.predict_raw_data(trees, queries, cards)
+        finally:
+            with self._condition:
+                self._running[generation] -= 1
+                if not self._running[generation]:
+                    del self._running[generation]
+                    if generation != self.generation:
+                        _close(self._predictors.pop(generation, None))
+                    self._condition.notify_all()
+
+    def swap(self, model):
+        """
+        Serve model from now on. Returns the generation of the previous model,
+        which is closed once its requests end, see wait_drained.
+        """
+        return self._swap(model, None)
+
+    def _swap(self, model, predictor):
+        with self._condition:
+            generation = self.generation
+            self._model = model
+            self.generation += 1
+            if predictor is not None:
+                self._predictors[self.generation] = predictor
+            if generation not in self._running:
+                _close(self._predictors.pop(generation, None))
+            return generation
+
+    def reload(self, path, map_location=None, warmup=None):
+        """
+        Load the model saved in path and swap it in, see load_model.
+        :param warmup: (trees, queries, cards) predicted before swapping, so the
+        first requests don't pay for building the predictor and lazy loading.
+        :return: generation of the previous model.
+        """
+        model = load_model(path, map_location=map_location)
+        predictor = None
+        if warmup is not None:
+            predictor = _serving_predictor(model)
+            predictor.predict_raw_data(*warmup)
+        return self._swap(model, predictor)
+
+    def running(self):
+        """Requests running by generation of the model"""
+        with self._condition:
+            return dict(self._running)
+
+    def wait_drained(self, generation, timeout=None):
+        """
+        Wait until no request runs on the model of generation, its predictor is
+        closed then. False on timeout.
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: generation not in self._running, timeout
+            )
+
+    def close(self):
+        """Close the predictors built"""
+        with self._condition:
+            for predictor in self._predictors.values():
+                _close(predictor)
+            self._predictors = {}
+
+
+class _Scratch(threading.local):
+    """Buffers of a thread, grown as needed and reused by its batches"""
+
+    def __init__(self):
+        self.buffers = {}
+
+    def zeros(self, name, shape, dtype):
+        size = int(np.prod(shape))
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.dtype != dtype or buffer.size < size:
+            buffer = self.buffers[name] = np.empty(size, dtype=dtype)
+        array = buffer[:size].reshape(shape)
+        array.fill(0)
+        return array
+
+
+class ConcurrentPredictor:
+    def __init__(self, reg, workers=None, num_threads=None, batch_size=128):
+        """
+        :param reg: fitted regressor, it is not modified.
+        :param workers: threads of the pool of submit and predict_parallel, the
+        number of cpus if None.
+        :param num_threads: torch.set_num_threads, threads of each torch operation.
+        With many workers 1 is usually the fastest, None keeps the setting.
+        :param batch_size: trees by forward of the net.
+        """
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        model = copy.copy(reg)
+        model.tree_transform = reg.tree_transform.frozen()
+        model.net = copy.deepcopy(reg.net).eval().requires_grad_(False)
+        if reg.aec_net is not None:
+            model.aec_net = copy.deepcopy(reg.aec_net).eval().requires_grad_(False)
+        if reg.card_encoder is not None:
+            # Unknown predicates of the requests are not counted in the regressor
+            model.card_encoder = copy.copy(reg.card_encoder)
+            model.card_encoder.unknown_predicates = {}
+        # Caches of the regressor are not shared, neither the memo of its nodes
+        model.prediction_cache = None
+        model.node_memo = None
+        self.model = model
+        self.batch_size = batch_size
+        self.vocabulary_size = len(model.get_pred())
+        self.device = next(model.net.parameters()).device
+        self.workers = workers or os.cpu_count()
+        self.executor = ThreadPoolExecutor(self.workers)
+        self._scratch = _Scratch()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def predict_raw_data(self, trees, queries, cards=None):
+        """
+        Same predictions as BaseRegression.predict_raw_data, in the calling
+        thread. Safe to call from several threads at once.
+        """
+        model = self.model
+        features = model.query_features(queries, cards)
+        if not isinstance(trees, ParsedTrees):
+            trees = parse_trees(trees, backend=model.json_backend)
+        packed = model.tree_transform.transform_packed(trees.trees)
+        rows = trees.rows
+        results = []
+        with torch.no_grad():
+            for start in range(0, len(packed), self.batch_size):
+                end = start + self.batch_size
+                y_pred = self.forward(packed[start:end], features[rows[start:end]])
+                results.extend(model.pipeline.inverse_transform(y_pred))
+        return results
+
+    def forward(self, packed, query):
+        """
+        Outputs of the net for PackedTrees and the CSR matrix of their query
+        features, built in the scratch buffers of the thread. As
+        collate_predict_with_card and NeoNet.prepare without their copies.
+        """
+        scratch = self._scratch
+        sizes = [len(tree) for tree in packed]
+        indices = np.concatenate([tree.indices for tree in packed])
+        counts = np.concatenate([np.diff(tree.indptr) for tree in packed])
+        onehot = scratch.zeros(
+            "onehot", (len(counts), self.vocabulary_size), np.float32
+        )
+        np.add.at(onehot, (np.repeat(np.arange(len(counts)), counts), indices), 1)
+        nodes = self.model.node_features(onehot)
+
+        # Batch x positions x channels, the first position of every tree is the
+        # zero vector, as prepare_trees
+        positions = max(sizes) + 1
+        trees = scratch.zeros(
+            "trees", (len(packed), positions, nodes.shape[1]), np.float32
+        )
+        indexes = scratch.zeros(
+            "indexes", (len(packed), 3 * (positions - 1), 1), np.int64
+        )
+        start = 0
+        for i, (tree, size) in enumerate(zip(packed, sizes)):
+            trees[i, 1 : size + 1] = nodes[start : start + size]
+            indexes[i, : 3 * size] = tree.conv_indexes
+            start += size
+
+        trees = torch.from_numpy(trees).transpose(1, 2).to(self.device)
+        indexes = torch.from_numpy(indexes).to(self.device)
+        query = torch.from_numpy(query.toarray().astype(np.float32)).to(self.device)
+        return self.model.net.forward_prepared((trees, indexes), query).cpu().numpy()
+
+    def submit(self, trees, queries, cards=None):
+        """Future of predict_raw_data run in the pool"""
+        return self.executor.submit(self.predict_raw_data, trees, queries, cards)
+
+    def predict_parallel(self, trees, queries, cards=None):
+        """predict_raw_data of the rows split in chunks predicted in the pool"""
+        chunk = max(self.batch_size, -(-len(queries) // self.workers))
+        futures = [
+            self.submit(
+                trees[start : start + chunk],
+                queries[start : start + chunk],
+                None if cards is None else cards[start : start + chunk],
+            )
+            for start in range(0, len(queries), chunk)
+        ]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
@@ -0,0 +1,31 @@
+"""Fixtures shared by the tests"""
+
+import torch
+
+from benchmarks.synthetic import random_dataset
+from data_preprocessing import LIST_QUERY_COLUMNS
+from Models.model_trees_algebra import NeoRegression
+
+
+def fitted_regressor(
+    n_rows, n_nodes, seed=0, data_seed=None, target_scale=1.0, **kvargs
+):
+    """
+    NeoRegression with its featurizer, cardinality encoder and target pipeline
+    fitted on random_dataset(n_rows, n_nodes), and a net initialized with seed,
+    not trained.
+    :param data_seed: seed of the dataset, seed if None.
+    :param target_scale: factor of the times the target pipeline is fitted on.
+    :param kvargs: arguments of NeoRegression.
+    :return: the regressor, the dataset, its query features and cardinalities.
+    """
+    ds = random_dataset(n_rows, n_nodes, seed=seed if data_seed is None else data_seed)
+    reg = NeoRegression(**kvargs)
+    reg.fit_transform_tree_data(ds, ds.iloc[:0], ds.iloc[:0])
+    card = reg.encode_cardinalities(ds["json_cardinality"].values, fit=True)
+    query = ds[LIST_QUERY_COLUMNS].values.astype(float)
+    reg.query_input_size = reg.query_features(query, card).shape[1]
+    reg.pipeline.fit(ds["time"].values.reshape(-1, 1) * target_scale)
+    torch.manual_seed(seed)
+    reg.net = reg.build_net(len(reg.get_pred()))
+    return reg, ds, query, card
@@ -0,0 +1,160 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+from artifact import (
+    ArtifactError,
+    LogMinMaxTransform,
+    Vocabulary,
+    load_artifact,
+    read_artifact,
+    read_tensors,
+    save_artifact,
+    write_tensors,
+)
+from Models.model_trees_algebra import NeoRegression
+from test.helpers import fitted_regressor
+from transforms import QueryScaler
+
+
+class TestTensors(unittest.TestCase):
+    def test_round_trip(self):
+        tensors = {
+            "a": np.arange(12, dtype=np.float32).reshape(3, 4),
+            "b": np.array([1, -2, 3], dtype=np.int64),
+            "c": np.frombuffer(b"abc", dtype=np.uint8),
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "t.safetensors")
+            write_tensors(path, tensors, {"key": "value"})
+            for mmap in (True, False):
+                read, metadata = read_tensors(path, mmap=mmap)
+                self.assertEqual(metadata, {"key": "value"})
+                for name, value in tensors.items():
+                    np.testing.assert_array_equal(read[name], value)
+                    self.assertEqual(read[name].dtype, value.dtype)
+
+    def test_not_an_artifact(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "t.safetensors")
+            write_tensors(path, {"a": np.zeros(2)})
+            with self.assertRaises(ArtifactError):
+                read_artifact(path)
+
+
+class TestVocabulary(unittest.TestCase):
+    def test_lookup(self):
+        preds = {"<b>": 0, "<a>": 1, "ñ<c>": 2}
+        vocabulary = Vocabulary.from_dict(preds)
+        self.assertEqual(vocabulary.get("<a>"), 1)
+        self.assertEqual(vocabulary.get("ñ<c>"), 2)
+        self.assertIsNone(vocabulary.get("<z>"))
+        self.assertNotIn("<", vocabulary)
+        self.assertEqual(list(vocabulary.to_dict().items()), list(preds.items()))
+        # A read only mapping in index order, as the dict of the featurizer
+        self.assertEqual(vocabulary["ñ<c>"], 2)
+        with self.assertRaises(KeyError):
+            vocabulary["<z>"]
+        self.assertEqual(list(vocabulary), list(preds))
+        self.assertEqual(vocabulary, preds)
+
+
+class TestLogMinMaxTransform(unittest.TestCase):
+    def test_same_as_pipeline(self):
+        reg = NeoRegression()
+        y = np.array([0.0, 3.5, 120.0, 9000.0]).reshape(-1, 1)
+        reg.pipeline.fit(y)
+        transform = LogMinMaxTransform.from_pipeline(reg.pipeline)
+        np.testing.assert_allclose(transform.transform(y), reg.pipeline.transform(y))
+        scaled = np.array([[0.1], [0.7]])
+        np.testing.assert_allclose(
+            transform.inverse_transform(scaled),
+            reg.pipeline.inverse_transform(scaled),
+        )
+
+
+class TestArtifact(unittest.TestCase):
+    def test_same_predictions(self):
+        reg, ds, query, card = fitted_regressor(
+            40, 7, data_seed=1, tree_units=[32, 16], tree_units_dense=[8]
+        )
+        reg.query_scaler = QueryScaler(query.mean(axis=0), query.std(axis=0) + 1)
+        expected = np.asarray(reg.predict_raw_data(ds["trees"].values, query, card))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "model.safetensors")
+            save_artifact(reg, path)
+            loaded = load_artifact(path)
+        self.assertIsInstance(loaded, NeoRegression)
+        self.assertEqual(loaded.get_pred(), reg.get_pred())
+        self.assertEqual(loaded.tree_units, [32, 16])
+        np.testing.assert_array_equal(loaded.query_scaler.mean, query.mean(axis=0))
+        card = loaded.encode_cardinalities(ds["json_cardinality"].values)
+        predictions = loaded.predict_raw_data(ds["trees"].values, query, card)
+        np.testing.assert_allclose(np.asarray(predictions), expected, rtol=1e-5)
+
+    def test_without_sklearn(self):
+        reg, ds, query, card = fitted_regressor(
+            40, 7, data_seed=1, tree_units=[32, 16], tree_units_dense=[8]
+        )
+        expected = np.asarray(reg.predict_raw_data(ds["trees"].values, query, card))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "model.safetensors")
+            save_artifact(reg, path)
+            output = subprocess.run(
+                [sys.executable, "-c", SKLEARN_BLOCKED, path],
+                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                capture_output=True,
+                text=True,
+            )
+        self.assertEqual(output.returncode, 0, output.stderr)
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        np.testing.assert_allclose(
+            result["predictions"], expected.reshape(-1), rtol=1e-5
+        )
+        # Only the predicates of the plans were looked up in the table
+        self.assertLess(result["found"], len(reg.get_pred()))
+
+
+# Loads an artifact and predicts with sklearn imports failing
+SKLEARN_BLOCKED = """
+import importlib.abc
+import json
+import sys
+
+
+class BlockSklearn(importlib.abc.MetaPathFinder):
+    def find_spec(self, name, path, target=None):
+        if name.split(".")[0] == "sklearn":
+            raise ImportError("sklearn is blocked")
+
+
+sys.meta_path.insert(0, BlockSklearn())
+
+from artifact import load_artifact
+from benchmarks.synthetic import random_dataset
+from data_preprocessing import LIST_QUERY_COLUMNS
+
+reg = load_artifact(sys.argv[1], map_location="cpu")
+ds = random_dataset(40, 7, seed=1)
+card = reg.encode_cardinalities(ds["json_cardinality"].values)
+query = ds[LIST_QUERY_COLUMNS].values.astype(float)
+predictions = reg.predict_raw_data(ds["trees"].values, query, card)
+print(
+    json.dumps(
+        {
+            "predictions": [float(value) for value in predictions],
+            "found": len(reg.get_pred()._found),
+        }
+    )
+)
+"""
+
+
+if __name__ == "__main__":
+    unittest.main()
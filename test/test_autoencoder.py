@@ -0,0 +1,137 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from benchmarks.synthetic import random_dataset
+from featurize import SPARQLTreeFeaturizer
+from json_parser import parse_trees
+from Models.model_autoencoder import AECDataset, AECTraining, weighted_bce
+from Models.model_base import BaseRegression
+from Models.model_trees_algebra_aec import NeoRegression
+from net import SparseAutoencoder
+
+
+class TestAECDataset(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        ds = random_dataset(30, 6, seed=0)
+        cls.featurizer = SPARQLTreeFeaturizer()
+        trees = parse_trees(ds["trees"].values).trees
+        cls.featurizer.fit(trees)
+        cls.featurizer.transform_packed(trees)
+        cls.samples = cls.featurizer.get_aec_ds()
+        cls.io_dim = len(cls.featurizer.get_pred_index()) - 18
+
+    def test_same_as_one_hot(self):
+        samples = self.samples + [[0, 20, 20, 25]]
+        dataset = AECDataset.from_samples(samples, self.io_dim, ignore_first=18)
+        self.assertEqual(len(dataset), len(samples))
+        for i in (0, len(samples) // 2, len(samples) - 1):
+            expected = self.featurizer.get_one_hot_from_tuple(samples[i])[18:]
+            np.testing.assert_array_equal(dataset[i].numpy(), expected)
+
+    def test_batches(self):
+        dataset = AECDataset.from_samples(self.samples, self.io_dim)
+        batches = list(dataset.batches(16, shuffle=True))
+        self.assertEqual(len(batches), dataset.num_batches(16))
+        self.assertEqual(batches[0].dtype, torch.float32)
+        np.testing.assert_allclose(
+            torch.cat(batches).sum(0).numpy(), dataset.matrix.sum(0).A1
+        )
+
+    def test_deduplicate(self):
+        samples = self.samples * 3 + [[0, 20, 21], [1, 20, 21]]
+        dataset = AECDataset.from_samples(samples, self.io_dim)
+        distinct = dataset.deduplicate()
+        self.assertLess(len(distinct), len(dataset))
+        self.assertEqual(distinct.weights.sum(), len(samples))
+        dense = distinct.matrix.toarray()
+        self.assertEqual(len(np.unique(dense, axis=0)), len(distinct))
+
+        # The weighted loss of the distinct nodes is the loss of every node
+        torch.manual_seed(0)
+        output = torch.sigmoid(torch.randn(len(distinct), self.io_dim))
+        loss = weighted_bce(
+            output, torch.from_numpy(dense), torch.from_numpy(distinct.weights)
+        )
+        index = {row.tobytes(): i for i, row in enumerate(dense)}
+        every = dataset.matrix.toarray()
+        rows = [index[row.tobytes()] for row in every]
+        expected = torch.nn.BCELoss()(output[rows], torch.from_numpy(every))
+        self.assertAlmostEqual(loss.item(), expected.item(), places=5)
+
+    def test_fit(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            training = AECTraining(
+                self.samples, io_dim=self.io_dim, epochs=2, output_path=tmp
+            )
+            net = training.fit(os.path.join(tmp, "aec.pt"))
+            self.assertTrue(os.path.exists(os.path.join(tmp, "aec.pt")))
+        self.assertEqual(net.encoder[0].in_features, self.io_dim)
+
+
+class TestSparseAutoencoder(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.net = SparseAutoencoder(50, hidden=16)
+        rows = [[1, 4, 7], [], [4, 49], [0, 2, 3, 4, 5]]
+        self.matrix = AECDataset.from_samples(rows, 50, ignore_first=0).matrix
+        self.batch = AECDataset.sparse(self.matrix)
+
+    def test_encoder_as_linear(self):
+        dense = torch.from_numpy(self.matrix.toarray())
+        indices, offsets, values = self.batch
+        with torch.no_grad():
+            expected = torch.relu(
+                dense @ self.net.encoder.bag.weight + self.net.encoder.bias
+            )
+            np.testing.assert_allclose(
+                self.net.encoder(indices, offsets, values), expected, atol=1e-6
+            )
+            np.testing.assert_allclose(self.net.encoder(dense), expected, atol=1e-6)
+
+    def test_sampled_loss_estimates_bce(self):
+        dense = torch.from_numpy(self.matrix.toarray())
+        weights = torch.tensor([1.0, 2.0, 1.0, 3.0])
+        with torch.no_grad():
+            expected = weighted_bce(self.net(dense), dense, weights).item()
+            # Averaged over draws of the negatives the estimate is the loss
+            estimates = [
+                self.net.sampled_loss(*self.batch, weights, negatives=20).item()
+                for _ in range(300)
+            ]
+        self.assertAlmostEqual(np.mean(estimates), expected, places=2)
+
+    def test_regression_encodes_indexes(self):
+        ds = random_dataset(20, 5, seed=2)
+        reg = NeoRegression()
+        reg.fit_transform_tree_data(ds, ds.iloc[:0], ds.iloc[:0])
+        packed = reg.tree_transform.transform_packed(
+            parse_trees(ds["trees"].values).trees
+        )
+        vocabulary = len(reg.get_pred())
+        reg.aec_net = SparseAutoencoder(vocabulary - reg.ignore_first_aec_data)
+        sparse = reg.packed2flat(packed, vocabulary)
+        indices = np.concatenate([tree.indices for tree in packed])
+        counts = np.concatenate([np.diff(tree.indptr) for tree in packed])
+        # The multi-hot encodings through the dense encoder
+        dense = BaseRegression.encode_nodes(reg, indices, counts, vocabulary)
+        np.testing.assert_allclose(
+            np.concatenate([tree.features[1:] for tree in sparse]), dense, atol=1e-5
+        )
+
+    def test_fit(self):
+        samples = [[0, 20, 21], [1, 22], [2, 20, 23, 30]] * 20
+        with tempfile.TemporaryDirectory() as tmp:
+            training = AECTraining(
+                samples, io_dim=40, epochs=2, output_path=tmp, sparse=True
+            )
+            net = training.fit(os.path.join(tmp, "aec.pt"))
+        self.assertIsInstance(net, SparseAutoencoder)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import json
+import os
+import tempfile
+import unittest
+
+from benchmarks.synthetic import random_dataset
+from benchmarks.timing import (
+    RESULTS_DIR,
+    compare_results,
+    default_output,
+    write_results,
+)
+from data_preprocessing import LIST_QUERY_COLUMNS
+
+
+class TestSynthetic(unittest.TestCase):
+    def test_dataset_schema(self):
+        ds = random_dataset(10, 7, seed=1)
+        self.assertEqual(len(ds), 10)
+        for column in LIST_QUERY_COLUMNS + ["trees", "json_cardinality", "time"]:
+            self.assertIn(column, ds.columns)
+        tree = json.loads(ds["trees"].iloc[0])
+        self.assertIn(tree[0], ["JOIN", "LEFT_JOIN"])
+        self.assertTrue(json.loads(ds["json_cardinality"].iloc[0]))
+        self.assertTrue(ds.equals(random_dataset(10, 7, seed=1)))
+
+
+class TestCompareResults(unittest.TestCase):
+    def test_default_output(self):
+        # Out of the working directory, in the folder git ignores
+        path = default_output("trees")
+        self.assertEqual(path, os.path.join(RESULTS_DIR, "bench_trees.json"))
+        self.assertTrue(os.path.isdir(RESULTS_DIR))
+        self.assertEqual(os.path.basename(RESULTS_DIR), "results")
+
+    def test_regressions(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            base, new = os.path.join(tmp, "base.json"), os.path.join(tmp, "new.json")
+            write_results(
+                base,
+                "test",
+                {},
+                [{"depth": 2, "times": {"a": 1.0, "b": {"c": 1.0}}}],
+            )
+            write_results(
+                new,
+                "test",
+                {},
+                [
+                    {"depth": 2, "times": {"a": 1.1, "b": {"c": 2.0}}},
+                    {"depth": 4, "times": {"a": 9.0}},
+                ],
+            )
+            self.assertEqual(
+                compare_results(new, base, ["depth"]), [((2,), "b.c", 1.0, 2.0, 2.0)]
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import data_preprocessing
+from benchmarks.synthetic import random_dataset
+from cross_validation import (
+    cross_validate,
+    featurize,
+    fold_features,
+    stratified_folds,
+)
+from Models.model_base import BaseRegression
+from Models.model_trees_algebra import NeoRegression
+
+
+class TestFolds(unittest.TestCase):
+    def test_time_range_index(self):
+        index = data_preprocessing.time_range_index([0, 1, 2, 2.5, 150, 151])
+        names = list(data_preprocessing.TIME_RANGES)
+        self.assertEqual(index[0], -1)
+        self.assertEqual(
+            [names[i] for i in index[1:]], ["1_2", "1_2", "2_3", "100_150", "150_last"]
+        )
+
+    def test_stratified_folds(self):
+        rng = np.random.RandomState(0)
+        times = np.concatenate([rng.uniform(0.1, 2, 50), rng.uniform(20, 30, 30)])
+        folds = stratified_folds(times, 5, seed=0)
+        self.assertEqual(np.bincount(folds).tolist(), [16] * 5)
+        # every fold has the same share of every time range
+        self.assertEqual(np.bincount(folds[:50]).tolist(), [10] * 5)
+        self.assertEqual(np.bincount(folds[50:]).tolist(), [6] * 5)
+
+
+class TestCrossValidation(unittest.TestCase):
+    def test_fold_features(self):
+        # The cardinalities of the rows out of the training folds don't leak
+        ds = random_dataset(40, 7, seed=0)
+        ds.loc[0, "json_cardinality"] = json.dumps({"OTHER_PRED": 1e9})
+        data = featurize(ds)
+        reg = NeoRegression(verbose=False)
+        reg.tree_transform = data.reg.tree_transform
+        train = np.arange(1, 40)
+        features = fold_features(reg, data, train)
+        expected = NeoRegression(verbose=False)
+        expected.tree_transform = data.reg.tree_transform
+        expected.encode_cardinalities(ds["json_cardinality"].values[1:], fit=True)
+        self.assertEqual(reg.maxcardinality, expected.maxcardinality)
+        self.assertLess(reg.maxcardinality, 1e9)
+        self.assertEqual(features.shape[0], 40)
+
+    def test_cross_validate(self):
+        ds = random_dataset(240, 7, seed=0)
+        data = featurize(ds)
+        with tempfile.TemporaryDirectory() as tmp:
+            results = cross_validate(
+                data, tmp, n_folds=3, processes=2, config={"epochs": 1}
+            )
+            with open(os.path.join(tmp, "summary.json")) as f:
+                summary = json.load(f)
+            for name in ("folds.csv", "time_ranges.csv", "predictions.csv"):
+                self.assertTrue(os.path.exists(os.path.join(tmp, name)))
+            # The model of a fold predicts its rows again from the raw data
+            reg = BaseRegression.load_model(
+                os.path.join(tmp, "fold_0", "model"), map_location="cpu"
+            )
+            predictions = results["predictions"]
+            rows = predictions["row"].values[predictions["fold"].values == 0]
+            expected = predictions["prediction"].values[predictions["fold"].values == 0]
+            queries = np.column_stack(
+                [
+                    ds[data_preprocessing.LIST_QUERY_COLUMNS].values[rows],
+                    ds["json_cardinality"].values[rows],
+                ]
+            )
+            np.testing.assert_allclose(
+                np.asarray(
+                    reg.predict_raw_data(ds["trees"].values[rows], queries)
+                ).reshape(-1),
+                expected,
+                rtol=1e-4,
+            )
+
+        self.assertEqual(len(results["folds"]), 3)
+        self.assertEqual(results["folds"]["epochs"].tolist(), [1, 1, 1])
+        # every row is predicted once, by the model that did not train on it
+        predictions = results["predictions"]
+        self.assertEqual(predictions["row"].tolist(), list(range(len(ds))))
+        self.assertEqual(results["time_ranges"]["n"].sum(), len(ds))
+        self.assertAlmostEqual(
+            summary["rmse_mean"], results["folds"]["rmse"].mean(), places=6
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from custom_loss import (
+    CustomMSELoss,
+    HuberLoss,
+    LogCoshLoss,
+    QErrorLoss,
+    make_loss,
+)
+from Models.model_trees_algebra import NeoRegression
+
+
+def reference_mse(input, target, threshold, weight_factor):
+    """CustomMSELoss as it was, with a tensor of ones and torch.where"""
+    weights = torch.ones(input.size())
+    weights = torch.where(input <= threshold, weights, weights * weight_factor)
+    return torch.mean(weights * ((input - target) ** 2))
+
+
+class TestLosses(unittest.TestCase):
+    def setUp(self):
+        generator = torch.Generator().manual_seed(0)
+        self.input = torch.rand(64, 1, generator=generator)
+        self.target = torch.rand(64, 1, generator=generator)
+
+    def test_custom_mse(self):
+        loss = CustomMSELoss(0.5, weight_factor=3)
+        torch.testing.assert_close(
+            loss(self.input, self.target),
+            reference_mse(self.input, self.target, 0.5, 3),
+        )
+        self.assertIsInstance(loss.weight_factor, float)
+        torch.testing.assert_close(
+            CustomMSELoss(0.5, 1)(self.input, self.target),
+            F.mse_loss(self.input, self.target),
+        )
+
+    def test_weighted_losses(self):
+        torch.testing.assert_close(
+            HuberLoss(delta=0.2)(self.input, self.target),
+            F.huber_loss(self.input, self.target, delta=0.2),
+        )
+        torch.testing.assert_close(
+            LogCoshLoss()(self.input, self.target),
+            torch.log(torch.cosh(self.input - self.target)).mean(),
+        )
+        self.assertTrue(
+            torch.isfinite(LogCoshLoss()(torch.tensor([1e4]), torch.zeros(1)))
+        )
+        errors = HuberLoss(reduction="none")(self.input, self.target)
+        weighted = HuberLoss(threshold=0.5, weight_factor=2, reduction="sum")
+        torch.testing.assert_close(
+            weighted(self.input, self.target),
+            torch.where(self.input <= 0.5, errors, 2 * errors).sum(),
+        )
+
+    def test_qerror(self):
+        reg = NeoRegression(verbose=False)
+        latency = np.array([1.0, 10.0, 100.0, 50.0])
+        reg.pipeline.fit(latency.reshape(-1, 1))
+        predicted = np.array([2.0, 10.0, 40.0, 70.0])
+        scaled = [
+            torch.tensor(reg.pipeline.transform(y.reshape(-1, 1)), dtype=torch.float64)
+            for y in (predicted, latency)
+        ]
+        reg.loss = {"func": "qerror", "reduction": "none"}
+        loss = reg.make_loss()
+        self.assertIsInstance(loss, QErrorLoss)
+        expected = np.maximum(
+            (1 + predicted) / (1 + latency), (1 + latency) / (1 + predicted)
+        )
+        np.testing.assert_allclose(loss(*scaled).numpy().reshape(-1), expected)
+
+    def test_make_loss(self):
+        self.assertIsInstance(make_loss(), torch.nn.MSELoss)
+        self.assertIsInstance(make_loss("logcosh"), LogCoshLoss)
+        loss = make_loss({"func": "CustomMSELoss", "threshold": 50, "weight_factor": 1})
+        self.assertIsInstance(loss, CustomMSELoss)
+        self.assertEqual(loss.threshold, 50)
+        with self.assertRaises(ValueError):
+            make_loss("l1")
+        reg = NeoRegression(verbose=False, loss={"func": "huber", "delta": 0.5})
+        reg.pipeline.fit(np.array([[1.0], [10.0]]))
+        self.assertEqual(reg.make_loss().delta, 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import json
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import data_preprocessing
+
+
+class TestCardinalityEncoder(unittest.TestCase):
+    def setUp(self):
+        self.pred_to_index = {"JOIN": 0, "OTHER_PRED": 1, "p1": 2, "p2": 3}
+        self.column = [
+            json.dumps({"p1": "10", "p2": "40"}),
+            json.dumps({"p2": "20", "p3": "80", "p4": "5"}),
+            json.dumps({}),
+        ]
+
+    def test_same_as_pred2index_dict(self):
+        encoder = data_preprocessing.CardinalityEncoder(self.pred_to_index)
+        matrix = encoder.fit_transform(self.column)
+
+        max_cardinality = data_preprocessing.get_max_cardinaliy(
+            pd.DataFrame({"json_cardinality": self.column})
+        )
+        self.assertEqual(encoder.max_cardinality, max_cardinality)
+        self.assertEqual(matrix.shape, (3, 4))
+        for row, value in enumerate(self.column):
+            expected = np.zeros(4)
+            resp = data_preprocessing.pred2index_dict(
+                value, self.pred_to_index, max_cardinality
+            )
+            for key, cardinality in resp.items():
+                expected[key] = cardinality
+            np.testing.assert_allclose(matrix[row].toarray()[0], expected, rtol=1e-6)
+        self.assertEqual(encoder.unknown_predicates, {"p3": 1, "p4": 1})
+
+    def test_unknown_as_other_pred(self):
+        encoder = data_preprocessing.CardinalityEncoder(
+            self.pred_to_index, unknown="other"
+        )
+        matrix = encoder.fit_transform(self.column)
+        np.testing.assert_allclose(matrix[1].toarray()[0], [0, 85 / 80, 0, 20 / 80])
+
+    def test_transform_uses_fitted_max(self):
+        encoder = data_preprocessing.CardinalityEncoder(self.pred_to_index)
+        encoder.fit(self.column)
+        matrix = encoder.transform([{"p1": 160}])
+        np.testing.assert_allclose(matrix.toarray(), [[0, 0, 2, 0]])
+
+    def test_query_card_matrix(self):
+        encoder = data_preprocessing.CardinalityEncoder(self.pred_to_index)
+        matrix = data_preprocessing.query_card_matrix(
+            np.ones((3, 2)), encoder.fit_transform(self.column)
+        )
+        self.assertEqual(matrix.shape, (3, 6))
+        self.assertEqual(matrix.dtype, np.float32)
+        np.testing.assert_allclose(matrix[0].toarray()[0], [1, 1, 0, 0, 0.125, 0.5])
+
+
+if __name__ == "__main__":
+    unittest.main()
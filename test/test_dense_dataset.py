@@ -0,0 +1,87 @@
+import unittest
+
+import numpy as np
+import torch
+from scipy import sparse
+
+from dense_dataset import DenseDataset, dense_features
+from net_baseline import DenseNet
+
+
+def random_rows(n, num_features, num_preds, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for _ in range(n):
+        preds = rng.choice(num_preds, size=rng.integers(0, 4), replace=False)
+        card = {int(pred): float(rng.random()) for pred in preds}
+        rows.append(list(rng.normal(size=num_features)) + [card])
+    return rows
+
+
+def collate_features(rows, num_preds):
+    """Features as DenseRegression.collate built them, one row at a time"""
+    features = []
+    for query in rows:
+        b = np.zeros(num_preds)
+        for key in query[-1].keys():
+            b[key] = query[-1][key]
+        features.append(np.concatenate([query[:-1], b]))
+    return np.asarray(features, dtype=np.float32)
+
+
+class TestDenseDataset(unittest.TestCase):
+    def test_same_features_as_collate(self):
+        rows = random_rows(50, 5, 12)
+        np.testing.assert_allclose(
+            dense_features(rows, 12), collate_features(rows, 12), rtol=1e-6
+        )
+        self.assertEqual(dense_features(np.ones((3, 4))).dtype, np.float32)
+
+    def test_cardinality_block(self):
+        rows = random_rows(20, 5, 12, seed=1)
+        cards = sparse.csr_matrix(collate_features(rows, 12)[:, 5:])
+        query = [row[:-1] for row in rows]
+        y = np.ones(len(rows))
+        np.testing.assert_allclose(
+            DenseDataset.from_queries(query, y, cards=cards).features.numpy(),
+            DenseDataset.from_queries(rows, y, num_preds=12).features.numpy(),
+        )
+
+    def test_target_range(self):
+        rows = random_rows(6, 3, 4, seed=2)
+        y = np.array([0.0, 5.0, 70.0, 71.0, -1.0, 30.0])
+        dataset = DenseDataset.from_queries(rows, y, 4, target_range=(0, 70))
+        self.assertEqual(dataset.targets.reshape(-1).tolist(), [5.0, 70.0, 30.0])
+        np.testing.assert_allclose(
+            dataset.features.numpy(), collate_features(rows, 4)[[1, 2, 5]]
+        )
+
+    def test_batches(self):
+        dataset = DenseDataset(np.arange(10).reshape(10, 1), np.arange(10))
+        self.assertEqual(dataset.num_batches(4), 3)
+        batches = list(dataset.batches(4, shuffle=True))
+        self.assertEqual([len(x) for x, _ in batches], [4, 4, 2])
+        features = torch.cat([x for x, _ in batches]).reshape(-1)
+        targets = torch.cat([y for _, y in batches]).reshape(-1)
+        self.assertTrue(torch.equal(features, targets))
+        self.assertEqual(sorted(features.tolist()), list(range(10)))
+
+    def test_training_step(self):
+        torch.manual_seed(0)
+        rows = random_rows(64, 5, 12, seed=3)
+        dataset = DenseDataset.from_queries(rows, np.linspace(0, 1, 64), 12)
+        net = DenseNet(dataset.features.shape[1], [16], 1)
+        optimizer = torch.optim.Adam(net.parameters(), lr=0.01)
+        losses = []
+        for _ in range(20):
+            for x, y in dataset.batches(16, shuffle=True):
+                loss = torch.nn.functional.mse_loss(net(x), y)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+            losses.append(loss.item())
+        self.assertLess(np.mean(losses[-5:]), np.mean(losses[:5]))
+
+
+if __name__ == "__main__":
+    unittest.main()
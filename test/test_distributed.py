@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+
+import joblib
+import torch
+
+import distributed
+from benchmarks.synthetic import random_dataset
+from data_preprocessing import LIST_QUERY_COLUMNS
+
+
+def train_worker(output):
+    from Models.model_trees_algebra import NeoRegression
+
+    ds = random_dataset(300, 5, seed=0)
+    ds_val = random_dataset(60, 5, seed=1)
+    reg = NeoRegression(epochs=2, output_path=output, distributed=True)
+    reg.fit_transform_tree_data(ds, ds_val, ds_val)
+    card = reg.encode_cardinalities(ds["json_cardinality"].values, fit=True)
+    card_val = reg.encode_cardinalities(ds_val["json_cardinality"].values)
+    reg.fit(
+        ds["trees"].values,
+        ds[LIST_QUERY_COLUMNS].values.astype(float),
+        ds["time"].values,
+        ds_val["trees"].values,
+        ds_val[LIST_QUERY_COLUMNS].values.astype(float),
+        ds_val["time"].values,
+        X_card=card,
+        X_val_card=card_val,
+    )
+    rank = distributed.get_rank()
+    joblib.dump(
+        {"state": reg.net.state_dict(), "history": reg.history},
+        os.path.join(output, "rank{}.pkl".format(rank)),
+    )
+
+
+class TestDistributed(unittest.TestCase):
+    def test_not_distributed(self):
+        self.assertFalse(distributed.is_distributed())
+        self.assertEqual(distributed.get_world_size(), 1)
+        self.assertTrue(distributed.is_main_process())
+        self.assertEqual(distributed.broadcast_object(3), 3)
+        self.assertEqual(distributed.all_gather_list((1, 2)), [1, 2])
+
+    def test_ranks_stay_in_sync(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "model")
+            os.mkdir(output)
+            distributed.spawn(train_worker, 2, output)
+            rank0 = joblib.load(os.path.join(output, "rank0.pkl"))
+            rank1 = joblib.load(os.path.join(output, "rank1.pkl"))
+            # only rank 0 saves checkpoints
+            self.assertTrue(os.path.exists(os.path.join(tmp, "checkpoint.pt")))
+
+        for name, value in rank0["state"].items():
+            self.assertTrue(torch.equal(value, rank1["state"][name]), name)
+        # metrics are computed on the predictions of both ranks
+        self.assertEqual(rank0["history"], rank1["history"])
+        self.assertEqual(len(rank0["history"]["rmse_val_by_epoch"]), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
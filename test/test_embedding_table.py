@@ -0,0 +1,79 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from benchmarks.synthetic import random_dataset
+from embedding_table import NodeEmbeddingTable
+from json_parser import parse_trees
+from Models.model_trees_algebra_aec import NeoRegression
+from net import Autoencoder, SparseAutoencoder
+
+
+class TestNodeEmbeddingTable(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        ds = random_dataset(40, 6, seed=3)
+        cls.reg = NeoRegression()
+        cls.reg.fit_transform_tree_data(ds, ds.iloc[:0], ds.iloc[:0])
+        cls.trees = parse_trees(ds["trees"].values).trees
+        cls.vocabulary = len(cls.reg.get_pred())
+        cls.io_dim = cls.vocabulary - cls.reg.ignore_first_aec_data
+
+    def packed(self):
+        return self.reg.tree_transform.transform_packed(self.trees)
+
+    def features(self, aec_net, table):
+        self.reg.aec_net = aec_net
+        self.reg.set_embedding_table(table)
+        flat = self.reg.packed2flat(self.packed_trees, self.vocabulary)
+        return np.concatenate([tree.features for tree in flat])
+
+    def test_same_features(self):
+        torch.manual_seed(0)
+        for aec_net in (Autoencoder(self.io_dim), SparseAutoencoder(self.io_dim)):
+            self.packed_trees = self.packed()
+            expected = self.features(aec_net.eval(), None)
+            table = NodeEmbeddingTable.build(self.packed_trees, aec_net.encoder)
+            self.assertLess(len(table), sum(map(len, self.packed_trees)))
+            np.testing.assert_allclose(
+                self.features(aec_net, table), expected, atol=1e-5
+            )
+
+    def test_missing_and_stale_ids(self):
+        torch.manual_seed(0)
+        aec_net = Autoencoder(self.io_dim).eval()
+        self.packed_trees = self.packed()
+        expected = self.features(aec_net, None)
+        # A table of half of the trees, the nodes of the rest are encoded
+        table = NodeEmbeddingTable.build(self.packed_trees[:20], aec_net.encoder)
+        np.testing.assert_allclose(self.features(aec_net, table), expected, atol=1e-5)
+        # Trees with the rows of another table get the rows of this one
+        other = NodeEmbeddingTable.build(self.packed_trees, aec_net.encoder)
+        np.testing.assert_allclose(self.features(aec_net, table), expected, atol=1e-5)
+        np.testing.assert_allclose(self.features(aec_net, other), expected, atol=1e-5)
+
+    def test_save_load(self):
+        torch.manual_seed(0)
+        aec_net = SparseAutoencoder(self.io_dim).eval()
+        packed = self.packed()
+        with tempfile.TemporaryDirectory() as tmp:
+            table = NodeEmbeddingTable.build(
+                packed, aec_net.encoder, path=os.path.join(tmp, "mapped.npy")
+            )
+            self.assertIsInstance(table.embeddings, np.memmap)
+            path = os.path.join(tmp, "table")
+            table.save(path)
+            loaded = NodeEmbeddingTable.load(path)
+            self.assertEqual(loaded.keys, table.keys)
+            np.testing.assert_array_equal(
+                loaded.lookup(packed, aec_net.encoder),
+                table.lookup(packed, aec_net.encoder),
+            )
+            del table, loaded
+
+
+if __name__ == "__main__":
+    unittest.main()
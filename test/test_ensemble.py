@@ -0,0 +1,115 @@
+import unittest
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from benchmarks.synthetic import random_dataset
+from data_preprocessing import LIST_QUERY_COLUMNS
+from ensemble import EnsemblePredictor
+from test.helpers import fitted_regressor
+from transforms import QueryScaler
+
+
+def make_member(seed, tree_units=None):
+    # every member with its own target scale, on the dataset of the tests
+    reg, _, _, _ = fitted_regressor(
+        150, 7, seed=seed, data_seed=0, target_scale=seed + 1, tree_units=tree_units
+    )
+    return reg
+
+
+class TestEnsemble(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.ds = random_dataset(150, 7, seed=0)
+        cls.query = cls.ds[LIST_QUERY_COLUMNS].values.astype(float)
+
+    def predict_members(self, members):
+        card = members[0].encode_cardinalities(self.ds["json_cardinality"].values)
+        expected = np.stack(
+            [
+                np.asarray(
+                    member.predict_raw_data(self.ds["trees"].values, self.query, card)
+                ).reshape(-1)
+                for member in members
+            ]
+        )
+        return card, expected
+
+    def test_same_as_members(self):
+        members = [make_member(seed) for seed in range(3)]
+        card, expected = self.predict_members(members)
+        for stacked in (False, True):
+            ensemble = EnsemblePredictor(members, stacked=stacked)
+            self.assertEqual(ensemble.stacked, stacked)
+            mean, variance, predictions = ensemble.predict_raw_data(
+                self.ds["trees"].values, self.query, card, batch_size=64
+            )
+            np.testing.assert_allclose(predictions, expected, rtol=1e-4)
+            np.testing.assert_allclose(mean, expected.mean(axis=0), rtol=1e-4)
+            np.testing.assert_allclose(
+                variance, expected.var(axis=0), rtol=1e-3, atol=1e-6
+            )
+
+    def test_different_architectures_not_stacked(self):
+        members = [
+            make_member(0, tree_units=[16, 8]),
+            make_member(1, tree_units=[32, 8]),
+        ]
+        card, expected = self.predict_members(members)
+        ensemble = EnsemblePredictor(members, stacked=True)
+        self.assertFalse(ensemble.stacked)
+        _, _, predictions = ensemble.predict_raw_data(
+            self.ds["trees"].values, self.query, card
+        )
+        np.testing.assert_allclose(predictions, expected, rtol=1e-4)
+
+    def test_members_of_folds(self):
+        # Every member with its cardinality encoder and query scaler, as the
+        # models of the folds of cross_validation
+        members = []
+        for seed in range(2):
+            member, ds, query, _ = fitted_regressor(150, 7, seed=seed, data_seed=0)
+            member.encode_cardinalities(
+                ds["json_cardinality"].values[: 50 + 100 * seed], fit=True
+            )
+            member.query_scaler = QueryScaler(query.mean(axis=0) * seed, seed + 1.0)
+            members.append(member)
+        self.assertNotEqual(members[0].maxcardinality, members[1].maxcardinality)
+        queries = np.column_stack(
+            [self.query.astype(object), self.ds["json_cardinality"].values]
+        )
+        expected = np.stack(
+            [
+                np.asarray(
+                    member.predict_raw_data(self.ds["trees"].values, queries)
+                ).reshape(-1)
+                for member in members
+            ]
+        )
+        for stacked in (False, True):
+            _, _, predictions = EnsemblePredictor(
+                members, stacked=stacked
+            ).predict_raw_data(self.ds["trees"].values, queries)
+            np.testing.assert_allclose(predictions, expected, rtol=1e-4)
+
+        card = members[0].encode_cardinalities(self.ds["json_cardinality"].values)
+        with self.assertRaises(ValueError):
+            EnsemblePredictor(members).predict_raw_data(
+                self.ds["trees"].values, self.query, card
+            )
+
+    def test_different_autoencoders(self):
+        members = [make_member(0), make_member(1)]
+        for seed, member in enumerate(members):
+            torch.manual_seed(seed)
+            member.aec_net = nn.Linear(4, 2)
+        with self.assertRaises(ValueError):
+            EnsemblePredictor(members)
+        members[1].aec_net.load_state_dict(members[0].aec_net.state_dict())
+        self.assertEqual(len(EnsemblePredictor(members)), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from data_preprocessing import TIME_RANGES
+from evaluation import evaluate, format_report, q_errors, report_path, write_report
+
+
+class TestEvaluation(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.y_true = rng.lognormal(1, 1.5, 5000)
+        self.y_pred = self.y_true * rng.lognormal(0, 0.5, 5000)
+
+    def test_overall(self):
+        report = evaluate(self.y_pred, self.y_true)
+        errors = self.y_pred - self.y_true
+        q = np.maximum(self.y_pred / self.y_true, self.y_true / self.y_pred)
+        self.assertEqual(report["count"], 5000)
+        self.assertAlmostEqual(report["rmse"], np.sqrt(np.mean(errors**2)))
+        self.assertAlmostEqual(report["mae"], np.mean(np.abs(errors)))
+        np.testing.assert_allclose(
+            [report["qerror"][key] for key in ("p50", "p90", "p99")],
+            np.percentile(q, [50, 90, 99]),
+        )
+        self.assertAlmostEqual(report["qerror"]["max"], q.max())
+        json.dumps(report)
+
+    def test_buckets(self):
+        report = evaluate(self.y_pred, self.y_true)
+        self.assertEqual(list(report["buckets"]), list(TIME_RANGES))
+        q = q_errors(self.y_pred, self.y_true)
+        for name, (low, high) in TIME_RANGES.items():
+            mask = (self.y_true > low) & (self.y_true <= high)
+            metrics = report["buckets"][name]
+            self.assertEqual(metrics["count"], mask.sum())
+            if not mask.any():
+                continue
+            errors = self.y_pred[mask] - self.y_true[mask]
+            self.assertAlmostEqual(metrics["rmse"], np.sqrt(np.mean(errors**2)))
+            np.testing.assert_allclose(
+                [metrics["qerror"][key] for key in ("p50", "p90", "p99")],
+                np.percentile(q[mask], [50, 90, 99]),
+            )
+            predicted = (self.y_pred[mask] > low) & (self.y_pred[mask] <= high)
+            self.assertAlmostEqual(metrics["bucket_accuracy"], predicted.mean())
+
+    def test_edge_cases(self):
+        report = evaluate([0.0, 3.0], [0.0, 1.5])
+        # The zero latency is in no bucket, its q-error is 1
+        self.assertEqual(report["count"], 2)
+        self.assertEqual(report["qerror"]["max"], 2.0)
+        self.assertEqual(report["buckets"]["1_2"]["count"], 1)
+        self.assertEqual(report["buckets"]["150_last"], {"count": 0})
+        self.assertEqual(format_report(evaluate([], [])), "No predictions")
+        with self.assertRaises(ValueError):
+            evaluate([1.0], [1.0, 2.0])
+
+    def test_write_report(self):
+        report = evaluate(self.y_pred, self.y_true)
+        self.assertEqual(
+            len(format_report(report).splitlines()),
+            1 + sum(1 for metrics in report["buckets"].values() if metrics["count"]),
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            path = write_report(report, tmp)
+            self.assertEqual(path, os.path.join(tmp, "evaluation.json"))
+            artifact = os.path.join(tmp, "model.safetensors")
+            self.assertEqual(
+                report_path(artifact), os.path.join(tmp, "model.evaluation.json")
+            )
+            with open(path) as f:
+                self.assertEqual(json.load(f)["count"], 5000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+
+from featurize import SPARQLTreeFeaturizer, bits_to_indexes, map_tree
+
+
+class TestEncodeTree(unittest.TestCase):
+    def setUp(self):
+        self.trees = [
+            ["JOIN", ["VAR_URI_VARᶲp1"], ["LEFT_JOIN", ["VAR_URI_URIᶲp2"], ["x"]]],
+            ["VAR_URI_VARᶲp1ᶲp3"],
+        ]
+        self.featurizer = SPARQLTreeFeaturizer()
+        self.featurizer.fit(self.trees)
+        self.index = self.featurizer.get_pred_index()
+
+    def node_indexes(self, packed):
+        return [
+            packed.indices[packed.indptr[i] : packed.indptr[i + 1]].tolist()
+            for i in range(len(packed))
+        ]
+
+    def test_joins_get_childs_predicates(self):
+        packed = self.featurizer.transform_packed(self.trees)[0]
+        p1, p2 = self.index["p1"], self.index["p2"]
+        # preorder: JOIN, leaf p1, LEFT_JOIN, leaf p2, leaf x
+        self.assertEqual(
+            self.node_indexes(packed),
+            [
+                [self.index["JOIN"], p1, p2],
+                [self.index["VAR_URI_VAR"], p1],
+                [self.index["LEFT_JOIN"], p2],
+                [self.index["VAR_URI_URI"], p2],
+                [self.index["OTHER_TPF"]],
+            ],
+        )
+        self.assertEqual(
+            packed.conv_indexes.ravel().tolist(),
+            [1, 2, 3, 2, 0, 0, 3, 4, 5, 4, 0, 0, 5, 0, 0],
+        )
+        self.assertEqual(
+            self.featurizer.transform_packed(self.trees)[1].indices.size, 3
+        )
+
+    def test_fixed_joins_are_kept(self):
+        tree = ["JOINᶲp3", ["JOIN", ["VAR_URI_VARᶲp1"], ["x"]], ["x"]]
+        packed = self.featurizer.transform_packed([tree])[0]
+        # the inner join is not fixed, as BaseRegression.fix_tree
+        self.assertEqual(
+            self.node_indexes(packed)[:2],
+            [[self.index["JOIN"], self.index["p3"]], [self.index["JOIN"]]],
+        )
+
+    def test_join_without_predicates(self):
+        packed = self.featurizer.transform_packed([["JOIN", ["x"], ["y"]]])[0]
+        self.assertEqual(
+            self.node_indexes(packed)[0],
+            [self.index["JOIN"], self.index["OTHER_PRED"]],
+        )
+
+    def test_unknown_predicates_in_joins(self):
+        tree = ["JOIN", ["VAR_URI_VARᶲu1ᶲp1"], ["VAR_URI_VARᶲu2ᶲp1"]]
+        packed = self.featurizer.transform_packed([tree])[0]
+        other = self.index["OTHER_PRED"]
+        # leaves keep a count by token, joins the set of their childs
+        self.assertEqual(
+            self.node_indexes(packed),
+            [
+                [self.index["JOIN"], other, self.index["p1"]],
+                [self.index["VAR_URI_VAR"], other, self.index["p1"]],
+                [self.index["VAR_URI_VAR"], other, self.index["p1"]],
+            ],
+        )
+
+    def test_bits_to_indexes(self):
+        self.assertEqual(bits_to_indexes(0), [])
+        self.assertEqual(bits_to_indexes((1 << 3) | (1 << 70) | 1), [0, 3, 70])
+
+    def test_deep_tree(self):
+        tree = ["VAR_URI_VARᶲp1"]
+        for _ in range(5000):
+            tree = ["JOIN", tree, ["VAR_URI_URIᶲp2"]]
+        featurizer = SPARQLTreeFeaturizer()
+        featurizer.fit([tree])
+        self.assertIn("p2", featurizer.get_pred_index())
+        packed = featurizer.transform_packed([tree])[0]
+        self.assertEqual(len(packed), 10001)
+        self.assertEqual(len(map_tree(tree, lambda x: isinstance(x, list), str)), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,173 @@
+import contextlib
+import copy
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from scipy import sparse
+from sklearn.ensemble import HistGradientBoostingRegressor
+
+from benchmarks.synthetic import random_dataset
+from data_preprocessing import LIST_QUERY_COLUMNS
+from Models.model_base import BaseRegression
+from Models.model_gbt import (
+    FlatForest,
+    GBTRegression,
+    hash_cardinalities,
+    plan_statistics,
+)
+from train import parse_args, train_and_save_model
+
+
+def fitted(ds, **kvargs):
+    reg = GBTRegression(max_iter=60, eval_every=20, **kvargs)
+    trees, _, _ = reg.fit_transform_tree_data(ds, ds.iloc[:0], ds.iloc[:0])
+    cards = reg.encode_cardinalities(ds["json_cardinality"].values, fit=True)
+    query = ds[LIST_QUERY_COLUMNS].values.astype(float)
+    return reg, trees, query, cards
+
+
+class TestPlanStatistics(unittest.TestCase):
+    def test_statistics(self):
+        ds = random_dataset(10, 5, seed=0)
+        reg, _, _, _ = fitted(ds)
+        preds = [pred for pred in reg.get_pred() if pred.startswith("http")]
+        leaf = "VAR_URI_VARᶲ{}"
+        deep = [
+            "JOIN",
+            [
+                "LEFT_JOIN",
+                [leaf.format(preds[0])],
+                [leaf.format(preds[1]) + "ᶲ" + preds[2]],
+            ],
+            [leaf.format(preds[0])],
+        ]
+        trees = [deep, [leaf.format(preds[3])]]
+        stats = plan_statistics(
+            reg.tree_transform.transform_packed(trees), reg.ignore_first_aec_data
+        )
+        types = reg.get_pred()
+        # nodes, leaves, depth, predicates of the leaves, most in a leaf, distinct
+        np.testing.assert_array_equal(stats[0, :6], [5, 3, 2, 4, 2, 3])
+        np.testing.assert_array_equal(stats[1, :6], [1, 1, 0, 1, 1, 1])
+        self.assertEqual(stats[0, 6 + types["JOIN"]], 1)
+        self.assertEqual(stats[0, 6 + types["LEFT_JOIN"]], 1)
+        self.assertEqual(stats[0, 6 + types["VAR_URI_VAR"]], 3)
+        self.assertEqual(plan_statistics([]).shape, (0, 24))
+
+    def test_hash_cardinalities(self):
+        cards = sparse.random(20, 300, density=0.05, format="csr", random_state=0)
+        hashed = hash_cardinalities(cards, 16)
+        self.assertEqual(hashed.shape, (20, 19))
+        np.testing.assert_allclose(
+            hashed[:, :16].sum(1), np.asarray(cards.sum(1)).reshape(-1), rtol=1e-5
+        )
+        np.testing.assert_array_equal(hashed[:, 16], np.diff(cards.indptr))
+        np.testing.assert_allclose(
+            hashed[:, 18], cards.max(axis=1).toarray().reshape(-1), rtol=1e-6
+        )
+
+
+class TestGBTRegression(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.ds = random_dataset(300, 9, seed=4)
+        cls.reg, cls.trees, cls.query, cls.cards = fitted(cls.ds)
+        y = cls.ds["time"].values
+        cls.reg.fit(
+            cls.trees, cls.query, y, cls.trees, cls.query, y, cls.cards, cls.cards
+        )
+
+    def test_fit(self):
+        y = self.ds["time"].values
+        predictions = np.asarray(
+            self.reg.predict_raw_data(self.trees, self.query, self.cards)
+        )
+        self.assertEqual(predictions.shape, (len(y),))
+        rmse = np.sqrt(np.mean((predictions - y) ** 2))
+        self.assertLess(rmse, 0.5 * np.std(y))
+        self.assertEqual(len(self.reg.history["rmse_val_by_epoch"]), 3)
+        self.assertEqual(self.reg.model.n_iter_, 60)
+        # Small batches are predicted by the FlatForest
+        np.testing.assert_allclose(
+            self.reg.predict_raw_data(
+                self.ds["trees"].values[:10], self.query[:10], self.cards[:10]
+            ),
+            predictions[:10],
+        )
+
+    def test_flat_forest(self):
+        rng = np.random.RandomState(0)
+        X = rng.normal(size=(200, 4))
+        X[rng.rand(200, 4) < 0.1] = np.nan
+        y = np.nan_to_num(X[:, 0]) * 2 + np.nan_to_num(X[:, 1]) ** 2
+        model = HistGradientBoostingRegressor(max_iter=30).fit(X, y)
+        np.testing.assert_allclose(FlatForest(model).predict(X), model.predict(X))
+        np.testing.assert_allclose(
+            FlatForest(model).predict(X[:1]), model.predict(X[:1])
+        )
+
+    def test_flat_forest_fallback(self):
+        features, _ = self.reg.features(self.trees, self.query, self.cards)
+        np.testing.assert_allclose(
+            self.reg.forest.predict(features), self.reg.model.predict(features)
+        )
+        expected = self.reg.predict_raw_data(
+            self.ds["trees"].values[:10], self.query[:10], self.cards[:10]
+        )
+        # Without the private attributes of sklearn the forest isn't built
+        reg = copy.copy(self.reg)
+        model = copy.deepcopy(self.reg.model)
+        del model._predictors
+        with contextlib.redirect_stdout(io.StringIO()):
+            reg.set_model(model)
+        self.assertIsNone(reg.forest)
+        reg.model = self.reg.model
+        np.testing.assert_allclose(
+            reg.predict_raw_data(
+                self.ds["trees"].values[:10], self.query[:10], self.cards[:10]
+            ),
+            expected,
+        )
+
+    def test_json_cardinalities(self):
+        column = np.column_stack([self.query, self.ds["json_cardinality"].values])
+        np.testing.assert_allclose(
+            self.reg.predict_raw_data(self.ds["trees"].values, column),
+            self.reg.predict_raw_data(self.trees, self.query, self.cards),
+        )
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "regressor")
+            self.reg.save(path)
+            with open(os.path.join(path, "config.json")) as f:
+                self.assertEqual(json.load(f)["config"]["hash_dim"], 64)
+            loaded = BaseRegression.load_model(path)
+        self.assertIsInstance(loaded, GBTRegression)
+        np.testing.assert_allclose(
+            loaded.predict_raw_data(self.trees, self.query, self.cards),
+            self.reg.predict_raw_data(self.trees, self.query, self.cards),
+        )
+
+
+class TestTrainArguments(unittest.TestCase):
+    def test_not_distributed(self):
+        required = ["--data-dir", "data", "--output-dir", "output", "--gbt"]
+        self.assertTrue(parse_args(required).gbt)
+        with contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                parse_args(required + ["--nprocs", "2"])
+            with mock.patch.dict(os.environ, {"WORLD_SIZE": "2"}):
+                with self.assertRaises(SystemExit):
+                    parse_args(required)
+        with self.assertRaises(ValueError):
+            train_and_save_model(None, None, None, "output", gbt=True, distributed=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
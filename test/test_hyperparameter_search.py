@@ -0,0 +1,122 @@
+import os
+import random
+import tempfile
+import unittest
+
+import pandas as pd
+
+import hyperparameter_search
+from benchmarks.synthetic import random_dataset
+from hyperparameter_search import (
+    SuccessiveHalving,
+    TPESampler,
+    configure,
+    featurize,
+    search,
+)
+
+SPACE = {
+    "tree_units": [[32, 16], [64, 32]],
+    "tree_units_dense": [[16, 8]],
+    "query_hidden_inputs": [[32, 32]],
+    "query_output": [16],
+    "lr": {"loguniform": [1e-4, 1e-2]},
+    "early_stop_patience": [10],
+}
+
+
+class TestSuccessiveHalving(unittest.TestCase):
+    def test_rungs(self):
+        self.assertEqual(SuccessiveHalving(1, 27, 3).rungs, [1, 3, 9, 27])
+        self.assertEqual(SuccessiveHalving(2, 10, 3).rungs, [2, 6, 10])
+        self.assertEqual(SuccessiveHalving(10, 10, 3).rungs, [10])
+
+    def test_asha_promotes_top_of_rung(self):
+        halving = SuccessiveHalving(1, 9, 3)
+        halving.report(0, 0, 2.0)
+        halving.report(1, 0, 3.0)
+        self.assertIsNone(halving.promotion([], False))
+        halving.report(2, 0, 1.0)
+        self.assertEqual(halving.promotion([], False), (2, 1))
+        self.assertIsNone(halving.promotion([], False))
+
+    def test_sha_waits_for_rung(self):
+        halving = SuccessiveHalving(1, 9, 3, synchronous=True)
+        for trial, rmse in enumerate([2.0, 3.0, 1.0]):
+            halving.report(trial, 0, rmse)
+        self.assertIsNone(halving.promotion([0], True))
+        self.assertIsNone(halving.promotion([], False))
+        self.assertEqual(halving.promotion([], True), (2, 1))
+
+    def test_stopped_trials_not_promoted(self):
+        halving = SuccessiveHalving(1, 9, 3)
+        halving.report(0, 0, 1.0, stopped=True)
+        halving.report(1, 0, 2.0)
+        halving.report(2, 0, 3.0)
+        self.assertIsNone(halving.promotion([], False))
+
+
+class TestSamplers(unittest.TestCase):
+    def test_tpe_samples_in_space(self):
+        sampler = TPESampler(SPACE, seed=0, n_startup=3)
+        rng = random.Random(0)
+        for trial in range(10):
+            config = sampler.sample()
+            self.assertIn(config["tree_units"], SPACE["tree_units"])
+            self.assertTrue(1e-4 <= config["lr"] <= 1e-2)
+            sampler.tell(trial, config, rng.random())
+
+    def test_tpe_by_rung(self):
+        # RMSEs of a rung are compared only with the same rung
+        sampler = TPESampler({"x": ["a", "b", "c"]}, seed=0, n_startup=4)
+        for trial, x in enumerate("aabbccab"):
+            sampler.tell(trial, {"x": x}, 0.1 if x == "a" else 1.0, rung=0)
+        for trial, x in enumerate("bc"):
+            sampler.tell(trial, {"x": x}, 0.1 if x == "b" else 1.0, rung=1)
+        self.assertEqual(sampler.sample()["x"], "a")
+        for trial, x in enumerate("ac", 2):
+            sampler.tell(trial, {"x": x}, 1.0, rung=1)
+        self.assertEqual(sampler.sample()["x"], "b")
+
+    def test_configure(self):
+        reg = hyperparameter_search.NeoRegression(verbose=False)
+        configured = configure(reg, {"lr": 0.5, "tree_units": [8]})
+        self.assertEqual(configured.optimizer["args"]["lr"], 0.5)
+        self.assertEqual(configured.tree_units, [8])
+        self.assertNotEqual(reg.optimizer["args"]["lr"], 0.5)
+        with self.assertRaises(ValueError):
+            configure(reg, {"unknown": 1})
+
+
+class TestSearch(unittest.TestCase):
+    def test_search_writes_leaderboard(self):
+        data = featurize(random_dataset(200, 5, seed=0), random_dataset(50, 5, seed=1))
+        with tempfile.TemporaryDirectory() as tmp:
+            leaderboard = search(
+                data,
+                tmp,
+                space=SPACE,
+                n_trials=4,
+                processes=2,
+                min_epochs=1,
+                max_epochs=3,
+                eta=3,
+            )
+            written = pd.read_csv(os.path.join(tmp, "leaderboard.csv"))
+            self.assertTrue(os.path.exists(os.path.join(tmp, "best_config.json")))
+
+        self.assertEqual(len(written), 4)
+        self.assertEqual(sorted(written["trial"]), [0, 1, 2, 3])
+        self.assertTrue(written["val_rmse"].is_monotonic_increasing)
+        # the best of the first rung went on to max_epochs
+        self.assertEqual(leaderboard["epochs"].max(), 3)
+        self.assertEqual(leaderboard["epochs"].min(), 1)
+
+    def test_no_trials(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.assertRaises(ValueError):
+                search(None, tmp, space=SPACE, n_trials=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import json
+import unittest
+
+import json_parser
+
+
+class TestParseTrees(unittest.TestCase):
+    def setUp(self):
+        self.trees = [
+            ["JOIN", ["VAR_URI_VARᶲp1"], ["VAR_URI_URIᶲp2ᶲp3"]],
+            ["VAR_URI_VARᶲp1"],
+            ["LEFT_JOIN", ["JOIN", ["VAR_URI_VARᶲp1"], ["URI_URI_VARᶲp2"]], ["x"]],
+        ]
+        self.column = [json.dumps(tree) for tree in self.trees]
+
+    def test_parse_column(self):
+        for backend in ["auto", "json"]:
+            parsed = json_parser.parse_trees(self.column, backend=backend)
+            self.assertEqual(parsed.trees, self.trees)
+            self.assertEqual(parsed.rows.tolist(), [0, 1, 2])
+            self.assertEqual(parsed.errors, [])
+
+    def test_bad_rows_in_report(self):
+        column = list(self.column)
+        column.insert(1, '["JOIN", ["x"]')
+        column.insert(3, '["JOIN", ["x"], 3]')
+        column.append(float("nan"))
+        parsed = json_parser.parse_trees(column, backend="json")
+
+        self.assertEqual(parsed.trees, self.trees)
+        self.assertEqual(parsed.rows.tolist(), [0, 2, 4])
+        self.assertEqual([row for row, _ in parsed.errors], [1, 3, 5])
+        report = parsed.report()
+        self.assertEqual(report["rows"], 6)
+        self.assertEqual(report["parsed"], 3)
+        self.assertTrue(report["errors"][1]["error"].startswith("TreeSchemaError"))
+
+    def test_rows_merged_when_joined(self):
+        # Both rows are bad but joined with a comma they are a valid json list
+        column = ['["VAR_URI_VARᶲp1"]', '["JOIN"', '["x"], ["y"]]']
+        parsed = json_parser.parse_trees(column, backend="json")
+        self.assertEqual(parsed.rows.tolist(), [0])
+        self.assertEqual(len(parsed.errors), 2)
+
+    def test_validate_tree(self):
+        json_parser.validate_tree(self.trees[2])
+        with self.assertRaises(json_parser.TreeSchemaError):
+            json_parser.validate_tree(["JOIN", ["x"]])
+        with self.assertRaises(json_parser.TreeSchemaError):
+            json_parser.validate_tree([1])
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            json_parser.get_backend("yaml")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+import numpy as np
+
+from node_memo import NodeMemo
+from test.helpers import fitted_regressor
+
+
+class TestNodeMemo(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        reg, ds, cls.query, _ = fitted_regressor(60, 9)
+        cls.reg = reg
+        # every plan twice, with other query features the second time
+        cls.trees = np.concatenate([ds["trees"].values] * 2)
+        cls.query = np.concatenate([cls.query, cls.query[::-1]])
+        cls.card = np.concatenate([np.arange(60), np.arange(60)[::-1]])
+        cls.card = reg.encode_cardinalities(ds["json_cardinality"].values)[cls.card]
+
+    def predict(self, memo):
+        self.reg.set_node_memo(memo)
+        try:
+            return np.asarray(
+                self.reg.predict_raw_data(self.trees, self.query, self.card)
+            ).reshape(-1)
+        finally:
+            self.reg.set_node_memo(None)
+
+    def test_same_predictions(self):
+        expected = self.predict(None)
+        for max_entries in (0, 1000):
+            memo = NodeMemo(max_entries=max_entries)
+            np.testing.assert_allclose(self.predict(memo), expected, rtol=1e-4)
+            stats = memo.stats()
+            self.assertLess(stats["unique"], stats["nodes"])
+
+    def test_cache_across_batches(self):
+        memo = NodeMemo(max_entries=1000)
+        self.predict(memo)
+        projected = memo.projected
+        self.predict(memo)
+        # every node was projected in the first call
+        self.assertEqual(memo.projected, projected)
+        self.assertGreater(memo.stats()["cache_hit_rate"], 0.4)
+
+        self.reg.set_node_memo(memo)
+        self.reg.invalidate_caches()
+        self.reg.set_node_memo(None)
+        self.assertEqual(memo.stats()["cache_entries"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
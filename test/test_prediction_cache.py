@@ -0,0 +1,77 @@
+import json
+import pickle
+import unittest
+
+import numpy as np
+
+from prediction_cache import PredictionCache, tree_key
+from test.helpers import fitted_regressor
+
+
+class TestPredictionCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = PredictionCache(max_entries=2)
+        cache.put(b"a", 1)
+        cache.put(b"b", 2)
+        self.assertEqual(cache.get(b"a"), 1)
+        cache.put(b"c", 3)
+        # b is the least recently used
+        self.assertIsNone(cache.get(b"b"))
+        self.assertEqual(cache.get(b"c"), 3)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["entries"], 2)
+
+    def test_ttl_and_bytes(self):
+        cache = PredictionCache(ttl=0)
+        cache.put(b"a", 1)
+        self.assertIsNone(cache.get(b"a"))
+        self.assertEqual(cache.stats()["expirations"], 1)
+        self.assertEqual(cache.bytes, 0)
+
+        cache = PredictionCache(max_bytes=1000)
+        for i in range(100):
+            cache.put(str(i).encode(), np.zeros(1))
+        self.assertLessEqual(cache.bytes, 1000)
+        self.assertGreater(cache.evictions, 0)
+        self.assertIsNotNone(cache.get(b"99"))
+
+    def test_copies_are_empty(self):
+        cache = PredictionCache(max_entries=5, ttl=10)
+        cache.put(b"a", 1)
+        copy = pickle.loads(pickle.dumps(cache))
+        self.assertEqual(len(copy), 0)
+        self.assertEqual((copy.max_entries, copy.ttl), (5, 10))
+
+    def test_tree_key_is_canonical(self):
+        tree = ["JOINᶲp1", ["TPFᶲp1"], ["TPFᶲp2"]]
+        self.assertEqual(
+            tree_key(json.loads(json.dumps(tree, indent=2))), tree_key(tree)
+        )
+
+
+class TestCachedPrediction(unittest.TestCase):
+    def test_predict_raw_data(self):
+        reg, ds, query, card = fitted_regressor(80, 7)
+        trees = ds["trees"].values
+        expected = np.asarray(reg.predict_raw_data(trees, query, card))
+
+        cache = PredictionCache()
+        reg.set_prediction_cache(cache)
+        first = np.asarray(reg.predict_raw_data(trees, query, card))
+        self.assertEqual(cache.stats()["misses"], len(ds))
+        # same trees with other whitespace, and half of the rows
+        spaced = [json.dumps(json.loads(tree), indent=1) for tree in trees[:40]]
+        second = np.asarray(reg.predict_raw_data(spaced, query[:40], card[:40]))
+        self.assertEqual(cache.stats()["hits"], 40)
+        np.testing.assert_allclose(first, expected, rtol=1e-6)
+        np.testing.assert_allclose(second, expected[:40], rtol=1e-6)
+
+        # a new featurizer invalidates the predictions
+        reg.fit_transform_tree_data(ds, ds.iloc[:0], ds.iloc[:0])
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+import profiling
+from profiling import StageProfiler
+
+
+class TestStageProfiler(unittest.TestCase):
+    def test_inactive_stage_is_noop(self):
+        self.assertIsNone(profiling.active())
+        with profiling.stage("forward"):
+            pass
+        self.assertEqual(list(profiling.iterate([1, 2], "data")), [1, 2])
+
+    def test_epoch_summary(self):
+        profiler = StageProfiler()
+        with profiler:
+            self.assertIs(profiling.active(), profiler)
+            for _ in profiling.iterate(range(3), "data"):
+                with profiling.stage("forward"):
+                    with profiling.stage("prepare_trees"):
+                        pass
+            summary = profiler.end_epoch(0)
+            with profiling.stage("forward"):
+                pass
+            profiler.end_epoch(1)
+        self.assertIsNone(profiling.active())
+
+        # 3 items and the last call that stops the iteration
+        self.assertEqual(summary["stages"]["data"]["count"], 4)
+        self.assertEqual(summary["stages"]["forward"]["count"], 3)
+        self.assertEqual(summary["stages"]["prepare_trees"]["count"], 3)
+        self.assertEqual(profiler.epochs[1]["stages"]["forward"]["count"], 1)
+        self.assertNotIn("data", profiler.epochs[1]["stages"])
+        self.assertIn("forward", StageProfiler.format_summary(summary))
+
+    def test_nested_self_time(self):
+        profiler = StageProfiler()
+        with profiler:
+            for _ in range(2):
+                with profiling.stage("forward"):
+                    time.sleep(0.01)
+                    with profiling.stage("prepare_trees"):
+                        time.sleep(0.02)
+            summary = profiler.end_epoch(0)
+        stages = summary["stages"]
+        forward, prepare = stages["forward"], stages["prepare_trees"]
+        # The nested stage is in the total of forward, not in its self time
+        self.assertAlmostEqual(forward["total"], forward["self"] + prepare["total"])
+        self.assertAlmostEqual(prepare["self"], prepare["total"])
+        self.assertLessEqual(
+            sum(stats["self"] for stats in stages.values()), summary["wall"]
+        )
+        percentages = [
+            float(line.split("(")[1].split("%")[0])
+            for line in StageProfiler.format_summary(summary).splitlines()[1:]
+            if "%" in line
+        ]
+        self.assertLessEqual(sum(percentages), 100.0)
+
+    def test_chrome_trace(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.json")
+            with StageProfiler(trace_path=path, max_trace_events=2) as profiler:
+                for _ in range(3):
+                    with profiling.stage("forward"):
+                        pass
+            with open(path) as f:
+                events = json.load(f)["traceEvents"]
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[0]["name"], "forward")
+        self.assertEqual(events[0]["ph"], "X")
+        self.assertEqual(profiler._stages["forward"]["count"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
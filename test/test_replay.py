@@ -0,0 +1,118 @@
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+
+from benchmarks.synthetic import random_dataset
+from data_preprocessing import LIST_QUERY_COLUMNS
+from Models.model_gbt import GBTRegression
+from replay import read_batches, replay, summary_path
+from serving import load_model
+from test.helpers import fitted_regressor
+from train import train_and_save_model
+
+
+class TestReplay(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.reg, _, _, _ = fitted_regressor(
+            40, 7, data_seed=1, tree_units=[32, 16], tree_units_dense=[8]
+        )
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.ds = random_dataset(70, 7, seed=2)
+        # A bad json tree is not predicted
+        cls.ds.loc[5, "trees"] = "[not json"
+        cls.log = os.path.join(cls.tmp.name, "log.csv")
+        cls.ds.to_csv(cls.log, index=False, sep="ᶶ")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def expected(self, reg):
+        valid = self.ds.drop(index=5)
+        query = valid[LIST_QUERY_COLUMNS].values.astype(float)
+        cards = reg.encode_cardinalities(valid["json_cardinality"].values)
+        return np.asarray(
+            reg.predict_raw_data(valid["trees"].values, query, cards)
+        ).reshape(-1)
+
+    def check(self, reg, threads):
+        output = os.path.join(self.tmp.name, "predictions_{}.csv".format(threads))
+        summary = replay(
+            reg, self.log, output, batch_size=16, threads=threads, with_evaluation=True
+        )
+        self.assertEqual(summary["rows"], 70)
+        self.assertEqual(summary["batches"], 5)
+        self.assertGreater(summary["rows_per_second"], 0)
+        self.assertEqual(summary["evaluation"]["count"], 69)
+        predictions = pd.read_csv(output)
+        np.testing.assert_array_equal(predictions["row"], np.arange(70))
+        np.testing.assert_allclose(predictions["time"], self.ds["time"])
+        self.assertTrue(np.isnan(predictions["prediction"][5]))
+        np.testing.assert_allclose(
+            predictions["prediction"].drop(index=5), self.expected(reg), rtol=1e-5
+        )
+
+    def test_replay(self):
+        self.check(self.reg, threads=1)
+        self.check(self.reg, threads=3)
+
+    def test_gbt(self):
+        reg = GBTRegression(max_iter=20, eval_every=20)
+        ds = random_dataset(100, 7, seed=1)
+        trees, _, _ = reg.fit_transform_tree_data(ds, ds.iloc[:0], ds.iloc[:0])
+        cards = reg.encode_cardinalities(ds["json_cardinality"].values, fit=True)
+        query = ds[LIST_QUERY_COLUMNS].values.astype(float)
+        y = ds["time"].values
+        reg.fit(trees, query, y, trees, query, y, cards, cards)
+        self.check(reg, threads=2)
+
+    def check_trained(self, gbt):
+        # A model of train.py replays the raw log as its predictions of the
+        # query features scaled as in training
+        ds_train = random_dataset(60, 7, seed=3)
+        output = tempfile.mkdtemp(dir=self.tmp.name)
+        train_and_save_model(
+            ds_train, ds_train.iloc[:20], self.ds.drop(index=5), output, gbt=gbt
+        )
+        reg = load_model(os.path.join(output, "regressor"), map_location="cpu")
+        self.assertIsNotNone(reg.query_scaler)
+        predictions = os.path.join(output, "predictions.csv")
+        replay(reg, self.log, predictions, batch_size=16)
+
+        valid = self.ds.drop(index=5)
+        scaler = StandardScaler().fit(ds_train[LIST_QUERY_COLUMNS])
+        scaled = scaler.transform(valid[LIST_QUERY_COLUMNS])
+        cards = reg.encode_cardinalities(valid["json_cardinality"].values)
+        reg.query_scaler = None
+        expected = np.asarray(
+            reg.predict_raw_data(valid["trees"].values, scaled, cards)
+        ).reshape(-1)
+        np.testing.assert_allclose(
+            pd.read_csv(predictions)["prediction"].drop(index=5), expected, rtol=1e-5
+        )
+
+    def test_trained(self):
+        self.check_trained(gbt=False)
+
+    def test_trained_gbt(self):
+        self.check_trained(gbt=True)
+
+    def test_read_batches(self):
+        sizes = [len(batch) for batch in read_batches(self.log, 32)]
+        self.assertEqual(sizes, [32, 32, 6])
+        batch = next(read_batches(self.log, 8, columns=["trees", "time"]))
+        self.assertEqual(list(batch.columns), ["trees", "time"])
+        self.assertEqual(
+            summary_path(os.path.join("out", "predictions.csv")),
+            os.path.join("out", "predictions.replay.json"),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,205 @@
+import os
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from artifact import save_artifact
+from Models.model_trees_algebra import NeoRegression
+from serving import ConcurrentPredictor, HotSwapPredictor, load_model
+from test.helpers import fitted_regressor
+
+
+def serving_regressor(seed):
+    reg, ds, query, card = fitted_regressor(
+        40, 7, seed=seed, data_seed=1, tree_units=[32, 16], tree_units_dense=[8]
+    )
+    return reg, (ds["trees"].values, query, card)
+
+
+def predict(reg, data):
+    return np.asarray(reg.predict_raw_data(*data)).reshape(-1)
+
+
+class TestSaveLoad(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.reg, cls.data = serving_regressor(0)
+        cls.expected = predict(cls.reg, cls.data)
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.path = os.path.join(cls.tmp.name, "model")
+        cls.reg.save(cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def test_round_trip(self):
+        # The configuration of the instance is replaced by the saved one
+        reg = NeoRegression(tree_units=[8], query_output=4)
+        reg.load(self.path, map_location="cpu")
+        self.assertEqual(reg.tree_units, [32, 16])
+        self.assertEqual(reg.query_input_size, self.reg.query_input_size)
+        self.assertFalse(reg.net.training)
+        np.testing.assert_allclose(predict(reg, self.data), self.expected, rtol=1e-5)
+
+    def test_load_model(self):
+        reg = load_model(self.path)
+        self.assertIsInstance(reg, NeoRegression)
+        np.testing.assert_allclose(predict(reg, self.data), self.expected, rtol=1e-5)
+
+    def test_lazy(self):
+        reg = load_model(self.path, lazy=True)
+        self.assertEqual(set(reg._deferred), {"net", "tree_transform"})
+        np.testing.assert_allclose(predict(reg, self.data), self.expected, rtol=1e-5)
+        self.assertEqual(reg._deferred, {})
+
+    def test_best_model_path(self):
+        other, _ = serving_regressor(1)
+        best = os.path.join(self.tmp.name, "checkpoint.pt")
+        torch.save(other.net.state_dict(), best)
+        reg = load_model(self.path)
+        reg.load(self.path, best)
+        np.testing.assert_allclose(
+            predict(reg, self.data), predict(other, self.data), rtol=1e-5
+        )
+
+    def test_without_config(self):
+        # Saved before the configuration was saved with the model
+        path = os.path.join(self.tmp.name, "old")
+        self.reg.save(path)
+        os.remove(os.path.join(path, "config.json"))
+        reg = NeoRegression(tree_units=[32, 16], tree_units_dense=[8])
+        reg.load(path)
+        np.testing.assert_allclose(predict(reg, self.data), self.expected, rtol=1e-5)
+
+
+class _Blocking:
+    """Model whose predictions wait for an event"""
+
+    def __init__(self, value):
+        self.value = value
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def predict_raw_data(self, trees, queries, cards=None):
+        self.started.set()
+        self.release.wait(5)
+        return self.value
+
+
+class TestHotSwapPredictor(unittest.TestCase):
+    def test_swap_keeps_running_requests(self):
+        old, new = _Blocking("old"), _Blocking("new")
+        new.release.set()
+        predictor = HotSwapPredictor(old)
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(predictor.predict_raw_data([], []))
+        )
+        thread.start()
+        old.started.wait(5)
+        generation = predictor.swap(new)
+        self.assertEqual(predictor.running(), {generation: 1})
+        self.assertEqual(predictor.predict_raw_data([], []), "new")
+        self.assertFalse(predictor.wait_drained(generation, timeout=0.01))
+        old.release.set()
+        self.assertTrue(predictor.wait_drained(generation, timeout=5))
+        thread.join()
+        self.assertEqual(results, ["old"])
+        self.assertEqual(predictor.running(), {})
+
+    def test_reload(self):
+        reg, data = serving_regressor(0)
+        other, _ = serving_regressor(1)
+        predictor = HotSwapPredictor(reg)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "model.safetensors")
+            save_artifact(other, path)
+            self.assertEqual(predictor.reload(path, "cpu", warmup=data), 0)
+        self.assertEqual(predictor.generation, 1)
+        np.testing.assert_allclose(
+            predict(predictor, data), predict(other, data), rtol=1e-5
+        )
+
+    def test_frozen(self):
+        # Requests record nothing in the regressor and can run in threads
+        reg, data = serving_regressor(0)
+        expected = predict(reg, data)
+        samples = len(reg.tree_transform.get_aec_ds())
+        predictor = HotSwapPredictor(reg)
+        with ThreadPoolExecutor(3) as executor:
+            results = list(executor.map(lambda _: predict(predictor, data), range(3)))
+        for result in results:
+            np.testing.assert_allclose(result, expected, rtol=1e-5)
+        self.assertEqual(len(reg.tree_transform.get_aec_ds()), samples)
+        served = predictor._predictors[0]
+        self.assertIsInstance(served, ConcurrentPredictor)
+        self.assertEqual(served.model.tree_transform.get_aec_ds(), [])
+
+        # The old predictor is closed once drained
+        self.assertEqual(predictor.swap(serving_regressor(1)[0]), 0)
+        self.assertTrue(predictor.wait_drained(0, timeout=5))
+        with self.assertRaises(RuntimeError):
+            served.submit(*data)
+        predictor.close()
+
+    def test_lazy(self):
+        # The lazy model loads on the first request, not when it is swapped in
+        reg, data = serving_regressor(0)
+        with tempfile.TemporaryDirectory() as tmp:
+            reg.save(tmp)
+            lazy = load_model(tmp, lazy=True)
+            predictor = HotSwapPredictor(reg)
+            self.assertEqual(predictor.swap(lazy), 0)
+            self.assertEqual(set(lazy._deferred), {"net", "tree_transform"})
+            self.assertEqual(predictor._predictors, {})
+            np.testing.assert_allclose(
+                predict(predictor, data), predict(reg, data), rtol=1e-5
+            )
+        self.assertEqual(lazy._deferred, {})
+        self.assertEqual(list(predictor._predictors), [1])
+        predictor.close()
+
+
+class TestConcurrentPredictor(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.reg, cls.data = serving_regressor(0)
+        cls.expected = predict(cls.reg, cls.data)
+
+    def test_same_predictions(self):
+        samples = len(self.reg.tree_transform.get_aec_ds())
+        with ConcurrentPredictor(self.reg, workers=3, batch_size=16) as predictor:
+            np.testing.assert_allclose(
+                predict(predictor, self.data), self.expected, rtol=1e-6
+            )
+            np.testing.assert_allclose(
+                np.asarray(predictor.predict_parallel(*self.data)).reshape(-1),
+                self.expected,
+                rtol=1e-6,
+            )
+            self.assertFalse(predictor.model.net.training)
+            self.assertFalse(
+                any(p.requires_grad for p in predictor.model.net.parameters())
+            )
+        # Neither the featurizer nor the net of the regressor change
+        self.assertEqual(len(self.reg.tree_transform.get_aec_ds()), samples)
+        self.assertTrue(all(p.requires_grad for p in self.reg.net.parameters()))
+
+    def test_threads(self):
+        with ConcurrentPredictor(self.reg, workers=2, batch_size=8) as predictor:
+            with ThreadPoolExecutor(4) as pool:
+                futures = [pool.submit(predict, predictor, self.data) for _ in range(8)]
+                futures.append(predictor.submit(*self.data))
+            for future in futures:
+                np.testing.assert_allclose(
+                    np.asarray(future.result()).reshape(-1), self.expected, rtol=1e-6
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
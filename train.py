@@ -1,21 +1,46 @@
 import datetime
 import os
-from sklearn.metrics import mean_squared_error
 from sklearn.preprocessing import StandardScaler
 
 import data_preprocessing
+from evaluation import evaluate, format_report, write_report
+from distributed import (
+    broadcast_object,
+    cleanup,
+    get_rank,
+    is_main_process,
+    setup_from_env,
+    spawn,
+)
+from profiling import StageProfiler
+from transforms import QueryScaler
 from Models.model_trees_algebra import NeoRegression as NeoRegression
 from Models.model_trees_algebra_aec import NeoRegression as AECNeoRegression
-import numpy as np
-import pandas as pd
+from Models.model_gbt import GBTRegression
 
 import argparse
 import os.path as osp
 
 
 def train_and_save_model(
-    ds_train, ds_val, ds_test, output_path, aec=None, verbose=True
+    ds_train,
+    ds_val,
+    ds_test,
+    output_path,
+    aec=None,
+    verbose=True,
+    profile=False,
+    distributed=False,
+    gbt=False,
 ):
+    """
+    Train, save and evaluate a model. With distributed=True every process of the
+    group (see distributed.py) runs it, rank 0 saves and evaluates the model.
+    With gbt=True the model is the gradient boosted trees baseline, see
+    Models/model_gbt.py.
+    """
+    if gbt and distributed:
+        raise ValueError("The gradient boosted trees can't be trained distributed")
 
     x_train_query = ds_train[data_preprocessing.LIST_QUERY_COLUMNS]
     x_train_query_json_card = ds_train[data_preprocessing.CARDINALITY_COLUMNS]
@@ -26,62 +51,59 @@ def train_and_save_model(
     x_test_query = ds_test[data_preprocessing.LIST_QUERY_COLUMNS]
     x_test_query_json_card = ds_test[data_preprocessing.CARDINALITY_COLUMNS]
 
-    x_train_tree = ds_train["trees"].values
-    x_val_tree = ds_val["trees"].values
-    x_test_tree = ds_test["trees"].values
-
     y_train = ds_train["time"].values
     y_val = ds_val["time"].values
     y_test = ds_test["time"].values
 
-    scalerx = StandardScaler()
-    x_train_scaled = scalerx.fit_transform(x_train_query)
-    x_val_scaled = scalerx.transform(x_val_query)
-    x_test_scaled = scalerx.transform(x_test_query)
-
-    # Scale x_query data.
-    scaled_df_train = pd.DataFrame(
-        x_train_scaled, index=x_train_query.index, columns=x_train_query.columns
-    )
-    x_train_query = data_preprocessing.concat_dataframes(
-        scaled_df_train, x_train_query_json_card
-    )
-
-    scaled_df_val = pd.DataFrame(
-        x_val_scaled, index=x_val_query.index, columns=x_val_query.columns
-    )
-    x_val_query = data_preprocessing.concat_dataframes(
-        scaled_df_val, x_val_query_json_card
-    )
-
-    scaled_df_test = pd.DataFrame(
-        x_test_scaled, index=x_test_query.index, columns=x_test_query.columns
-    )
-    x_test_query = data_preprocessing.concat_dataframes(
-        scaled_df_test, x_test_query_json_card
-    )
-
-    max_cardinality = data_preprocessing.get_max_cardinaliy(x_train_query_json_card)
+    # The query features are scaled by the model, which is saved with the scaler
+    query_scaler = QueryScaler.from_scaler(StandardScaler().fit(x_train_query))
 
     verbose = True
-    if aec:
+    profiler = None
+    if profile:
+        # On several nodes only rank 0 created output_path, every rank writes in it
+        os.makedirs(output_path, exist_ok=True)
+        trace = "profile_trace.json"
+        if distributed:
+            trace = "profile_trace_rank{}.json".format(get_rank())
+        profiler = StageProfiler(cuda=True, trace_path=osp.join(output_path, trace))
+    if gbt:
+        reg = GBTRegression(verbose=verbose, output_path=output_path)
+    elif aec:
         reg = AECNeoRegression(
-            epochs=2, verbose=verbose, output_path=output_path, aec=aec
+            epochs=2,
+            verbose=verbose,
+            output_path=output_path,
+            aec=aec,
+            profiler=profiler,
+            distributed=distributed,
         )
     else:
-        reg = NeoRegression(epochs=2, verbose=verbose, output_path=output_path, aec=aec)
+        reg = NeoRegression(
+            epochs=2,
+            verbose=verbose,
+            output_path=output_path,
+            aec=aec,
+            profiler=profiler,
+            distributed=distributed,
+        )
 
-    # Fit the transformer tree data
-    reg.fit_transform_tree_data(ds_train, ds_val, ds_test)
+    reg.query_scaler = query_scaler
+
+    # Fit the transformer tree data, trees are parsed once and shared with fit
+    x_train_tree, x_val_tree, x_test_tree = reg.fit_transform_tree_data(
+        ds_train, ds_val, ds_test
+    )
 
-    x_train_query["json_cardinality"] = x_train_query["json_cardinality"].apply(
-        lambda x: data_preprocessing.pred2index_dict(x, reg.get_pred(), max_cardinality)
+    # Encode cardinalities over the predicates vocabulary, normalized by train max.
+    x_train_card = reg.encode_cardinalities(
+        x_train_query_json_card["json_cardinality"].values, fit=True
     )
-    x_val_query["json_cardinality"] = x_val_query["json_cardinality"].apply(
-        lambda x: data_preprocessing.pred2index_dict(x, reg.get_pred(), max_cardinality)
+    x_val_card = reg.encode_cardinalities(
+        x_val_query_json_card["json_cardinality"].values
     )
-    x_test_query["json_cardinality"] = x_test_query["json_cardinality"].apply(
-        lambda x: data_preprocessing.pred2index_dict(x, reg.get_pred(), max_cardinality)
+    x_test_card = reg.encode_cardinalities(
+        x_test_query_json_card["json_cardinality"].values
     )
 
     # Fit model
@@ -92,13 +114,22 @@ def train_and_save_model(
         x_val_tree,
         x_val_query.values,
         y_val,
+        X_card=x_train_card,
+        X_val_card=x_val_card,
     )
+    if distributed and not is_main_process():
+        return reg
     reg.save(osp.join(output_path, "regressor"))
+    if profiler is not None:
+        profiler.export_json(osp.join(output_path, "profile.json"))
 
     # Prediction
-    preds_val = reg.predict_raw_data(x_val_tree, x_val_query.values)
-    rmse = np.sqrt(mean_squared_error(y_val, preds_val))
-    print("RMSE in VAL: {}".format(rmse))
+    preds_val = reg.predict_raw_data(x_val_tree, x_val_query.values, x_val_card)
+    # Rows with bad json trees are not predicted
+    y_val = y_val[x_val_tree.rows]
+    report_val = evaluate(preds_val, y_val)
+    print("RMSE in VAL: {}".format(report_val["rmse"]))
+    print(format_report(report_val))
     reg.scatter_image(
         preds_val,
         y_val,
@@ -106,20 +137,25 @@ def train_and_save_model(
         osp.join(output_path, "model_with_aec_scatter_val"),
     )
 
-    preds_test = reg.predict_raw_data(x_test_tree, x_test_query.values)
-    rmsetest = np.sqrt(mean_squared_error(y_test, preds_test))
-    print("RMSE in TEST: {}".format(rmsetest))
+    preds_test = reg.predict_raw_data(x_test_tree, x_test_query.values, x_test_card)
+    y_test = y_test[x_test_tree.rows]
+    report_test = evaluate(preds_test, y_test)
+    print("RMSE in TEST: {}".format(report_test["rmse"]))
+    print(format_report(report_test))
     reg.scatter_image(
         preds_test,
         y_test,
         "Scatter real latency vs prediction on Test dataset.",
         osp.join(output_path, "model_with_aec_scatter_test"),
     )
+    write_report(
+        {"val": report_val, "test": report_test}, osp.join(output_path, "regressor")
+    )
 
     return reg
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(
         description="Create training data for embedding model"
     )
@@ -163,12 +199,38 @@ def parse_args():
     parser.add_argument(
         "--with-aec", dest="with_aec", help="", type=bool, default=False, required=False
     )
+    parser.add_argument(
+        "--gbt",
+        dest="gbt",
+        help="train the gradient boosted trees baseline instead of the neural model",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        help="time the stages of training, summaries in the log and a chrome trace",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--nprocs",
+        dest="nprocs",
+        help="local processes for data parallel training on CPU (gloo), "
+        "under torchrun the processes of torchrun are used",
+        default=1,
+        type=int,
+        required=False,
+    )
 
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    # The gradient boosted trees train on one process
+    if args.gbt and (args.nprocs > 1 or int(os.environ.get("WORLD_SIZE", 1)) > 1):
+        parser.error(
+            "--gbt trains on a single process, not under torchrun or --nprocs > 1"
+        )
+    return args
 
 
-if __name__ == "__main__":
-    args = parse_args()
+def prepare_output(args):
     model_id = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
     ds_train, ds_val, ds_test = data_preprocessing.prepare_datasets(
         args.data_dir, val_rate=args.val_rate, seed=args.seed, model_id=model_id
@@ -178,6 +240,18 @@ if __name__ == "__main__":
     output = osp.join(args.output_dir, model_id)
     if not os.path.isdir(output):
         os.mkdir(output)
+    return ds_train, ds_val, ds_test, output
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # Under torchrun rank 0 prepares the datasets and shares them
+    distributed = setup_from_env()
+    if distributed:
+        prepared = prepare_output(args) if is_main_process() else None
+        ds_train, ds_val, ds_test, output = broadcast_object(prepared)
+    else:
+        ds_train, ds_val, ds_test, output = prepare_output(args)
     aec = (
         {
             "train_aec": True,
@@ -187,4 +261,37 @@ if __name__ == "__main__":
         if args.with_aec
         else None
     )
-    train_and_save_model(ds_train, ds_val, ds_test, output, aec=aec)
+    if distributed:
+        train_and_save_model(
+            ds_train,
+            ds_val,
+            ds_test,
+            output,
+            aec=aec,
+            profile=args.profile,
+            distributed=True,
+        )
+        cleanup()
+    elif args.nprocs > 1:
+        spawn(
+            train_and_save_model,
+            args.nprocs,
+            ds_train,
+            ds_val,
+            ds_test,
+            output,
+            aec,
+            True,
+            args.profile,
+            True,
+        )
+    else:
+        train_and_save_model(
+            ds_train,
+            ds_val,
+            ds_test,
+            output,
+            aec=aec,
+            profile=args.profile,
+            gbt=args.gbt,
+        )
@@ -0,0 +1,158 @@
+"""
+Transforms of the inputs and targets of the regressors that only need numpy and
+scipy, so a saved model predicts without sklearn: the cardinality encoder, the
+query feature matrix and the target transform of the artifacts.
+"""
+
+import json
+
+import numpy as np
+from scipy import sparse
+
+
+class CardinalityEncoder:
+    """
+    Encode a ``json_cardinality`` column as a sparse CSR matrix aligned with the
+    predicate vocabulary of the tree featurizer.
+
+    The column is parsed once; the normalizer (max cardinality of the column) is
+    computed in the same pass. Predicates out of the vocabulary are dropped, like
+    ``pred2index_dict`` did, or accumulated in ``OTHER_PRED`` with
+    ``unknown="other"``. Either way they are counted in ``unknown_predicates``.
+    """
+
+    def __init__(self, pred_to_index, unknown="ignore", other_pred="OTHER_PRED"):
+        if unknown not in ("ignore", "other"):
+            raise ValueError("unknown must be 'ignore' or 'other', got: " + unknown)
+        self.pred_to_index = pred_to_index
+        self.unknown = unknown
+        self.other_index = pred_to_index[other_pred]
+        self.max_cardinality = None
+        self.unknown_predicates = {}
+
+    def __len__(self):
+        return len(self.pred_to_index)
+
+    def fit(self, column):
+        self.fit_transform(column)
+        return self
+
+    def fit_transform(self, column):
+        matrix, max_cardinality = self._parse(column)
+        # Avoid division by zero on columns without cardinalities
+        self.max_cardinality = max_cardinality if max_cardinality > 0 else 1.0
+        return self._normalize(matrix)
+
+    def transform(self, column):
+        assert self.max_cardinality is not None, "CardinalityEncoder is not fitted"
+        matrix, _ = self._parse(column)
+        return self._normalize(matrix)
+
+    def _normalize(self, matrix):
+        matrix.data = (matrix.data / self.max_cardinality).astype(np.float32)
+        return matrix
+
+    def _parse(self, column):
+        indptr = [0]
+        indices = []
+        data = []
+        max_cardinality = 0.0
+        for value in column:
+            if isinstance(value, str):
+                value = json.loads(value)
+            for pred, cardinality in value.items():
+                cardinality = float(cardinality)
+                if cardinality > max_cardinality:
+                    max_cardinality = cardinality
+                if pred in self.pred_to_index:
+                    indices.append(self.pred_to_index[pred])
+                else:
+                    self.unknown_predicates[pred] = (
+                        self.unknown_predicates.get(pred, 0) + 1
+                    )
+                    if self.unknown == "ignore":
+                        continue
+                    indices.append(self.other_index)
+                data.append(cardinality)
+            indptr.append(len(indices))
+
+        matrix = sparse.csr_matrix(
+            (
+                np.asarray(data, dtype=np.float64),
+                np.asarray(indices, dtype=np.int64),
+                np.asarray(indptr, dtype=np.int64),
+            ),
+            shape=(len(indptr) - 1, len(self.pred_to_index)),
+        )
+        # Several unknown predicates may fall in OTHER_PRED
+        matrix.sum_duplicates()
+        return matrix, max_cardinality
+
+
+def query_card_matrix(x_query, x_card):
+    """Stack scaled query features and the cardinality block in one CSR matrix"""
+    x_query = sparse.csr_matrix(np.asarray(x_query, dtype=np.float32))
+    return sparse.hstack([x_query, x_card], format="csr", dtype=np.float32)
+
+
+class LogMinMaxTransform:
+    """
+    Target transform of BaseRegression, log1p then min max scaling, as a scale
+    and an offset. Same results as the sklearn pipeline it replaces.
+    """
+
+    def __init__(self, scale, offset):
+        self.scale = float(scale)
+        self.offset = float(offset)
+
+    @classmethod
+    def from_pipeline(cls, pipeline):
+        names = [name for name, _ in pipeline.steps]
+        if names != ["log", "scale"]:
+            raise ValueError("Unsupported target pipeline {}".format(names))
+        scaler = pipeline.named_steps["scale"]
+        return cls(scaler.scale_[0], scaler.min_[0])
+
+    def transform(self, y):
+        y = np.log1p(np.asarray(y, dtype=np.float64))
+        y *= self.scale
+        y += self.offset
+        return y
+
+    def inverse_transform(self, y):
+        y = np.array(y, dtype=np.float64)
+        y -= self.offset
+        y /= self.scale
+        return np.exp(y) - 1
+
+
+class QueryScaler:
+    """
+    Standardization of the query features, the StandardScaler of train.py as
+    mean and scale floats. Saved with the model, the regressors apply it to the
+    query features of fit and of the predictions.
+    """
+
+    def __init__(self, mean, scale):
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+
+    @classmethod
+    def from_scaler(cls, scaler):
+        """QueryScaler of a fitted sklearn StandardScaler"""
+        n_features = scaler.n_features_in_
+        mean = scaler.mean_ if scaler.with_mean else np.zeros(n_features)
+        scale = scaler.scale_ if scaler.with_std else np.ones(n_features)
+        return cls(mean, scale)
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(values["mean"], values["scale"])
+
+    def to_dict(self):
+        return {"mean": self.mean.tolist(), "scale": self.scale.tolist()}
+
+    def transform(self, x_query):
+        x_query = np.asarray(x_query, dtype=np.float64) - self.mean
+        x_query /= self.scale
+        return x_query